@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import sys
+
+from src import configure
+from src.release import parse_range, releases_from_ranges
+from src.utils import split_list
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Baixa, transforma e salva vários trimestres ou visitas da PNADC")
+    parser.add_argument('-y', '--years', dest='years', type=parse_range, help="Anos da PNADC, ex: 2012-2024", required=True)
+    parser.add_argument('-q','--quarters', dest='quarters', type=parse_range, default=[], help="Trimestres da PNADC, ex: 1-4")
+    parser.add_argument('-v','--visits', dest='visits', type=parse_range, default=[], help="Números das visitas, ex: 1,5")
+    parser.add_argument('-a','--anual', dest='force_yearly', action="store_true", default=False, help="Forçar dados anuais (útil para trimestres)")
+    parser.add_argument('-t','--translate', dest='translate', action="store_true", default=False, help="Traduzir códigos para a forma legível")
+    parser.add_argument('-n','--col-names', dest='col_names', action="store_true", default=False, help="Substituir código das variáveis pelas descrições correspondentes")
+    parser.add_argument('-f','--format', dest='file_format', choices=["csv", "parquet", "arrow", "sqlite"], default="csv", help="Formato do arquivo de saída")
+    parser.add_argument('-c','--columns', dest='columns', type=split_list, default=None, help="Variáveis a serem lidas e salvas, separadas por vírgula, ex: UF,V2007,V2009")
+    parser.add_argument('--where', dest='where', action="append", default=None, help="Filtro das linhas, pode ser repetido, ex: UF=35, \"V2009>=18\", \"Capital in (11, 35)\"")
+    parser.add_argument('-e','--engine', dest='engine', choices=["python", "numpy"], default="python", help="Motor de leitura do arquivo (numpy é vetorizado)")
+    parser.add_argument('-d','--downloads', dest='downloads', type=int, default=2, help="Número de downloads simultâneos")
+    parser.add_argument('-w','--workers', dest='workers', type=int, default=2, help="Número de processos para ler e transformar os dados")
+    args = parser.parse_args()
+    configure()
+    logging.debug(f"""Parsed args:
+    Years: {args.years}
+    Quarters: {args.quarters}
+    Visits: {args.visits}
+    Translate: {args.translate}
+    Force yearly: {args.force_yearly}
+    Change column names: {args.col_names}
+    Format: {args.file_format}
+    Engine: {args.engine}
+    Columns: {args.columns}
+    Filters: {args.where}
+    Downloads: {args.downloads}
+    Workers: {args.workers}""")
+    return args
+
+def main():
+    args = parse_args()
+    releases = releases_from_ranges(args.years, args.quarters, args.visits, args.force_yearly)
+    if not releases:
+        raise SystemExit("'Trimestres' or 'Visitas' must be passed")
+    from src.batch import run_batch
+    results = run_batch(releases, args.translate, args.col_names, args.engine, args.file_format,
+        args.downloads, args.workers, columns=args.columns, where=args.where)
+    failed = [result for result in results if not result.ok]
+    logging.info(f"{len(results) - len(failed)} of {len(results)} releases processed")
+    for result in failed:
+        logging.error(f"{result.release}: {result.error}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+import argparse
+from dataclasses import asdict
+import json
+import logging
+import os
+import tempfile
+
+from src import configure
+from src.benchmark import ENGINES, FORMATS, format_results, results_to_json, run_benchmark, run_scenario
+from src.synthetic import LAYOUTS
+from src.utils import split_list
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mede a vazão do download, leitura, tradução e escrita com dados sintéticos servidos por um FTP local")
+    parser.add_argument('-r', '--rows', dest='rows', type=int, default=100000, help="Número de linhas de cada arquivo de dados")
+    parser.add_argument('-x', '--extra-variables', dest='extra_variables', type=int, default=0, help="Variáveis codificadas extras, para se aproximar da largura dos arquivos reais")
+    parser.add_argument('-l', '--layouts', dest='layouts', type=split_list, default=list(LAYOUTS), help=f"Layouts, entre {','.join(LAYOUTS)}")
+    parser.add_argument('-e', '--engines', dest='engines', type=split_list, default=ENGINES, help=f"Motores, entre {','.join(ENGINES)}")
+    parser.add_argument('-f', '--formats', dest='formats', type=split_list, default=FORMATS, help=f"Formatos, entre {','.join(FORMATS)}")
+    parser.add_argument('-d', '--workdir', dest='workdir', default=None, help="Diretório dos arquivos gerados, temporário se não for passado")
+    parser.add_argument('-o', '--output', dest='output', default=None, help="Arquivo para salvar o resultado em JSON")
+    parser.add_argument('--scenario', dest='scenario', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    configure()
+    return args
+
+def main():
+    args = parse_args()
+    if args.scenario:
+        # A single combination, run by run_benchmark in its own process
+        result = run_scenario(**json.loads(args.scenario))
+        print(json.dumps(asdict(result)))
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        results = run_benchmark(os.path.abspath(__file__), workdir, args.rows, args.layouts,
+            args.engines, args.formats, args.extra_variables)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'rows': args.rows, 'extra_variables': args.extra_variables,
+                'results': results_to_json(results)}, f, indent=2)
+        logging.info(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
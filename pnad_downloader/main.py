@@ -1,13 +1,15 @@
 #!/usr/bin/python3
 import argparse
-from functools import partial
 import logging
+from typing import TYPE_CHECKING, List
 
-from src import CONVERT_ASCII
-from src.reader import PnadReader
-from src.utils import get_list_size, apply_inplace
-from src.anual import build_pnad_anual_trimestre, build_pnad_anual_visita
-from src.trimestral import build_pnad_trimestral
+import os
+
+from src import SAVE_PATH, configure
+from src.utils import split_list
+
+if TYPE_CHECKING:
+    from src.reader import PnadReader
 
 class WrongArgument(Exception):
     pass
@@ -20,53 +22,106 @@ def parse_args():
     parser.add_argument('-a','--anual', dest='force_yearly', action="store_true", default=False, help="Forçar dados anuais (útil para trimestres)")
     parser.add_argument('-t','--translate', dest='translate', action="store_true", default=False, help="Traduzir códigos para a forma legível")
     parser.add_argument('-n','--col-names', dest='col_names', action="store_true", default=False, help="Substituir código das variáveis pelas descrições correspondentes")
+    parser.add_argument('-w','--workers', dest='workers', type=int, default=1, help="Número de processos para ler e transformar os dados")
+    parser.add_argument('-f','--format', dest='file_format', choices=["csv", "parquet", "arrow", "sqlite"], default="csv", help="Formato do arquivo de saída")
+    parser.add_argument('-c','--columns', dest='columns', type=split_list, default=None, help="Variáveis a serem lidas e salvas, separadas por vírgula, ex: UF,V2007,V2009")
+    parser.add_argument('--where', dest='where', action="append", default=None, help="Filtro das linhas, pode ser repetido, ex: UF=35, \"V2009>=18\", \"Capital in (11, 35)\"")
+    parser.add_argument('-p','--partition-by', dest='partition_by', type=split_list, default=[], help="Salvar em diretórios no estilo Hive pelos valores destas variáveis, ex: UF_ABREV ou UF_ABREV,Capital")
+    parser.add_argument('-e','--engine', dest='engine', choices=["python", "numpy"], default="python", help="Motor de leitura do arquivo (numpy é vetorizado)")
+    parser.add_argument('-g','--group-by', dest='group_by', type=split_list, default=None, help="Em vez de salvar os microdados, salvar totais e médias ponderados agrupados por estas variáveis, ex: UF,Capital")
+    parser.add_argument('--weight', dest='weight', default=None, help="Variável de peso das agregações (padrão: V1028 nos trimestres, V1032 nos dados anuais)")
+    parser.add_argument('--measures', dest='measures', type=split_list, default=[], help="Variáveis numéricas somadas e com médias nas agregações, ex: VD4020")
+    parser.add_argument('--profile', dest='profile', action="store_true", default=False, help="Medir tempo, vazão e memória de cada etapa e salvar em JSON")
+    parser.add_argument('--cprofile', dest='cprofile', default=None, help="Etapa a ser medida também com o cProfile, ex: parse, translate, write")
     args = parser.parse_args()
+    # The config is only read and logging set up once the arguments are valid, so -h does no work
+    configure()
     logging.debug(f"""Parsed args:
     Year: {args.year}
     Quarter: {args.quarter}
     Visit: {args.visit}
     Translate: {args.translate}
     Force yearly: {args.force_yearly}
-    Change column names: {args.col_names}""")
+    Change column names: {args.col_names}
+    Engine: {args.engine}
+    Workers: {args.workers}
+    Format: {args.file_format}
+    Columns: {args.columns}
+    Filters: {args.where}
+    Partition by: {args.partition_by}
+    Group by: {args.group_by}
+    Weight: {args.weight or 'default of the release'}
+    Measures: {args.measures}
+    Profile: {args.profile}
+    cProfile stage: {args.cprofile}""")
     return args
 
+def validate_args(args:argparse.Namespace) -> None:
+    """Checks the combinations of arguments, before anything is downloaded"""
+    if args.visit and args.quarter:
+        raise WrongArgument("Only one of 'Trimestre' or 'Visita' must be passed")
+    if not args.visit and not args.quarter:
+        raise WrongArgument("'Trimestre' or 'Visita' must be passed")
+    if args.partition_by and args.file_format == "sqlite":
+        raise WrongArgument("Only csv, parquet and arrow files can be partitioned")
+
 def main():
     reader = None
     args = parse_args()
-    if args.visit and args.quarter:
-        raise WrongArgument("Only one of 'Trimestre' or 'Visita' must be passed")
+    validate_args(args)
+    # Imported here so the arguments are parsed before the reader and its dependencies are loaded
+    from src.anual import build_pnad_anual_trimestre, build_pnad_anual_visita
+    from src.metrics import PROFILER
+    from src.reader import LOCATION_VARS, PnadReader
+    from src.trimestral import build_pnad_trimestral
+    if args.profile or args.cprofile:
+        PROFILER.enable(args.cprofile)
     if args.visit:
-        reader = PnadReader(build_pnad_anual_visita(args.year, args.visit))
+        reader = PnadReader(build_pnad_anual_visita(args.year, args.visit), columns=args.columns, where=args.where)
     elif args.quarter:
         if args.force_yearly:
-            reader = PnadReader(build_pnad_anual_trimestre(args.year, args.quarter))
+            reader = PnadReader(build_pnad_anual_trimestre(args.year, args.quarter), columns=args.columns, where=args.where)
         else:
-            reader = PnadReader(build_pnad_trimestral(args.year, args.quarter))
-    else:
-        raise WrongArgument("'Trimestre' or 'Visita' must be passed")
+            reader = PnadReader(build_pnad_trimestral(args.year, args.quarter), columns=args.columns, where=args.where)
 
-    logging.info("Downloading file")
-    pnad = reader.download_pnad()
-    logging.info(f"Data size: {get_list_size(pnad) / (1024 * 1024)} MB")
-    logging.info("Parsing and transforming data")
-    pnad_data = map(reader.parse_row, pnad)
     if args.translate:
-        translate = partial(reader.translate_record, tvars = reader.pnad_vars)
-        pnad_data = map(translate, pnad_data)
+        tvars = reader.pnad_vars
     else:
         # Converts only state and capital values
-        translate = partial(reader.translate_record, tvars = ["UF","Capital","RM_RIDE"])
-        pnad_data = map(translate, pnad_data)
-    if args.col_names:
-        pnad_data = map(reader.var_to_name_record, pnad_data)
-    if CONVERT_ASCII:
-        pnad_data = map(reader.to_ascii, pnad_data)
-    pnad_data = list(pnad_data)
-    # Insert a column with the UF abreviations
-    apply_inplace(pnad_data, reader.insert_uf_abrev_from_name)
-    logging.info("Saving to file")
-    reader.to_file(pnad_data)
-    
+        tvars = LOCATION_VARS
+
+    logging.info("Downloading, parsing and transforming data")
+    try:
+        save(reader, tvars, args)
+    finally:
+        reader.close()
+    if PROFILER.enabled:
+        PROFILER.save(os.path.join(SAVE_PATH, f"{reader.pnad_read_vars.save_filename}_profile.json"))
+
+def save(reader:"PnadReader", tvars:List[str], args:argparse.Namespace) -> None:
+    """Downloads, parses, transforms and saves the pnad data as set by the arguments"""
+    if args.group_by is not None:
+        aggregator = reader.aggregate(args.group_by, args.weight, args.measures, args.engine)
+        reader.save_aggregate(aggregator, tvars)
+    # A SQLite database has a single writer and the partitions of the workers would
+    # collide, so both are always written by this process
+    elif args.workers > 1 and args.file_format != "sqlite" and not args.partition_by:
+        from src.parallel import process_in_parallel
+        with reader.extract_pnad() as extracted_path:
+            process_in_parallel(reader, extracted_path, SAVE_PATH, tvars, args.col_names, args.engine,
+                args.workers, args.file_format)
+    elif args.engine == "numpy":
+        with reader.open_pnad() as buffer:
+            pnad_data = reader.transform(reader.iter_columnar_rows(buffer, tvars))
+            logging.info("Saving to file")
+            reader.to_file(pnad_data, file_format=args.file_format, tvars=tvars, col_names=args.col_names,
+                partition_by=args.partition_by)
+    else:
+        # Lines flow one at a time from the zip to the writer, saved again if the streamed zip is corrupted
+        logging.info("Saving to file")
+        reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(lines, tvars), file_format=args.file_format,
+            tvars=tvars, col_names=args.col_names, partition_by=args.partition_by))
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
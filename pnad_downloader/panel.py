@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import argparse
+import logging
+
+from src import configure
+from src.release import parse_range, releases_from_ranges
+from src.utils import split_list
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Liga os mesmos domicílios ou moradores entre trimestres ou visitas da PNADC")
+    parser.add_argument('-y', '--years', dest='years', type=parse_range, help="Anos da PNADC, ex: 2022-2023", required=True)
+    parser.add_argument('-q','--quarters', dest='quarters', type=parse_range, default=[], help="Trimestres da PNADC, ex: 1-4")
+    parser.add_argument('-v','--visits', dest='visits', type=parse_range, default=[], help="Números das visitas, ex: 1,5")
+    parser.add_argument('-a','--anual', dest='force_yearly', action="store_true", default=False, help="Forçar dados anuais (útil para trimestres)")
+    parser.add_argument('-k','--keys', dest='keys', type=split_list, default=None, help="Variáveis da chave, ex: UPA,V1008,V1014 para domicílios (padrão: UPA,V1008,V1014,V2003)")
+    parser.add_argument('-c','--columns', dest='columns', type=split_list, default=None, help="Variáveis salvas para cada chave, separadas por vírgula, ex: UF,V2007,V2009")
+    parser.add_argument('--keep', dest='keep', type=split_list, default=[], help="Variáveis mantidas da primeira visita em que a chave aparece, as outras ficam com o valor da última")
+    parser.add_argument('--wide', dest='wide', action="store_true", default=False, help="Salvar as variáveis de cada trimestre ou visita em colunas próprias")
+    parser.add_argument('--min-waves', dest='min_waves', type=int, default=2, help="Número mínimo de trimestres ou visitas em que a chave deve aparecer")
+    parser.add_argument('--where', dest='where', action="append", default=None, help="Filtro das linhas, pode ser repetido, ex: UF=35, \"V2009>=18\"")
+    parser.add_argument('-t','--translate', dest='translate', action="store_true", default=False, help="Traduzir códigos para a forma legível")
+    parser.add_argument('-i','--index-path', dest='index_path', default=None, help="Diretório dos índices das chaves (padrão: data/panel)")
+    args = parser.parse_args()
+    configure()
+    logging.debug(f"""Parsed args:
+    Years: {args.years}
+    Quarters: {args.quarters}
+    Visits: {args.visits}
+    Force yearly: {args.force_yearly}
+    Keys: {args.keys}
+    Columns: {args.columns}
+    Keep: {args.keep}
+    Wide: {args.wide}
+    Min waves: {args.min_waves}
+    Filters: {args.where}
+    Translate: {args.translate}
+    Index path: {args.index_path}""")
+    return args
+
+def main():
+    args = parse_args()
+    releases = releases_from_ranges(args.years, args.quarters, args.visits, args.force_yearly)
+    if len(releases) < 2:
+        raise SystemExit("At least two 'Trimestres' or 'Visitas' must be passed")
+    from src.panel import PERSON_KEYS, link_panel
+    link_panel(releases, args.keys or PERSON_KEYS, args.columns, args.keep, args.min_waves, args.wide,
+        args.translate, args.where, args.index_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,122 @@
 from dataclasses import dataclass
-import logging
-from configparser import ConfigParser
-from typing import Callable, Dict, List, NewType, Tuple
+from typing import Callable, Dict, List, NewType, Optional, Sequence, Tuple
 import os
 
 BASE_PATH = "/Trabalho_e_Rendimento/Pesquisa_Nacional_por_Amostra_de_Domicilios_continua/"
 SAVE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
-if not os.path.isdir(SAVE_PATH):
-    os.mkdir(SAVE_PATH)
-
-config = ConfigParser()
-config.read(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'config.ini'))
-CONVERT_ASCII = config['saving'].getboolean('convert_to_ascii', False)
-MAX_LINES = config['saving'].getint('max_lines_per_file', None)
-DEBUG = config['DEFAULT'].getboolean('debug', True)
-
-if DEBUG:
-    logging.basicConfig(level="DEBUG")
-else:
-    logging.basicConfig(level="INFO")
-logging.debug("Program initiated")
-logging.debug(f"""Configs: 
-    Converto to ascii: {CONVERT_ASCII} 
-    Max lines per file: {MAX_LINES}
-    Truncate in multiple files: {bool(MAX_LINES)}""")
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.ini')
+
+@dataclass(frozen=True)
+class Settings:
+    """The options of config.ini, read once when first needed instead of at import"""
+
+    convert_ascii: bool = False
+    max_lines: Optional[int] = None
+    spool_path: str = SAVE_PATH
+    compression: str = "none"
+    compression_level: Optional[int] = None
+    writer_threads: int = 2
+    max_open_files: int = 32
+    part_size_bytes: int = 128 * 1024 * 1024
+    debug: bool = True
+    cache_enabled: bool = True
+    cache_path: str = os.path.join(SAVE_PATH, "cache")
+    cache_max_bytes: int = 4096 * 1024 * 1024
+    cache_revalidate_after: int = 0
+    ftp_host: str = "ftp.ibge.gov.br"
+    ftp_port: int = 21
+    ftp_max_sessions: int = 4
+    ftp_retries: int = 3
+    ftp_segments: int = 1
+    ftp_segment_min_bytes: int = 32 * 1024 * 1024
+    pipeline_enabled: bool = True
+    pipeline_queue_size: int = 16
+
+    @classmethod
+    def from_file(cls, path:Optional[str] = None) -> "Settings":
+        """Reads the settings from a config file
+
+        Args:
+            path (Optional[str]): the config file, PNAD_DOWNLOADER_CONFIG (e.g. for the benchmark)
+            or config.ini if None. Missing sections and options take their defaults
+        """
+        from configparser import ConfigParser
+        config = ConfigParser()
+        config.read(path or os.environ.get("PNAD_DOWNLOADER_CONFIG", DEFAULT_CONFIG_PATH))
+        for section in ('saving', 'cache', 'ftp', 'pipeline'):
+            if not config.has_section(section):
+                config.add_section(section)
+        saving, cache, ftp, pipeline = config['saving'], config['cache'], config['ftp'], config['pipeline']
+        return cls(
+            convert_ascii=saving.getboolean('convert_to_ascii', False),
+            max_lines=saving.getint('max_lines_per_file', None),
+            spool_path=saving.get('spool_path', SAVE_PATH),
+            compression=saving.get('compression', "none"),
+            compression_level=saving.getint('compression_level', None),
+            writer_threads=saving.getint('writer_threads', 2),
+            max_open_files=saving.getint('max_open_files', 32),
+            part_size_bytes=saving.getint('part_size_mb', 128) * 1024 * 1024,
+            debug=config['DEFAULT'].getboolean('debug', True),
+            cache_enabled=cache.getboolean('enabled', True),
+            cache_path=cache.get('path', os.path.join(SAVE_PATH, "cache")),
+            cache_max_bytes=cache.getint('max_size_mb', 4096) * 1024 * 1024,
+            cache_revalidate_after=cache.getint('revalidate_after_seconds', 0),
+            ftp_host=ftp.get('host', "ftp.ibge.gov.br"),
+            ftp_port=ftp.getint('port', 21),
+            ftp_max_sessions=ftp.getint('max_sessions', 4),
+            ftp_retries=ftp.getint('retries', 3),
+            ftp_segments=ftp.getint('segments', 1),
+            ftp_segment_min_bytes=ftp.getint('segment_min_size_mb', 32) * 1024 * 1024,
+            pipeline_enabled=pipeline.getboolean('enabled', True),
+            pipeline_queue_size=pipeline.getint('queue_size', 16))
+
+_settings: Optional[Settings] = None
+
+def settings() -> Settings:
+    """Returns the settings set by configure, reading the config file the first time
+    when it was not called, e.g. in a worker process or when used as a library"""
+    global _settings
+    if _settings is None:
+        _settings = Settings.from_file()
+    return _settings
+
+def configure(path:Optional[str] = None) -> Settings:
+    """Reads the settings and sets up logging and the data directory, called by the
+    scripts before they do any work so that importing the package has no side effects
+
+    Args:
+        path (Optional[str]): the config file, see Settings.from_file
+    """
+    global _settings
+    import logging
+    _settings = Settings.from_file(path)
+    logging.basicConfig(level="DEBUG" if _settings.debug else "INFO")
+    os.makedirs(SAVE_PATH, exist_ok=True)
+    os.makedirs(_settings.spool_path, exist_ok=True)
+    logging.debug("Program initiated")
+    logging.debug(f"""Configs: 
+    Converto to ascii: {_settings.convert_ascii} 
+    Max lines per file: {_settings.max_lines}
+    Truncate in multiple files: {bool(_settings.max_lines)}
+    Compression: {_settings.compression}
+    Writer threads: {_settings.writer_threads}
+    Max open partition files: {_settings.max_open_files}
+    Partition part size: {_settings.part_size_bytes / (1024 * 1024)} MB
+    Cache enabled: {_settings.cache_enabled}
+    Cache path: {_settings.cache_path}
+    Cache max size: {_settings.cache_max_bytes / (1024 * 1024)} MB
+    Pipelined: {_settings.pipeline_enabled}
+    Pipeline queue size: {_settings.pipeline_queue_size}""")
+    return _settings
 
 PnadDict = NewType('PnadDict', Dict[str, Dict[str, str]])
 PnadInputInfo = NewType('PnadInputInfo', List[Tuple[str, str, int, str]])
-PnadData = NewType('PnadData', List[str])
-PnadParse = Callable[[str], List[str]]
+PnadData = NewType('PnadData', List[bytes])
+# Parses a raw line into the raw bytes of each field
+PnadParse = Callable[[bytes], List[bytes]]
 Record = NewType('Record', Dict[str, str])
+# The values of a line in the order of its Schema, see src.translation
+Row = Sequence[str]
 
 class ArgumentNotSpecifiedError(Exception):
     pass
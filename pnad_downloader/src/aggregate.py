@@ -0,0 +1,136 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from src import Row
+
+# Survey weights of the quarterly and yearly (visit and quarter) releases
+QUARTERLY_WEIGHT = "V1028"
+YEARLY_WEIGHT = "V1032"
+DEFAULT_WEIGHT = QUARTERLY_WEIGHT
+
+# The totals of a group: rows, sum of weights, then the weighted sum and
+# the sum of weights of the rows where it is not blank, for each measure
+Totals = List[float]
+GroupKey = Tuple[str, ...]
+
+def to_float(value:str) -> Optional[float]:
+    """Returns the number of a parsed value, None for blanks and other values that are not numbers"""
+    value = value.strip(' .')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+class WeightedAggregator:
+    """Accumulates grouped weighted counts, sums and means of parsed rows, in one pass
+
+    Only a list of totals per group is kept, so the memory used depends on the
+    number of groups and not on the number of rows.
+    """
+
+    def __init__(self, variables:Sequence[str], group_by:Sequence[str], weight:str = DEFAULT_WEIGHT,
+        measures:Sequence[str] = ()):
+        """Initiates the WeightedAggregator object
+
+        Args:
+            variables (Sequence[str]): the variables of the parsed rows, in order
+            group_by (Sequence[str]): the variables to group by, none for a single total
+            weight (str): the survey weight variable, e.g. V1028 or V1032
+            measures (Sequence[str]): the numeric variables to sum and average, e.g. VD4020
+        """
+        variables = list(variables)
+        self.group_by = list(group_by)
+        self.weight = weight
+        self.measures = list(measures)
+        self.group_idx = [variables.index(var) for var in self.group_by]
+        self.weight_idx = variables.index(weight)
+        self.measure_idx = [variables.index(var) for var in self.measures]
+        self.totals: Dict[GroupKey, Totals] = dict()
+
+    def add(self, values:Sequence[str]) -> None:
+        """Adds a parsed row, with blank weights counting as zero and
+        measures that are blank or not numbers left out of their totals"""
+        key = tuple(values[i] for i in self.group_idx)
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = [0.0] * (2 + 2 * len(self.measure_idx))
+        weight = to_float(values[self.weight_idx]) or 0.0
+        totals[0] += 1
+        totals[1] += weight
+        for j, i in enumerate(self.measure_idx, 1):
+            value = to_float(values[i])
+            if value is not None:
+                totals[2 * j] += weight * value
+                totals[2 * j + 1] += weight
+
+    def add_all(self, rows:Iterable[Sequence[str]]) -> "WeightedAggregator":
+        for values in rows:
+            self.add(values)
+        return self
+
+    def merge(self, totals:Dict[GroupKey, Totals]) -> None:
+        """Adds the totals of other rows, e.g. from aggregate_columns"""
+        for key, other in totals.items():
+            mine = self.totals.setdefault(key, [0.0] * len(other))
+            for i, value in enumerate(other):
+                mine[i] += value
+
+    @property
+    def header(self) -> List[str]:
+        header = self.group_by + ["rows", "weighted_count"]
+        for var in self.measures:
+            header += [f"{var}_sum", f"{var}_mean"]
+        return header
+
+    def table(self, translate_key:Optional[Callable[[GroupKey], GroupKey]] = None) -> List[Row]:
+        """Returns a row per group, sorted by the raw group values, with the columns of header
+
+        Args:
+            translate_key (Optional[Callable[[GroupKey], GroupKey]]): translates the group values,
+            they are only stripped if None
+        """
+        rows: List[Row] = list()
+        for key in sorted(self.totals):
+            totals = self.totals[key]
+            key = translate_key(key) if translate_key is not None else tuple(value.strip(' .') for value in key)
+            row = [*key, int(totals[0]), totals[1]]
+            for j in range(1, len(self.measures) + 1):
+                weighted_sum, weights = totals[2 * j], totals[2 * j + 1]
+                row += [weighted_sum, weighted_sum / weights if weights else '']
+            rows.append(row)
+        return rows
+
+def aggregate_columns(data:Any, group_by:Sequence[str], weight:str = DEFAULT_WEIGHT,
+    measures:Sequence[str] = ()) -> Dict[GroupKey, Totals]:
+    """Computes the totals of WeightedAggregator for a whole parsed file at once with NumPy
+
+    Groups are found with a single np.unique over the raw group spans and every
+    total is a np.bincount over the group of each row.
+
+    Args:
+        data (Any): the structured array from columnar.parse_buffer
+        group_by (Sequence[str]): the variables to group by
+        weight (str): the survey weight variable
+        measures (Sequence[str]): the numeric variables to sum and average
+
+    Returns:
+        Dict[GroupKey, Totals]: the totals of each group, keyed by the decoded raw values
+    """
+    import numpy as np
+    from numpy.lib import recfunctions
+    from src.columnar import to_numeric_or_nan
+    if group_by:
+        keys, inverse = np.unique(recfunctions.repack_fields(data[list(group_by)]), return_inverse=True)
+        keys = [tuple(value.decode('ISO-8859-1') for value in key) for key in keys.tolist()]
+    else:
+        keys, inverse = [()], np.zeros(len(data), dtype=np.intp)
+    inverse = inverse.ravel()
+    bincount = lambda weights: np.bincount(inverse, weights=weights, minlength=len(keys))
+    weights = np.nan_to_num(to_numeric_or_nan(data[weight]))
+    columns = [bincount(None).astype(np.float64), bincount(weights)]
+    for var in measures:
+        values = to_numeric_or_nan(data[var])
+        present = ~np.isnan(values)
+        columns += [bincount(np.where(present, weights * np.nan_to_num(values), 0.0)),
+            bincount(np.where(present, weights, 0.0))]
+    totals = np.column_stack(columns).tolist()
+    return {key: group_totals for key, group_totals in zip(keys, totals) if group_totals[0]}
@@ -0,0 +1,176 @@
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from src import Row
+from src.metrics import PROFILER
+from src.output import Part, describe_part
+from src.utils import ichunks
+
+# Rows per row group (parquet) or record batch (arrow) when MAX_LINES is not set
+DEFAULT_BATCH_SIZE = 100000
+
+FILE_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow"}
+
+def arrow_schema(fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]]) -> pa.Schema:
+    """Builds the schema of the output: dictionary encoded strings for the
+    columns with labels, plain strings for the others
+
+    Args:
+        fieldnames (Sequence[str]): the output column names
+        labels (Sequence[Optional[Sequence[str]]]): the known labels of each column, or None
+    """
+    return pa.schema([
+        pa.field(name, pa.dictionary(pa.int32(), pa.string()) if field_labels is not None else pa.string())
+        for name, field_labels in zip(fieldnames, labels)
+    ])
+
+class ArrowRecordWriter:
+    """Writes rows to a parquet or Arrow IPC file in batches
+
+    Dictionary encoded columns start with the labels from the pnad dictionary, values
+    outside of it are appended, so every batch shares (a delta of) the same dictionary.
+    """
+
+    def __init__(self, path:str, fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]],
+        file_format:str = "parquet"):
+        """Initiates the ArrowRecordWriter object
+
+        Args:
+            path (str): the path of the file
+            fieldnames (Sequence[str]): the output column names
+            labels (Sequence[Optional[Sequence[str]]]): the known labels of each column,
+            None for columns that are not dictionary encoded
+            file_format (str): "parquet" or "arrow"
+        """
+        self.fieldnames = list(fieldnames)
+        self.schema = arrow_schema(fieldnames, labels)
+        self.dictionaries: List[Optional[List[str]]] = [None if l is None else list(dict.fromkeys(l)) for l in labels]
+        self.indexes: List[Optional[Dict[str, int]]] = [None if d is None else {v: i for i, v in enumerate(d)}
+            for d in self.dictionaries]
+        self.file_format = file_format
+        # Bytes of the batches written, as the file on disk lags behind the buffered row groups
+        self.written = 0
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema)
+        elif file_format == "arrow":
+            self.writer = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        else:
+            raise ValueError(f"Unknown file format {file_format}")
+
+    def _code(self, i:int, value:str) -> int:
+        dictionary, index = self.dictionaries[i], self.indexes[i]
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(dictionary)
+            dictionary.append(value)
+        return code
+
+    def _encode(self, i:int, values:Sequence[str]) -> pa.Array:
+        if self.dictionaries[i] is None:
+            return pa.array(values, pa.string())
+        indices = [self._code(i, value) for value in values]
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.dictionaries[i], pa.string()))
+
+    def _recode(self, i:int, column:pa.Array) -> pa.Array:
+        """Converts a column read from another file to the type and dictionary of column i"""
+        if self.dictionaries[i] is None:
+            return column.cast(pa.string())
+        import pyarrow.compute as pc
+        if not pa.types.is_dictionary(column.type):
+            column = column.dictionary_encode()
+        codes = pa.array([self._code(i, value) for value in column.dictionary.to_pylist()], pa.int32())
+        return pa.DictionaryArray.from_arrays(pc.take(codes, column.indices), pa.array(self.dictionaries[i], pa.string()))
+
+    def write(self, rows:Sequence[Row]) -> None:
+        """Writes a batch of rows as one row group (parquet) or record batch (arrow)"""
+        if not rows:
+            return
+        arrays = [self._encode(i, values) for i, values in enumerate(zip(*rows))]
+        self._write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def write_batch(self, batch:pa.RecordBatch) -> None:
+        """Writes a record batch read from another file with the same columns, e.g. the
+        shard of a worker, with its dictionaries merged into the ones of this file"""
+        if not batch.num_rows:
+            return
+        arrays = [self._recode(i, column) for i, column in enumerate(batch.columns)]
+        self._write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def _write_batch(self, batch:pa.RecordBatch) -> None:
+        rows = batch.num_rows
+        self.written += batch.nbytes
+        if self.file_format == "parquet":
+            self.writer.write_batch(batch, row_group_size=rows)
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def __enter__(self) -> "ArrowRecordWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def write_arrow(path:str, fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]],
+    rows:Iterable[Row], file_format:str, batch_size:int) -> int:
+    """Writes rows to a single parquet or arrow file, batch_size rows at a time
+
+    Returns:
+        int: the number of rows written
+    """
+    count = 0
+    with ArrowRecordWriter(path, fieldnames, labels, file_format) as writer:
+        for chunk in ichunks(rows, batch_size):
+            batch = list(chunk)
+            with PROFILER.stage("write") as counts:
+                writer.write(batch)
+                counts.rows = len(batch)
+            count += len(batch)
+    return count
+
+def read_batches(path:str, file_format:str) -> Iterator[pa.RecordBatch]:
+    """Yields the row groups (parquet) or record batches (arrow) of a file, one at a time"""
+    if file_format == "parquet":
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            yield from parquet_file.read_row_group(i).combine_chunks().to_batches()
+    else:
+        with pa.ipc.open_file(path) as ipc_file:
+            for i in range(ipc_file.num_record_batches):
+                yield ipc_file.get_batch(i)
+
+def concat_arrow(paths:Sequence[str], output:str, fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]],
+    file_format:str) -> None:
+    """Writes the batches of several parquet or arrow files with the same columns, in order, to a single file"""
+    with ArrowRecordWriter(output, fieldnames, labels, file_format) as writer:
+        for path in paths:
+            for batch in read_batches(path, file_format):
+                writer.write_batch(batch)
+
+def rows_to_arrow(path:str, filename:str, fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]],
+    rows:Iterable[Row], file_format:str = "parquet", batch_size:Optional[int] = None) -> Part:
+    """Saves rows to a parquet or Arrow IPC file, streaming one row group at a time
+
+    Args:
+        path (str): the absolute path to the directory to save the file
+        filename (str): the filename to be saved, without extension
+        fieldnames (Sequence[str]): the output column names
+        labels (Sequence[Optional[Sequence[str]]]): the known labels of each column, or None
+        rows (Iterable[Row]): the data as an iterable of rows in fieldnames order
+        file_format (str): "parquet" or "arrow"
+        batch_size (Optional[int]): rows per row group (MAX_LINES)
+
+    Returns:
+        Part: the written file with its number of rows and checksum
+    """
+    file_path = os.path.join(path, f"{filename}.{FILE_EXTENSIONS[file_format]}")
+    logging.info(f"Saving to {os.path.basename(file_path)}")
+    rows_written = write_arrow(file_path, fieldnames, labels, rows, file_format, batch_size or DEFAULT_BATCH_SIZE)
+    return describe_part(file_path, rows_written)
@@ -0,0 +1,132 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from src import SAVE_PATH, PnadDict, PnadInputInfo, PnadReadVars
+from src.ftp import FtpPool
+from src.reader import LOCATION_VARS, PnadReader
+from src.release import Release
+
+@dataclass
+class ReleaseResult:
+    release: Release
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+def metadata_key(read_vars:PnadReadVars) -> Hashable:
+    """Releases with the same key share the input file and dictionary"""
+    return (read_vars.input_file_abspath, read_vars.input_is_zipped, read_vars.input_zipped_file_re,
+        read_vars.input_file_re, read_vars.dictionary_file_abspath, read_vars.dictionary_is_zipped,
+        read_vars.dictionary_zipped_file_re, read_vars.dictionary_file_re)
+
+class MetadataStore:
+    """Builds readers reusing the input file information and dictionary already
+    downloaded for other releases, safe to use from several threads"""
+
+    def __init__(self, pool:Optional[FtpPool] = None, columns:Optional[Sequence[str]] = None,
+        where:Optional[Sequence[str]] = None):
+        self.pool = pool if pool is not None else PnadReader.build_pool()
+        self.columns = columns
+        self.where = where
+        self.metadata: Dict[Hashable, Tuple[PnadInputInfo, PnadDict]] = dict()
+        self.locks: Dict[Hashable, threading.Lock] = dict()
+        self.lock = threading.Lock()
+
+    def reader_for(self, read_vars:PnadReadVars) -> PnadReader:
+        key = metadata_key(read_vars)
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        # Only the first release of each key downloads, the others wait for it
+        with key_lock:
+            if key in self.metadata:
+                input_info, pnad_dict = self.metadata[key]
+                return PnadReader(read_vars, input_info, pnad_dict, self.pool, self.columns, self.where)
+            reader = PnadReader(read_vars, pool=self.pool, columns=self.columns, where=self.where)
+            self.metadata[key] = (reader.input_info, reader.pnad_dict)
+            return reader
+
+def process_release(reader:PnadReader, path:str, translate:bool, col_names:bool, engine:str,
+    file_format:str, save_path:str) -> None:
+    """Parses, transforms and saves an unzipped release, run in a worker process"""
+    tvars = reader.pnad_vars if translate else LOCATION_VARS
+    reader.save_extracted(path, tvars, col_names, engine, file_format, save_path)
+
+def run_batch(releases:List[Release], translate:bool = False, col_names:bool = False, engine:str = "python",
+    file_format:str = "csv", downloads:int = 2, workers:int = 2, save_path:str = SAVE_PATH,
+    columns:Optional[Sequence[str]] = None, where:Optional[Sequence[str]] = None) -> List[ReleaseResult]:
+    """Downloads and processes many releases, overlapping downloads with processing
+
+    Downloads and unzipping run in a pool of threads, processing in a pool of processes.
+    At most downloads + workers unzipped releases are on disk at the same time.
+    A failure is reported for its release without stopping the others.
+
+    Args:
+        releases (List[Release]): the releases to process
+        translate (bool): translate all codes, not only the location ones
+        col_names (bool): substitute the variables for their descriptions
+        engine (str): "python" or "numpy"
+        file_format (str): "csv", "parquet", "arrow" or "sqlite"
+        downloads (int): the maximum number of concurrent downloads
+        workers (int): the number of processes
+        save_path (str): the directory to save the files
+        columns (Optional[Sequence[str]]): the variables to parse and save, all of them if None
+        where (Optional[Sequence[str]]): filters that every saved row must match
+
+    Returns:
+        List[ReleaseResult]: the result of each release, in the given order
+    """
+    store = MetadataStore(columns=columns, where=where)
+    slots = threading.BoundedSemaphore(downloads + workers)
+    results: Dict[Release, ReleaseResult] = dict()
+
+    def download(release:Release) -> Tuple[PnadReader, str, ExitStack]:
+        slots.acquire()
+        stack = ExitStack()
+        try:
+            logging.info(f"Downloading {release}")
+            reader = store.reader_for(release.read_vars())
+            path = stack.enter_context(reader.extract_pnad())
+            return reader, path, stack
+        except BaseException:
+            stack.close()
+            slots.release()
+            raise
+
+    def release_slot(stack:ExitStack, future:Future) -> None:
+        stack.close()
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=downloads) as download_pool, \
+        ProcessPoolExecutor(max_workers=workers) as process_pool:
+        download_futures = {download_pool.submit(download, release): release for release in releases}
+        process_futures: Dict[Future, Release] = dict()
+        for future in as_completed(download_futures):
+            release = download_futures[future]
+            try:
+                reader, path, stack = future.result()
+            except Exception as e:
+                logging.error(f"Failed to download {release}: {e!r}")
+                results[release] = ReleaseResult(release, repr(e))
+                continue
+            logging.info(f"Processing {release}")
+            process_future = process_pool.submit(process_release, reader, path, translate, col_names,
+                engine, file_format, save_path)
+            process_future.add_done_callback(lambda f, stack=stack: release_slot(stack, f))
+            process_futures[process_future] = release
+        for future in as_completed(process_futures):
+            release = process_futures[future]
+            try:
+                future.result()
+                logging.info(f"Finished {release}")
+                results[release] = ReleaseResult(release)
+            except Exception as e:
+                logging.error(f"Failed to process {release}: {e!r}")
+                results[release] = ReleaseResult(release, repr(e))
+    store.pool.close()
+    return [results[release] for release in releases]
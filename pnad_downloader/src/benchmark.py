@@ -0,0 +1,229 @@
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field
+import glob
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.synthetic import LAYOUTS, build_release, synthetic_variables
+
+ENGINES = ["python", "numpy"]
+FORMATS = ["csv", "parquet", "arrow", "sqlite"]
+
+@dataclass
+class StageResult:
+    stage: str
+    seconds: float
+    rows: int
+    bytes: int
+    peak_rss_mb: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / (1024 * 1024) / self.seconds if self.seconds else 0.0
+
+@dataclass
+class ScenarioResult:
+    layout: str
+    engine: str
+    file_format: str
+    stages: List[StageResult] = field(default_factory=list)
+    error: Optional[str] = None
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident memory of this process, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageTimer:
+    """Times the stages of a scenario, one after the other"""
+
+    def __init__(self):
+        self.stages: List[StageResult] = list()
+
+    def add(self, stage:str, start:float, rows:int, size:int) -> None:
+        self.stages.append(StageResult(stage, time.perf_counter() - start, rows, size, peak_rss_mb()))
+
+def serve_ftp(root:str, host:str = "127.0.0.1", port:int = 0) -> Tuple[Any, int]:
+    """Serves a directory to anonymous users from a FTP server running in a daemon thread
+
+    Args:
+        root (str): the directory to serve
+        host (str): the address to listen on
+        port (int): the port to listen on, any free port if 0
+
+    Returns:
+        Tuple[Any, int]: the pyftpdlib server, to close_all() when done, and its port
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+    logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type("BenchmarkHandler", (FTPHandler,), {"authorizer": authorizer})
+    server = FTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.address[1]
+
+def write_config(path:str, workdir:str, host:str, port:int) -> None:
+    """Writes the config of the scenario processes: local server, no cache and a single output file"""
+    with open(path, 'w') as f:
+        f.write(f"""[DEFAULT]
+debug = False
+
+[saving]
+max_lines_per_file = 0
+convert_to_ascii = False
+spool_path = {os.path.join(workdir, "spool")}
+
+[cache]
+enabled = False
+
+[ftp]
+host = {host}
+port = {port}
+""")
+
+def run_scenario(layout:str, year:int, period:int, engine:str, file_format:str, save_path:str) -> ScenarioResult:
+    """Runs the download, parse, translate and write stages of a release,
+    keeping each stage output in memory so they are timed apart
+
+    Args:
+        layout (str): "trimestral", "anual_visita" or "anual_trimestre"
+        year (int): the year of the release
+        period (int): the quarter or the visit
+        engine (str): "python" or "numpy"
+        file_format (str): "csv", "parquet", "arrow" or "sqlite"
+        save_path (str): the directory to save the output
+
+    Returns:
+        ScenarioResult: the result of each stage
+    """
+    from src.reader import PnadReader, mmap_file
+    timer = StageTimer()
+    start = time.perf_counter()
+    reader = PnadReader(LAYOUTS[layout](year, period))
+    timer.add("metadata", start, 0, 0)
+    tvars = reader.pnad_vars
+    with ExitStack() as stack:
+        start = time.perf_counter()
+        path = stack.enter_context(reader.extract_pnad())
+        size = os.path.getsize(path)
+        buffer = stack.enter_context(mmap_file(path))
+        rows = size // (buffer.find(b'\n') + 1) if size else 0
+        timer.add("download", start, rows, size)
+        if engine == "numpy":
+            from src.columnar import columns_to_rows
+            start = time.perf_counter()
+            columns = reader.parse_columns(buffer)
+            timer.add("parse", start, rows, size)
+            start = time.perf_counter()
+            columns = reader.translate_columns(columns, tvars)
+            rows = list(reader.transform(columns_to_rows(columns, 100000)))
+            # Release the views of the memory map before it is closed
+            del columns
+        else:
+            start = time.perf_counter()
+            parsed = [reader.parse(line) for line in iter(buffer.readline, b'')]
+            timer.add("parse", start, rows, size)
+            builder = reader.row_builder(tvars)
+            start = time.perf_counter()
+            rows = [builder.build(values) for values in parsed]
+            del parsed
+        timer.add("translate", start, len(rows), size)
+        start = time.perf_counter()
+        reader.to_file(rows, save_path, file_format, tvars)
+        written = sum(map(os.path.getsize, glob.glob(os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}*"))))
+        timer.add("write", start, len(rows), written)
+    reader.close()
+    return ScenarioResult(layout, engine, file_format, timer.stages)
+
+def run_scenario_process(script:str, config_path:str, layout:str, year:int, period:int,
+    engine:str, file_format:str, save_path:str) -> ScenarioResult:
+    """Runs a scenario in its own process, so its peak memory is measured alone"""
+    scenario = {'layout': layout, 'year': year, 'period': period, 'engine': engine,
+        'file_format': file_format, 'save_path': save_path}
+    env = dict(os.environ, PNAD_DOWNLOADER_CONFIG=config_path)
+    process = subprocess.run([sys.executable, script, '--scenario', json.dumps(scenario)],
+        env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit code {process.returncode}"
+        return ScenarioResult(layout, engine, file_format, error=error)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return ScenarioResult(layout, engine, file_format, [StageResult(**stage) for stage in result['stages']])
+
+def run_benchmark(script:str, workdir:str, rows:int, layouts:List[str] = tuple(LAYOUTS),
+    engines:List[str] = ENGINES, formats:List[str] = FORMATS, extra_variables:int = 0) -> List[ScenarioResult]:
+    """Generates a synthetic release for each layout, serves them from a local FTP
+    server and runs every combination of layout, engine and output format
+
+    Args:
+        script (str): the benchmark script, run with --scenario for each combination
+        workdir (str): the directory for the FTP root, spool and outputs
+        rows (int): the number of lines of each data file
+        layouts (List[str]): the layouts of LAYOUTS to generate
+        engines (List[str]): the engines to run
+        formats (List[str]): the output formats to write
+        extra_variables (int): extra coded variables, to approach the width of the real files
+
+    Returns:
+        List[ScenarioResult]: the result of each combination
+    """
+    root = os.path.join(workdir, "ftp")
+    for name in ("ftp", "spool", "output"):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    variables = synthetic_variables(extra_variables)
+    releases = list()
+    for layout in layouts:
+        logging.info(f"Generating {rows} rows for {layout}")
+        build_release(root, layout, 2023, 1, rows, variables)
+        releases.append((layout, 2023, 1))
+    server, port = serve_ftp(root)
+    config_path = os.path.join(workdir, "config.ini")
+    write_config(config_path, workdir, "127.0.0.1", port)
+    results: List[ScenarioResult] = list()
+    try:
+        for layout, year, period in releases:
+            for engine in engines:
+                for file_format in formats:
+                    logging.info(f"Running {layout} {engine} {file_format}")
+                    save_path = os.path.join(workdir, "output", f"{layout}_{engine}_{file_format}")
+                    os.makedirs(save_path, exist_ok=True)
+                    results.append(run_scenario_process(script, config_path, layout, year, period,
+                        engine, file_format, save_path))
+    finally:
+        server.close_all()
+    return results
+
+def results_to_json(results:List[ScenarioResult]) -> List[Dict[str, Any]]:
+    summary = list()
+    for result in results:
+        entry = asdict(result)
+        for stage, stage_result in zip(entry['stages'], result.stages):
+            stage['rows_per_second'] = stage_result.rows_per_second
+            stage['mb_per_second'] = stage_result.mb_per_second
+        summary.append(entry)
+    return summary
+
+def format_results(results:List[ScenarioResult]) -> str:
+    """Formats the results as a text table"""
+    lines = [f"{'layout':<16}{'engine':<8}{'format':<9}{'stage':<10}{'seconds':>9}{'rows/s':>12}{'MB/s':>9}{'peak RSS MB':>13}"]
+    for result in results:
+        prefix = f"{result.layout:<16}{result.engine:<8}{result.file_format:<9}"
+        if result.error:
+            lines.append(f"{prefix}failed: {result.error}")
+            continue
+        for stage in result.stages:
+            lines.append(f"{prefix}{stage.stage:<10}{stage.seconds:>9.3f}{stage.rows_per_second:>12.0f}"
+                f"{stage.mb_per_second:>9.1f}{stage.peak_rss_mb:>13.1f}")
+    return '\n'.join(lines)
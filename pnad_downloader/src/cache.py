@@ -0,0 +1,275 @@
+from functools import partial
+import ftplib
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from src import PnadDict, PnadInputInfo
+from src.ftp import PROGRESS_SUFFIX, Retriever, remote_stat, retrieve_file
+
+CacheEntry = Dict[str, Any]
+
+# Serializes the index read-modify-write cycles of the threads in this process
+_INDEX_LOCK = threading.RLock()
+
+# One lock per cached file, so threads fetching the same file download it once
+_FETCH_LOCKS: Dict[Tuple[str, str, str], threading.Lock] = dict()
+_FETCH_LOCKS_LOCK = threading.Lock()
+
+class CacheMiss(Exception):
+    """Exception to be raised when a file is not cached and no FTP connection is available"""
+    pass
+
+class FtpCache:
+    """A persistent local cache of files retrieved from the FTP server
+
+    Files are stored under a name derived from the FTP path and file name, checked
+    against the server SIZE and MDTM before reuse and evicted in least recently used
+    order once the cache grows above its byte budget.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, path:str, max_bytes:int, revalidate_after:int = 0):
+        """Initiates the FtpCache object
+
+        Args:
+            path (str): the directory to store the cached files
+            max_bytes (int): the maximum size of the cache in bytes
+            revalidate_after (int): seconds during which a cached file is used without
+            asking the server. Negative values never revalidate (offline mode)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(abspath:str, filename:str) -> str:
+        """Returns the cache key of a remote file"""
+        return hashlib.sha256(f"{abspath.rstrip('/')}/{filename}".encode("utf-8")).hexdigest()
+
+    def entry_path(self, key:str) -> str:
+        return os.path.join(self.path, key)
+
+    def _read_index(self) -> Dict[str, CacheEntry]:
+        try:
+            with open(os.path.join(self.path, self.INDEX_FILE), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+
+    def _write_index(self, index:Dict[str, CacheEntry]) -> None:
+        # Replace atomically so concurrent runs never read a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, self.INDEX_FILE))
+
+    def lookup(self, abspath:str, file_re:str) -> Optional[str]:
+        """Returns the cached file matching the regex without asking the server,
+        if it is still within the revalidation window
+
+        Args:
+            abspath (str): absolute path to file directory in the FTP server
+            file_re (str): regex to match with the file name
+
+        Returns:
+            Optional[str]: the path to the local file or None
+        """
+        with _INDEX_LOCK:
+            index = self._read_index()
+            key = self._fresh_key(index, abspath, file_re)
+            if key is None:
+                return None
+            index[key]['atime'] = time.time()
+            self._write_index(index)
+            logging.debug(f"Cache hit for {abspath}{index[key]['name']}")
+            return self.entry_path(key)
+
+    def _fresh_key(self, index:Dict[str, CacheEntry], abspath:str, file_re:str) -> Optional[str]:
+        """Returns the key of the cached file matching the regex, if it is within the revalidation window"""
+        match = partial(re.match, file_re)
+        for key, entry in index.items():
+            if entry['abspath'] != abspath or not match(entry['name']):
+                continue
+            if not os.path.isfile(self.entry_path(key)):
+                continue
+            age = time.time() - entry['validated']
+            if self.revalidate_after < 0 or age <= self.revalidate_after:
+                return key
+        return None
+
+    def lookup_entry(self, abspath:str, file_re:str) -> Optional[CacheEntry]:
+        """Returns the index entry, with the remote name, size and MDTM, of the cached
+        file matching the regex, if it is within the revalidation window"""
+        with _INDEX_LOCK:
+            index = self._read_index()
+            key = self._fresh_key(index, abspath, file_re)
+            return index[key] if key is not None else None
+
+    def expire(self, abspath:str, file_re:str) -> None:
+        """Makes the cached files matching the regex be checked against the server
+        on their next use, even within the revalidation window"""
+        match = partial(re.match, file_re)
+        with _INDEX_LOCK:
+            index = self._read_index()
+            expired = [entry for entry in index.values() if entry['abspath'] == abspath and match(entry['name'])]
+            if not expired:
+                return
+            for entry in expired:
+                entry['validated'] = 0
+            self._write_index(index)
+
+    def remove(self, abspath:str, file_re:str) -> None:
+        """Removes the cached files matching the regex, e.g. after they were found to be corrupted"""
+        match = partial(re.match, file_re)
+        with _INDEX_LOCK:
+            index = self._read_index()
+            removed = [key for key, entry in index.items() if entry['abspath'] == abspath and match(entry['name'])]
+            if not removed:
+                return
+            for key in removed:
+                logging.debug(f"Removing {abspath}{index[key]['name']} from cache")
+                try:
+                    os.remove(self.entry_path(key))
+                except FileNotFoundError:
+                    pass
+                del index[key]
+            self._write_index(index)
+
+    def fetch(self, abspath:str, file_re:str, ftp:Optional[ftplib.FTP], retrieve:Retriever = retrieve_file) -> str:
+        """Returns a local copy of the remote file, downloading it only when
+        it is missing from the cache or has changed on the server
+
+        Threads fetching the same file wait for each other, so it is downloaded once.
+
+        Args:
+            abspath (str): absolute path to file directory in the FTP server
+            file_re (str): regex to match with the file name
+            ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server
+            retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
+
+        Raises:
+            CacheMiss: the file is not cached and no connection was given
+
+        Returns:
+            str: the path to the local file
+        """
+        with self._fetch_lock(abspath, file_re):
+            return self._fetch(abspath, file_re, ftp, retrieve)
+
+    def _fetch_lock(self, abspath:str, file_re:str) -> threading.Lock:
+        key = (self.path, abspath, file_re)
+        with _FETCH_LOCKS_LOCK:
+            lock = _FETCH_LOCKS.get(key)
+            if lock is None:
+                lock = _FETCH_LOCKS[key] = threading.Lock()
+            return lock
+
+    def _fetch(self, abspath:str, file_re:str, ftp:Optional[ftplib.FTP], retrieve:Retriever) -> str:
+        cached = self.lookup(abspath, file_re)
+        if cached:
+            return cached
+        if ftp is None:
+            raise CacheMiss(f"{abspath}{file_re} is not cached")
+
+        ftp.cwd(abspath)
+        match = partial(re.match, file_re)
+        filename = next(filter(match, ftp.nlst()), None)
+        if filename is None:
+            raise FileNotFoundError(f"No file matching {file_re} in {abspath}")
+        size, mdtm = remote_stat(ftp, filename)
+        key = self.key(abspath, filename)
+        local_path = self.entry_path(key)
+
+        index = self._read_index()
+        entry = index.get(key)
+        if (entry and os.path.isfile(local_path) and size is not None
+                and entry['size'] == size and entry['mdtm'] == mdtm):
+            logging.debug(f"Cache revalidated for {abspath}{filename}")
+        else:
+            logging.debug(f"Cache miss for {abspath}{filename}, downloading")
+            # A unique partial name, so other processes downloading the same file do not write over it
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".part")
+            os.close(fd)
+            try:
+                retrieve(ftp, abspath, filename, tmp_path)
+                os.replace(tmp_path, local_path)
+            finally:
+                # A failed segmented download may have left the partial file and its progress
+                for path in (tmp_path, tmp_path + PROGRESS_SUFFIX):
+                    if os.path.isfile(path):
+                        os.remove(path)
+            size = os.path.getsize(local_path)
+
+        with _INDEX_LOCK:
+            # Re-read: other threads or processes may have changed the index meanwhile
+            index = self._read_index()
+            now = time.time()
+            index[key] = {'abspath': abspath, 'name': filename, 'size': size,
+                          'mdtm': mdtm, 'validated': now, 'atime': now}
+            self.evict(index, keep=key)
+            self._write_index(index)
+        return local_path
+
+    def evict(self, index:Dict[str, CacheEntry], keep:str = '') -> None:
+        """Removes least recently used files until the cache fits its byte budget
+
+        Args:
+            index (Dict[str, CacheEntry]): the cache index, modified inplace
+            keep (str): a key that must not be evicted
+        """
+        total = sum(entry['size'] or 0 for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['atime']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logging.debug(f"Evicting {index[key]['abspath']}{index[key]['name']} from cache")
+            total -= index[key]['size'] or 0
+            try:
+                os.remove(self.entry_path(key))
+            except FileNotFoundError:
+                pass
+            del index[key]
+
+class MetadataCache:
+    """A local cache of the parsed input file information and dictionary
+
+    Entries are keyed by the identity (path, name, size and MDTM) of the remote
+    files they were parsed from, so a changed file on the server is parsed again.
+    """
+
+    # Bump when the parsing of the input file or dictionary changes
+    VERSION = 1
+
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    @classmethod
+    def key(cls, identities:Iterable[str]) -> str:
+        """Returns the key of the metadata parsed from the remote files with these identities"""
+        return hashlib.sha256('\n'.join([f"v{cls.VERSION}", *identities]).encode("utf-8")).hexdigest()
+
+    def load(self, key:str) -> Optional[Tuple[PnadInputInfo, PnadDict]]:
+        try:
+            with open(os.path.join(self.path, f"{key}.json"), 'r', encoding="utf-8") as f:
+                metadata = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        logging.debug(f"Metadata cache hit for {key}")
+        return PnadInputInfo([tuple(info) for info in metadata['input_info']]), PnadDict(metadata['pnad_dict'])
+
+    def save(self, key:str, input_info:PnadInputInfo, pnad_dict:PnadDict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            json.dump({'input_info': input_info, 'pnad_dict': pnad_dict}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, os.path.join(self.path, f"{key}.json"))
@@ -0,0 +1,161 @@
+from typing import Any, Dict, Generator, Iterable, List, Sequence, Set
+
+import numpy as np
+
+from src import PnadDict, PnadInputInfo, Row
+
+Columns = Dict[str, np.ndarray]
+
+NUMERIC_UFUNCS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+def line_length(buffer:Any) -> int:
+    """Returns the length of a line of the file, including the line terminator
+
+    Args:
+        buffer (Any): the raw file as bytes, mmap or other buffer
+    """
+    newline = memoryview(buffer)[:64 * 1024].tobytes().find(b'\n')
+    if newline < 0:
+        return len(buffer)
+    return newline + 1
+
+def dtype_from_input(input_info:PnadInputInfo, itemsize:int) -> np.dtype:
+    """Builds a structured dtype with a byte string field for each variable,
+    placed at the '@' position from the input file
+
+    Args:
+        input_info (PnadInputInfo): the input file information
+        itemsize (int): the length of a line, including the line terminator
+
+    Returns:
+        np.dtype: the dtype of a single line of the file
+    """
+    return np.dtype({
+        'names': [info[1] for info in input_info],
+        'formats': [f'S{info[2]}' for info in input_info],
+        'offsets': [int(info[0].strip('@')) - 1 for info in input_info],
+        'itemsize': itemsize
+    })
+
+def parse_buffer(buffer:Any, input_info:PnadInputInfo) -> np.ndarray:
+    """Maps the raw fixed width file to a structured array without copying it
+
+    Args:
+        buffer (Any): the raw file as bytes, mmap or other buffer
+        input_info (PnadInputInfo): the input file information
+
+    Returns:
+        np.ndarray: a structured array with a row per line
+    """
+    itemsize = line_length(buffer)
+    dtype = dtype_from_input(input_info, itemsize)
+    count, remainder = divmod(len(buffer), itemsize)
+    data = np.frombuffer(buffer, dtype=dtype, count=count)
+    if remainder:
+        # Last line without terminator: pad it and append
+        last = memoryview(buffer)[count * itemsize:].tobytes().ljust(itemsize, b'\n')
+        data = np.concatenate([data, np.frombuffer(last, dtype=dtype)])
+    return data
+
+def numeric_vars_from_dict(pnad_dict:PnadDict, identifiers:Iterable[str]) -> Set[str]:
+    """Returns the variables with no coded categories in the dictionary,
+    apart from the identifiers, which hold measures such as age, income or weights"""
+    identifiers = set(identifiers)
+    return {var for var, codes in pnad_dict.items()
+        if var not in identifiers and all(not code.strip() for code in codes)}
+
+def to_numeric(column:np.ndarray) -> np.ndarray:
+    """Converts a byte string column to floats, blanks and '.' becoming NaN
+
+    Raises:
+        ValueError: the column has non numeric values
+    """
+    stripped = np.char.strip(column, b' .')
+    return np.where(stripped == b'', b'nan', stripped).astype(np.float64)
+
+def float_or_nan(raw:bytes) -> float:
+    try:
+        return float(raw)
+    except ValueError:
+        return float('nan')
+
+def to_numeric_or_nan(column:np.ndarray) -> np.ndarray:
+    """Converts a byte string column like to_numeric, with the values that are not numbers as NaN"""
+    try:
+        return to_numeric(column)
+    except ValueError:
+        return np.array([float_or_nan(value) for value in column.tolist()], dtype=np.float64)
+
+def to_columns(data:np.ndarray, numeric_vars:Iterable[str] = ()) -> Columns:
+    """Splits the structured array in columns, converting the numeric variables in bulk
+
+    Args:
+        data (np.ndarray): the parsed structured array
+        numeric_vars (Iterable[str]): variables to convert to floats
+
+    Returns:
+        Columns: a column per variable, as raw byte strings or floats
+    """
+    numeric_vars = set(numeric_vars)
+    columns: Columns = dict()
+    for var in data.dtype.names:
+        columns[var] = data[var]
+        if var in numeric_vars:
+            try:
+                columns[var] = to_numeric(data[var])
+            except ValueError:
+                pass # Not really numeric, keep the raw values
+    return columns
+
+def translate_column(column:np.ndarray, codes:Dict[str, str], translate:bool = True) -> np.ndarray:
+    """Decodes a raw column, translating the codes once per distinct value.
+    Follows the same rules as PnadReader.translate_record
+
+    Args:
+        column (np.ndarray): a raw byte string column
+        codes (Dict[str, str]): the codes and descriptions of the variable
+        translate (bool): whether to translate or only decode and strip the values
+
+    Returns:
+        np.ndarray: an object array with the decoded values
+    """
+    uniques, inverse = np.unique(column, return_inverse=True)
+    values: List[str] = list()
+    for raw in uniques:
+        value = raw.decode('ISO-8859-1').ljust(column.dtype.itemsize)
+        if translate:
+            values.append(codes.get(value.replace('.', ' '), value.strip(' .')))
+        else:
+            values.append(value.strip(' .'))
+    return np.array(values, dtype=object)[inverse]
+
+def conditions_mask(data:np.ndarray, conditions:Sequence[Any]) -> np.ndarray:
+    """Evaluates filter conditions on a structured array with a field per condition, in order
+
+    Args:
+        data (np.ndarray): the raw spans of the conditions, from parse_buffer
+        conditions (Sequence[Any]): the filters.Condition objects
+
+    Returns:
+        np.ndarray: True for the rows matching all conditions
+    """
+    mask = np.ones(len(data), dtype=bool)
+    for name, condition in zip(data.dtype.names, conditions):
+        field = data[name]
+        if condition.codes:
+            matched = np.isin(field, np.array(condition.codes, dtype=field.dtype))
+            mask &= matched if condition.op in ('=', 'in') else ~matched
+        else:
+            # Values that are not numbers never match, like in Condition
+            values = to_numeric_or_nan(field)
+            with np.errstate(invalid='ignore'):
+                mask &= NUMERIC_UFUNCS[condition.op](values, condition.number)
+    return mask
+
+def columns_to_rows(columns:Columns, chunk_size:int) -> Generator[Row, None, None]:
+    """Yields the columns as tuples in column order, building Python objects one chunk at a time"""
+    names = list(columns)
+    rows = len(columns[names[0]]) if names else 0
+    for start in range(0, rows, chunk_size):
+        chunk = [columns[name][start:start + chunk_size].tolist() for name in names]
+        yield from zip(*chunk)
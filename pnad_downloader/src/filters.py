@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+import operator
+import re
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from src import PnadDict, PnadInputInfo
+from src.utils import ASCII_CHARS, lpad
+
+# Operators compared as numbers, the others compare the raw codes
+NUMERIC_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+FILTER_RE = re.compile(r"^\s*(\w+)\s*(>=|<=|!=|==|=|<|>|\s+not\s+in\s+|\s+in\s+)\s*(.+?)\s*$", re.IGNORECASE)
+
+class InvalidFilter(Exception):
+    """Exception to be raised when a filter expression can not be compiled"""
+    pass
+
+@dataclass
+class Condition:
+    """A filter compiled to the byte span of its variable in each line
+
+    For '=', '!=', 'in' and 'not in', codes holds the raw values to compare with
+    the span, for the other operators number holds the value to compare with.
+    """
+
+    var: str
+    start: int
+    end: int
+    op: str
+    codes: Tuple[bytes, ...] = ()
+    number: float = 0.0
+
+    def __call__(self, line:bytes) -> bool:
+        field = line[self.start:self.end]
+        if self.op in NUMERIC_OPERATORS:
+            try:
+                return NUMERIC_OPERATORS[self.op](float(field), self.number)
+            except ValueError:
+                return False # Blanks do not match
+        return (field in self.codes) == (self.op in ('=', 'in'))
+
+def split_values(text:str) -> List[str]:
+    """Splits the values of a filter, like '35', 'Capital in (11, 35)' or "UF='Sao Paulo'" """
+    text = text.strip()
+    if text.startswith('(') and text.endswith(')'):
+        text = text[1:-1]
+    return [value.strip().strip('\'"') for value in text.split(',') if value.strip()]
+
+def code_from_value(value:str, width:int, codes:Dict[str, str]) -> bytes:
+    """Returns the raw code of a filter value: numbers are zero padded like the
+    dictionary codes and labels are looked up in the dictionary"""
+    if value.isdigit():
+        return lpad(value, width, '0').encode('ISO-8859-1')
+    folded = value.lower().translate(ASCII_CHARS)
+    for code, label in codes.items():
+        if label.lower().translate(ASCII_CHARS) == folded:
+            return code.encode('ISO-8859-1')
+    return value.ljust(width).encode('ISO-8859-1')
+
+def compile_filter(text:str, input_info:PnadInputInfo, pnad_dict:PnadDict) -> Condition:
+    """Compiles a filter expression like 'UF=35', 'V2009>=18' or 'Capital in (11, 35)'
+
+    Args:
+        text (str): the filter expression
+        input_info (PnadInputInfo): the input file information, with the variable positions
+        pnad_dict (PnadDict): the pnad dictionary, to accept labels as values
+
+    Raises:
+        InvalidFilter: the expression is malformed or its variable is not in the file
+
+    Returns:
+        Condition: the compiled filter
+    """
+    match = FILTER_RE.match(text)
+    if match is None:
+        raise InvalidFilter(f"Could not parse filter {text!r}")
+    var, op, values = match.group(1), ' '.join(match.group(2).lower().split()), split_values(match.group(3))
+    info = next((info for info in input_info if info[1] == var), None)
+    if info is None:
+        raise InvalidFilter(f"Could not found variable {var} of filter {text!r} on input file info")
+    if not values or (op not in ('in', 'not in') and len(values) > 1):
+        raise InvalidFilter(f"Wrong number of values in filter {text!r}")
+    start = int(info[0].strip('@')) - 1
+    end = start + info[2]
+    if op in NUMERIC_OPERATORS:
+        try:
+            return Condition(var, start, end, op, number=float(values[0]))
+        except ValueError:
+            raise InvalidFilter(f"Filter {text!r} must compare with a number")
+    op = {'==': '=', '!=': 'not in'}.get(op, op)
+    codes = tuple(code_from_value(value, info[2], pnad_dict.get(var, dict())) for value in values)
+    return Condition(var, start, end, op, codes=codes)
+
+class RowFilter:
+    """Checks the raw lines of the file against all its conditions, before they are decoded or parsed"""
+
+    def __init__(self, conditions:Sequence[Condition]):
+        self.conditions = list(conditions)
+
+    @classmethod
+    def from_expressions(cls, expressions:Sequence[str], input_info:PnadInputInfo, pnad_dict:PnadDict) -> "RowFilter":
+        return cls([compile_filter(text, input_info, pnad_dict) for text in expressions])
+
+    def __call__(self, line:bytes) -> bool:
+        for condition in self.conditions:
+            if not condition(line):
+                return False
+        return True
+
+    def mask(self, buffer:Any) -> Any:
+        """Returns a NumPy boolean mask with the lines of the raw file that match all conditions
+
+        Args:
+            buffer (Any): the raw fixed width file, e.g. the memory map from open_pnad
+        """
+        from src import columnar
+        filter_info = PnadInputInfo([(f"@{c.start + 1}", f"_{i}", c.end - c.start, c.var)
+            for i, c in enumerate(self.conditions)])
+        data = columnar.parse_buffer(buffer, filter_info)
+        return columnar.conditions_mask(data, self.conditions)
@@ -0,0 +1,453 @@
+from contextlib import contextmanager
+import ftplib
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Any, Callable, Generator, List, Optional, Tuple, TypeVar
+import zipfile
+import zlib
+
+T = TypeVar('T')
+
+# Downloads a remote file: (ftp, abspath, filename, local_path)
+Retriever = Callable[[ftplib.FTP, str, str, str], None]
+
+class DownloadVerificationError(Exception):
+    """Exception to be raised when a downloaded file does not match the remote one"""
+    pass
+
+# Appended to the path of a segmented download for the file with its progress
+PROGRESS_SUFFIX = ".progress"
+
+# Errors after which a connection is dropped and the operation retried on a new one
+TRANSIENT_ERRORS = (ftplib.error_temp, ftplib.error_reply, ConnectionError, TimeoutError, socket.gaierror, EOFError,
+    DownloadVerificationError)
+
+class FtpPool:
+    """A pool of logged in FTP connections to one host
+
+    Idle connections are kept alive and checked with NOOP before reuse, broken ones are
+    replaced, and no more than max_sessions connections are open at the same time.
+    """
+
+    def __init__(self, connect:Callable[[], ftplib.FTP], max_sessions:int = 4, retries:int = 3):
+        """Initiates the FtpPool object
+
+        Args:
+            connect (Callable[[], ftplib.FTP]): creates a new logged in connection
+            max_sessions (int): the maximum number of open connections
+            retries (int): how many times an operation is retried on a new connection
+        """
+        self.connect = connect
+        self.max_sessions = max_sessions
+        self.retries = retries
+        self.idle: List[ftplib.FTP] = list()
+        self.lock = threading.Lock()
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+
+    def _take(self) -> ftplib.FTP:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                ftp = self.idle.pop()
+            try:
+                ftp.voidcmd("NOOP")
+                return ftp
+            except ftplib.all_errors:
+                self._discard(ftp)
+        return self.connect()
+
+    @staticmethod
+    def _discard(ftp:ftplib.FTP) -> None:
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    @contextmanager
+    def connection(self) -> Generator[ftplib.FTP, None, None]:
+        """Yields a connection from the pool, waiting if max_sessions are in use.
+        The connection goes back to the pool unless an error happened while it was used"""
+        with self.sessions:
+            ftp = self._take()
+            try:
+                yield ftp
+            except BaseException:
+                self._discard(ftp)
+                raise
+            with self.lock:
+                self.idle.append(ftp)
+
+    def run(self, func:Callable[[ftplib.FTP], T]) -> T:
+        """Runs func with a pooled connection, retrying on a new connection
+        when the server or the network fails
+
+        Args:
+            func (Callable[[ftplib.FTP], T]): the operation to run
+
+        Returns:
+            T: what func returns
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as ftp:
+                    return func(ftp)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"FTP operation failed ({e!r}), reconnecting")
+                time.sleep(min(2 ** attempt, 30))
+
+    def close(self) -> None:
+        """Closes all the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, list()
+        for ftp in idle:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                self._discard(ftp)
+
+def remote_stat(ftp:ftplib.FTP, filename:str) -> Tuple[Optional[int], Optional[str]]:
+    """Returns the size and modification time of a remote file
+
+    Args:
+        ftp (ftplib.FTP): a FTP object with the connection to the FTP server
+        filename (str): the file name in the current FTP directory
+
+    Returns:
+        Tuple[Optional[int], Optional[str]]: the size in bytes and the MDTM timestamp,
+        None for the ones the server does not support
+    """
+    size = mdtm = None
+    try:
+        ftp.voidcmd("TYPE I")
+        size = ftp.size(filename)
+    except ftplib.error_perm:
+        pass
+    try:
+        mdtm = ftp.voidcmd(f"MDTM {filename}").split()[-1]
+    except ftplib.error_perm:
+        pass
+    return size, mdtm
+
+def file_identity(abspath:str, filename:str, size:Optional[int], mdtm:Optional[str]) -> str:
+    """Returns the path, name, size and modification time of a remote file, which change with its contents"""
+    return f"{abspath.rstrip('/')}/{filename}:{size}:{mdtm}"
+
+def retrieve_file(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+    """Downloads a file from the current FTP directory with a single RETR
+
+    Args:
+        ftp (ftplib.FTP): a FTP object with the connection to the FTP server
+        abspath (str): absolute path to file directory in the FTP server
+        filename (str): the file name
+        local_path (str): the path to save the file
+    """
+    with open(local_path, 'wb') as f:
+        ftp.retrbinary(f"RETR {filename}", f.write)
+
+def verify_download(local_path:str, size:Optional[int]) -> None:
+    """Checks a downloaded file against the FTP SIZE and, for zip files, the CRC of its members
+
+    Raises:
+        DownloadVerificationError: the file is incomplete or corrupted
+    """
+    local_size = os.path.getsize(local_path)
+    if size is not None and local_size != size:
+        raise DownloadVerificationError(f"{local_path} has {local_size} bytes, expected {size}")
+    if zipfile.is_zipfile(local_path):
+        try:
+            with zipfile.ZipFile(local_path) as zipped_file:
+                bad_file = zipped_file.testzip()
+        except (zipfile.BadZipFile, zlib.error) as e:
+            raise DownloadVerificationError(f"{local_path} is corrupted: {e}") from e
+        if bad_file is not None:
+            raise DownloadVerificationError(f"CRC check failed for {bad_file} in {local_path}")
+
+class SegmentedDownload:
+    """Downloads a file in byte ranges over parallel connections, using REST offsets
+
+    Each range is retried on a new connection from where it stopped, and the progress is
+    kept in a file next to the download, so an interrupted download resumes in the next run.
+    The calling thread downloads ranges on its own pooled connection and each extra thread
+    on a connection it opens while holding a session of the pool, so no more than
+    max_sessions connections are open. A connection takes its next range once the server
+    answered the RETR stopped at the end of the previous one, and is replaced when a
+    range fails, as a RETR that failed halfway leaves it in an unknown state.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    # Bytes downloaded by a range between saves of the progress file
+    SAVE_EVERY = 16 * 1024 * 1024
+
+    def __init__(self, pool:FtpPool, abspath:str, filename:str, local_path:str,
+        size:int, mdtm:Optional[str], segments:int):
+        """Initiates the SegmentedDownload object
+
+        Args:
+            pool (FtpPool): the pool to create connections and limit the sessions
+            abspath (str): absolute path to file directory in the FTP server
+            filename (str): the file name
+            local_path (str): the path to save the file
+            size (int): the remote file size
+            mdtm (Optional[str]): the remote modification time, to validate the progress file
+            segments (int): the number of byte ranges
+        """
+        self.pool = pool
+        self.abspath = abspath
+        self.filename = filename
+        self.local_path = local_path
+        self.progress_path = local_path + PROGRESS_SUFFIX
+        self.size = size
+        self.mdtm = mdtm
+        self.lock = threading.Lock()
+        self.ranges = self._load_progress() or self._split(segments)
+        self.pending: queue.Queue = queue.Queue()
+        for byte_range in self.ranges:
+            if byte_range[2] < byte_range[1]:
+                self.pending.put(byte_range)
+        self.errors: List[BaseException] = list()
+
+    def _split(self, segments:int) -> List[List[int]]:
+        step = -(-self.size // segments)
+        return [[start, min(start + step, self.size), start] for start in range(0, self.size, step)]
+
+    def _load_progress(self) -> Optional[List[List[int]]]:
+        if not os.path.isfile(self.local_path):
+            return None
+        try:
+            with open(self.progress_path, 'r') as f:
+                progress = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if progress['size'] != self.size or progress['mdtm'] != self.mdtm:
+            return None
+        logging.info(f"Resuming download of {self.filename}")
+        return progress['ranges']
+
+    def _save_progress(self) -> None:
+        with self.lock:
+            with open(self.progress_path, 'w') as f:
+                json.dump({'size': self.size, 'mdtm': self.mdtm, 'ranges': self.ranges}, f)
+
+    def _connect(self) -> ftplib.FTP:
+        ftp = self.pool.connect()
+        ftp.cwd(self.abspath)
+        ftp.voidcmd("TYPE I")
+        return ftp
+
+    def _fetch_range(self, fd:int, byte_range:List[int], ftp:ftplib.FTP) -> None:
+        """Downloads what is missing of a range, leaving the connection ready for the next one"""
+        with ftp.transfercmd(f"RETR {self.filename}", rest=byte_range[2]) as conn:
+            unsaved = 0
+            while byte_range[2] < byte_range[1]:
+                data = conn.recv(min(self.CHUNK_SIZE, byte_range[1] - byte_range[2]))
+                if not data:
+                    raise EOFError(f"Connection closed at byte {byte_range[2]} of {self.filename}")
+                os.pwrite(fd, data, byte_range[2])
+                byte_range[2] += len(data)
+                unsaved += len(data)
+                if unsaved >= self.SAVE_EVERY:
+                    self._save_progress()
+                    unsaved = 0
+        try:
+            ftp.voidresp()
+        except ftplib.error_temp:
+            pass # 426, the transfer was stopped before the end of the file
+
+    def _download_range(self, fd:int, byte_range:List[int], ftp:Optional[ftplib.FTP]) -> ftplib.FTP:
+        """Downloads a range, on a new connection if ftp is None and after each failure
+
+        Returns:
+            ftplib.FTP: the connection that downloaded the range, still open
+        """
+        for attempt in range(self.pool.retries + 1):
+            try:
+                if ftp is None:
+                    ftp = self._connect()
+                self._fetch_range(fd, byte_range, ftp)
+                return ftp
+            except TRANSIENT_ERRORS as e:
+                self._save_progress()
+                if ftp is not None:
+                    FtpPool._discard(ftp)
+                    ftp = None
+                if attempt == self.pool.retries:
+                    raise
+                logging.warning(f"Range {byte_range[0]}-{byte_range[1]} of {self.filename} failed at "
+                    f"byte {byte_range[2]} ({e!r}), resuming")
+                time.sleep(min(2 ** attempt, 30))
+            except BaseException:
+                if ftp is not None:
+                    FtpPool._discard(ftp)
+                raise
+
+    def _work(self, fd:int, ftp:Optional[ftplib.FTP] = None) -> Optional[ftplib.FTP]:
+        """Downloads pending ranges until none is left, on ftp or on a new connection
+
+        Returns:
+            Optional[ftplib.FTP]: the connection still open, None if it was closed after an error
+        """
+        while not self.errors:
+            try:
+                byte_range = self.pending.get_nowait()
+            except queue.Empty:
+                return ftp
+            try:
+                ftp = self._download_range(fd, byte_range, ftp)
+            except BaseException as e:
+                self.errors.append(e)
+                return None
+        return ftp
+
+    def _extra_worker(self, fd:int) -> None:
+        # Extra workers only run while a session is free, never blocking the caller
+        while not self.pending.empty() and not self.errors:
+            if self.pool.sessions.acquire(timeout=1):
+                try:
+                    ftp = self._work(fd)
+                    if ftp is not None:
+                        FtpPool._discard(ftp)
+                finally:
+                    self.pool.sessions.release()
+
+    def run(self, ftp:ftplib.FTP) -> None:
+        """Downloads the missing ranges, from the calling thread, which must already hold
+        a session of the pool, and from extra threads as other sessions become free
+
+        Args:
+            ftp (ftplib.FTP): the connection of the session of the calling thread, in the
+            directory of the file. It is closed if a range fails on it, and replaced by
+            another one, closed at the end
+
+        Raises:
+            DownloadVerificationError: the file is incomplete or corrupted
+        """
+        mode = 'r+b' if os.path.isfile(self.local_path) else 'wb'
+        with open(self.local_path, mode) as f:
+            f.truncate(self.size)
+            fd = f.fileno()
+            extra = [threading.Thread(target=self._extra_worker, args=(fd,), daemon=True)
+                for _ in range(min(len(self.ranges), self.pool.max_sessions) - 1)]
+            for thread in extra:
+                thread.start()
+            ftp.voidcmd("TYPE I")
+            own = self._work(fd, ftp)
+            if own is not None and own is not ftp:
+                FtpPool._discard(own)
+            for thread in extra:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+        try:
+            verify_download(self.local_path, self.size)
+        except DownloadVerificationError:
+            # Start over in the next attempt
+            os.remove(self.local_path)
+            if os.path.isfile(self.progress_path):
+                os.remove(self.progress_path)
+            raise
+        if os.path.isfile(self.progress_path):
+            os.remove(self.progress_path)
+
+class StreamingDownload:
+    """Downloads a file with RETR and hands its bytes to a callback as they arrive,
+    e.g. to the next stage of a pipeline, instead of only once the file is complete
+
+    The bytes are handed in chunks of CHUNK_SIZE, in file order and once each: when
+    the pool retries a download that failed halfway, it continues with REST after the
+    bytes already handed. An instance is also a Retriever, saving the file while streaming it.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    # Bytes asked to the data connection at a time
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, consume:Callable[[bytes], None]):
+        """Initiates the StreamingDownload object
+
+        Args:
+            consume (Callable[[bytes], None]): takes each chunk, may block to slow down the download
+        """
+        self.consume = consume
+        self.received = 0
+        self.pending: List[bytes] = list()
+        self.pending_size = 0
+
+    def _accept(self, data:bytes, position:int) -> None:
+        """Takes the bytes of a RETR that start at position, dropping the ones already received"""
+        skip = self.received - position
+        if skip >= len(data):
+            return
+        if skip > 0:
+            data = data[skip:]
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.received += len(data)
+        if self.pending_size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hands the bytes received and not handed yet"""
+        if self.pending:
+            chunk = b''.join(self.pending)
+            self.pending, self.pending_size = list(), 0
+            self.consume(chunk)
+
+    def _retrieve(self, ftp:ftplib.FTP, filename:str, write:Optional[Callable[[bytes], Any]] = None,
+        rest:int = 0) -> None:
+        position = rest
+        def callback(data:bytes) -> None:
+            nonlocal position
+            if write is not None:
+                write(data)
+            self._accept(data, position)
+            position += len(data)
+        ftp.retrbinary(f"RETR {filename}", callback, self.BLOCK_SIZE, rest or None)
+        self.flush()
+
+    def stream(self, ftp:ftplib.FTP, filename:str) -> None:
+        """Streams a file from the current FTP directory, resuming with REST after the bytes already received"""
+        self._retrieve(ftp, filename, rest=self.received)
+
+    def stream_local(self, path:str) -> None:
+        """Streams a file that is already on disk, e.g. revalidated in the cache"""
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                self._accept(data, self.received)
+        self.flush()
+
+    def __call__(self, ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+        """Saves the file to local_path like retrieve_file while streaming it. When
+        retried, the file is resumed with REST after the bytes already handed"""
+        if self.received and os.path.isfile(local_path):
+            with open(local_path, 'r+b') as f:
+                f.truncate(self.received)
+                f.seek(self.received)
+                self._retrieve(ftp, filename, f.write, self.received)
+            return
+        with open(local_path, 'wb') as f:
+            self._retrieve(ftp, filename, f.write)
+
+def is_segmented(size:Optional[int], segments:int, min_size:int) -> bool:
+    """Whether a file of size bytes is downloaded in byte ranges by segmented_retriever"""
+    return segments > 1 and size is not None and size >= min_size
+
+def segmented_retriever(pool:FtpPool, segments:int, min_size:int) -> Retriever:
+    """Returns a function to download files in byte ranges, with the same
+    arguments as retrieve_file. Files smaller than min_size, or from servers
+    without SIZE support, are downloaded with a single RETR"""
+    def retrieve(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+        size, mdtm = remote_stat(ftp, filename)
+        if not is_segmented(size, segments, min_size):
+            retrieve_file(ftp, abspath, filename, local_path)
+            return
+        logging.debug(f"Downloading {filename} in {segments} ranges")
+        SegmentedDownload(pool, abspath, filename, local_path, size, mdtm, segments).run(ftp)
+    return retrieve
@@ -0,0 +1,204 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import io
+from itertools import repeat
+import json
+import logging
+import resource
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, Iterator, Optional, TypeVar
+
+if TYPE_CHECKING:
+    import cProfile
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Marks the end of the iterator timed by Profiler.iterate
+_END = object()
+
+@dataclass
+class StageMetrics:
+    """What a stage accumulated over all its calls. Times are exclusive
+    of the other stages, except for the ones that wrap a whole step"""
+
+    wall: float = 0.0
+    cpu: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    peak_rss_mb: float = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        d = asdict(self)
+        d['rows_per_second'] = self.rows / self.wall if self.wall else 0.0
+        d['mb_per_second'] = self.bytes / (1024 * 1024) / self.wall if self.wall else 0.0
+        return d
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident memory of this process, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Profiler:
+    """Collects wall and CPU time, rows, bytes and peak memory per stage
+
+    Disabled by default: map and iterate then return the plain iterators and
+    stage does nothing, so the instrumented code runs at full speed. One stage
+    may also be run under cProfile, only in the thread that enabled the profiler:
+    the pipeline threads (ftp and decompress) are timed but not profiled, as a
+    cProfile.Profile only follows the thread it is enabled in.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages: Dict[str, StageMetrics] = dict()
+        self.lock = threading.Lock()
+        self.cprofile_stage: Optional[str] = None
+        self.cprofile: Optional["cProfile.Profile"] = None
+        self.cprofile_thread: Optional[int] = None
+        self.started = (0.0, 0.0)
+
+    def enable(self, cprofile_stage:Optional[str] = None) -> None:
+        """Starts collecting metrics
+
+        Args:
+            cprofile_stage (Optional[str]): a stage to run under cProfile, in the calling thread
+        """
+        import cProfile
+        self.enabled = True
+        self.stages = dict()
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = cProfile.Profile() if cprofile_stage else None
+        self.cprofile_thread = threading.get_ident()
+        self.started = (time.perf_counter(), time.process_time())
+
+    def _profile_for(self, name:str) -> Optional["cProfile.Profile"]:
+        """Returns the cProfile of a stage, only when it runs in the thread that enabled the profiler"""
+        if name != self.cprofile_stage or threading.get_ident() != self.cprofile_thread:
+            return None
+        return self.cprofile
+
+    def record(self, name:str, wall:float, cpu:float, rows:int = 0, size:int = 0) -> None:
+        with self.lock:
+            metrics = self.stages.setdefault(name, StageMetrics())
+            metrics.wall += wall
+            metrics.cpu += cpu
+            metrics.rows += rows
+            metrics.bytes += size
+            metrics.peak_rss_mb = max(metrics.peak_rss_mb, peak_rss_mb())
+
+    def take(self) -> Dict[str, StageMetrics]:
+        """Returns the metrics collected so far and starts over, e.g. to send them
+        from a worker process to the parent after each shard"""
+        with self.lock:
+            stages, self.stages = self.stages, dict()
+        return stages
+
+    def merge(self, stages:Dict[str, StageMetrics]) -> None:
+        """Adds the metrics of another process, e.g. a worker, to the ones of this one.
+        Times and counts are summed and the peak memory is the largest one"""
+        with self.lock:
+            for name, other in stages.items():
+                metrics = self.stages.setdefault(name, StageMetrics())
+                metrics.wall += other.wall
+                metrics.cpu += other.cpu
+                metrics.rows += other.rows
+                metrics.bytes += other.bytes
+                metrics.peak_rss_mb = max(metrics.peak_rss_mb, other.peak_rss_mb)
+
+    @contextmanager
+    def stage(self, name:str) -> Generator[StageMetrics, None, None]:
+        """Times a block as a stage. The yielded object takes the rows and bytes it handled"""
+        counts = StageMetrics()
+        if not self.enabled:
+            yield counts
+            return
+        profile = self._profile_for(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield counts
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.record(name, time.perf_counter() - wall, time.process_time() - cpu, counts.rows, counts.bytes)
+
+    def map(self, name:str, func:Callable[[T], R], iterable:Iterable[T],
+        size:Optional[Callable[[R], int]] = None) -> Iterator[R]:
+        """Like map, timing only the calls to func, so the time of the stages upstream is not counted
+
+        Args:
+            name (str): the stage name
+            func (Callable[[T], R]): the function applied to each item
+            iterable (Iterable[T]): the items
+            size (Optional[Callable[[R], int]]): the bytes of each result, if they are counted
+        """
+        if not self.enabled:
+            return map(func, iterable)
+        return self._timed_map(name, func, iterable, size)
+
+    def iterate(self, name:str, iterable:Iterable[T], size:Optional[Callable[[T], int]] = None) -> Iterator[T]:
+        """Times the production of each item of an iterator that does not depend on other stages,
+        like reading lines from a zip file"""
+        if not self.enabled:
+            return iter(iterable)
+        iterator = iter(iterable)
+        return self._timed_map(name, lambda _: next(iterator, _END), repeat(None), size)
+
+    def _timed_map(self, name:str, func:Callable[[T], R], iterable:Iterable[T],
+        size:Optional[Callable[[R], int]]) -> Generator[R, None, None]:
+        profile = self._profile_for(name)
+        perf_counter, process_time = time.perf_counter, time.process_time
+        wall = cpu = 0.0
+        rows = total = 0
+        try:
+            for item in iterable:
+                start, start_cpu = perf_counter(), process_time()
+                if profile is not None:
+                    profile.enable()
+                result = func(item)
+                if profile is not None:
+                    profile.disable()
+                wall += perf_counter() - start
+                cpu += process_time() - start_cpu
+                if result is _END:
+                    return
+                rows += 1
+                if size is not None:
+                    total += size(result)
+                yield result
+        finally:
+            self.record(name, wall, cpu, rows, total)
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the total and per stage metrics"""
+        with self.lock:
+            stages = {name: metrics.to_dict() for name, metrics in self.stages.items()}
+        return {
+            'total': {'wall': time.perf_counter() - self.started[0], 'cpu': time.process_time() - self.started[1],
+                'peak_rss_mb': peak_rss_mb()},
+            'stages': stages,
+        }
+
+    def save(self, path:str) -> None:
+        """Saves the summary as JSON and logs it, with the cProfile statistics if any"""
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        for name, metrics in summary['stages'].items():
+            logging.info(f"{name}: {metrics['wall']:.3f}s wall, {metrics['cpu']:.3f}s CPU, {metrics['rows']} rows, "
+                f"{metrics['rows_per_second']:.0f} rows/s, {metrics['mb_per_second']:.1f} MB/s, "
+                f"peak RSS {metrics['peak_rss_mb']:.1f} MB")
+        total = summary['total']
+        logging.info(f"Total: {total['wall']:.3f}s wall, {total['cpu']:.3f}s CPU, peak RSS {total['peak_rss_mb']:.1f} MB")
+        if self.cprofile is not None:
+            import pstats
+            self.cprofile.dump_stats(path.rsplit('.', 1)[0] + '.prof')
+            stats = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stats).sort_stats('cumulative').print_stats(20)
+            logging.info(f"cProfile of {self.cprofile_stage}:\n{stats.getvalue()}")
+        logging.info(f"Profile saved to {path}")
+
+# The profiler of this process, enabled by --profile
+PROFILER = Profiler()
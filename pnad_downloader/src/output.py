@@ -0,0 +1,144 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import IO, Any, Callable, Deque, Generator, Iterable, List, Optional, Sequence
+
+# Extension appended to the name of the compressed files
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# Text is buffered and handed to the compressor in blocks of this size, which
+# zlib and zstandard compress without holding the GIL
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class UnknownCompression(Exception):
+    """Exception to be raised when the compression set in the config is not supported"""
+    pass
+
+@dataclass
+class Part:
+    """A file of the output, as listed in the manifest"""
+
+    file: str
+    rows: int
+    bytes: int
+    sha256: str
+
+def open_compressed(path:str, compression:str = "none", level:Optional[int] = None) -> IO[bytes]:
+    """Opens a binary file for writing, compressing what is written to it
+
+    Args:
+        path (str): the path of the file
+        compression (str): "none", "gzip" or "zstd", which needs the zstandard package
+        level (Optional[int]): the compression level, the default of the codec if None
+
+    Raises:
+        UnknownCompression: the compression is not supported
+
+    Returns:
+        IO[bytes]: the file object, closing it also closes the file
+    """
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise UnknownCompression(f"Unknown compression {compression}, use one of {', '.join(COMPRESSION_EXTENSIONS)}")
+    if compression == "gzip":
+        import gzip
+        # mtime is fixed so the same rows always give the same checksum
+        return gzip.GzipFile(path, 'wb', compresslevel=6 if level is None else level, mtime=0)
+    f = open(path, 'wb')
+    if compression == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return compressor.stream_writer(f, closefd=True)
+    return f
+
+def open_text(path:str, compression:str = "none", level:Optional[int] = None) -> IO[str]:
+    """Opens a text file for writing through open_compressed, buffered in WRITE_BUFFER_SIZE blocks"""
+    return io.TextIOWrapper(io.BufferedWriter(open_compressed(path, compression, level), WRITE_BUFFER_SIZE))
+
+def file_sha256(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def describe_part(path:str, rows:int) -> Part:
+    """Returns the manifest entry of a finished file"""
+    return Part(os.path.basename(path), rows, os.path.getsize(path), file_sha256(path))
+
+@contextmanager
+def staged_directory(path:str) -> Generator[str, None, None]:
+    """Yields a temporary directory inside path whose files are moved to path only
+    when the block finishes without errors, so a failure leaves no partial output
+
+    Args:
+        path (str): the directory of the output
+    """
+    staging = tempfile.mkdtemp(dir=path, prefix=".staging_")
+    try:
+        yield staging
+        for name in os.listdir(staging):
+            os.replace(os.path.join(staging, name), os.path.join(path, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def write_manifest(path:str, parts:Sequence[Part], fieldnames:Sequence[str], file_format:str,
+    compression:str = "none", partition_by:Sequence[str] = ()) -> None:
+    """Saves the list of output files with their row counts and checksums as JSON
+
+    Args:
+        path (str): the path of the manifest
+        parts (Sequence[Part]): the output files, in file order
+        fieldnames (Sequence[str]): the header of the files
+        file_format (str): "csv", "parquet", "arrow" or "sqlite"
+        compression (str): the compression of csv files
+        partition_by (Sequence[str]): the partition variables, whose columns are
+        left out of the files and the parts are paths like UF_ABREV=SP/part-0.csv
+    """
+    manifest = {
+        'format': file_format,
+        'compression': compression if file_format == "csv" else "none",
+        'fieldnames': list(fieldnames),
+        'rows': sum(part.rows for part in parts),
+        'parts': [asdict(part) for part in parts],
+    }
+    if partition_by:
+        manifest['partition_by'] = list(partition_by)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"Manifest of {len(parts)} parts saved to {os.path.basename(path)}")
+
+def write_in_threads(write:Callable[[str, List[Any]], Part], chunks:Iterable[Iterable[Any]],
+    paths:Iterable[str], threads:int) -> List[Part]:
+    """Writes each chunk to its path in a pool of threads, so the compression and
+    disk writes of several parts overlap with each other and with producing the rows
+
+    Chunks are materialized before they are handed to the pool, and at most
+    threads of them are pending at a time, which bounds the memory used.
+
+    Args:
+        write (Callable[[str, List[Any]], Part]): writes the rows of a chunk to a path
+        chunks (Iterable[Iterable[Any]]): the rows of each part, e.g. from ichunks
+        paths (Iterable[str]): the path of each part
+        threads (int): the number of writer threads
+
+    Returns:
+        List[Part]: the written parts, in file order
+    """
+    parts: List[Part] = list()
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix="writer") as executor:
+        for path, chunk in zip(paths, chunks):
+            if len(pending) >= max(threads, 1):
+                parts.append(pending.popleft().result())
+            logging.info(f"Saving to {os.path.basename(path)}")
+            pending.append(executor.submit(write, path, list(chunk)))
+        parts.extend(future.result() for future in pending)
+    return parts
@@ -0,0 +1,264 @@
+from dataclasses import asdict, dataclass
+import heapq
+from itertools import groupby
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from src import SAVE_PATH, PnadInputInfo, Record, Row, settings
+from src.batch import MetadataStore, Release
+from src.output import Part, write_manifest
+from src.reader import LOCATION_VARS, PnadReader, project_input, remote_identity, rows_to_csv
+from src.utils import ichunks, merge_lines
+
+# Households are identified by UPA, V1008 and V1014 and their members by V2003
+HOUSEHOLD_KEYS = ["UPA", "V1008", "V1014"]
+PERSON_KEYS = HOUSEHOLD_KEYS + ["V2003"]
+
+# Lines sorted in memory before they are written as a run of the external sort
+RUN_LINES = 1000000
+
+# Bump when the layout of the index files changes, older indexes are then rebuilt
+INDEX_VERSION = 1
+
+@dataclass
+class IndexLayout:
+    """The fixed width records of a panel index: the key followed by the payload
+    variables, each with the width it has in the data file"""
+
+    keys: List[str]
+    payload: List[str]
+    widths: List[int]
+    source: str
+    where: List[str]
+    rows: int = 0
+    version: int = INDEX_VERSION
+
+    @property
+    def key_width(self) -> int:
+        return sum(self.widths[:len(self.keys)])
+
+    def matches(self, other:"IndexLayout") -> bool:
+        """Whether an index built with other can be reused for this one"""
+        return (self.keys, self.payload, self.widths, self.source, self.where, self.version) == \
+            (other.keys, other.payload, other.widths, other.source, other.where, other.version)
+
+def index_spans(input_info:PnadInputInfo, variables:Sequence[str]) -> List[Tuple[int, int]]:
+    """Returns the start and end of each variable in the lines, in the given order"""
+    info = {var: (int(position.strip('@')) - 1, width) for position, var, width, _ in project_input(input_info, variables)}
+    return [(info[var][0], info[var][0] + info[var][1]) for var in variables]
+
+def write_sorted_runs(lines:Iterable[bytes], spans:Sequence[Tuple[int, int]], directory:str,
+    run_lines:int = RUN_LINES) -> Tuple[List[str], int]:
+    """Cuts the spans of each line into an index record and writes them in sorted runs of run_lines
+
+    Returns:
+        Tuple[List[str], int]: the path of each run and the number of records
+    """
+    run_paths: List[str] = list()
+    rows = 0
+    for i, chunk in enumerate(ichunks(lines, run_lines)):
+        # Only the spans are decoded, ISO-8859-1 keeps the order of the bytes
+        records = sorted(b''.join(line[start:end] for start, end in spans).decode('ISO-8859-1') + '\n' for line in chunk)
+        rows += len(records)
+        run_paths.append(os.path.join(directory, f"run_{i}.txt"))
+        with open(run_paths[-1], 'w', encoding='ISO-8859-1') as f:
+            f.writelines(records)
+    return run_paths, rows
+
+class PanelIndex:
+    """A persistent index of a release on the household or person key
+
+    The index is a file with a fixed width record per line of the release, holding
+    the key and the payload variables, sorted by key. It is built once with an
+    external sort, streaming the lines from the zip, and reused while the data zip,
+    the variables and the filters are the same, so releases can be joined by
+    merging their indexes without loading them in memory.
+    """
+
+    def __init__(self, path:str, layout:IndexLayout):
+        self.path = path
+        self.layout = layout
+
+    @staticmethod
+    def paths(directory:str, reader:PnadReader) -> Tuple[str, str]:
+        """Returns the paths of the index file and of its layout"""
+        base = os.path.join(directory, reader.pnad_read_vars.save_filename)
+        return f"{base}.idx", f"{base}.json"
+
+    @classmethod
+    def open(cls, directory:str, reader:PnadReader, keys:Sequence[str], payload:Sequence[str],
+        where:Sequence[str] = (), run_lines:int = RUN_LINES) -> "PanelIndex":
+        """Returns the index of a release, building it when it is missing or stale
+
+        Args:
+            directory (str): the directory of the indexes
+            reader (PnadReader): the reader of the release, with its row filter
+            keys (Sequence[str]): the key variables, e.g. PERSON_KEYS
+            payload (Sequence[str]): the other variables kept in the index
+            where (Sequence[str]): the filters of the reader, recorded in the layout
+            run_lines (int): lines sorted in memory at a time while building
+
+        Raises:
+            PnadVariableNotFound: a variable is not in the input file of the release
+        """
+        v = reader.pnad_read_vars
+        source = reader.run_remote(v.download_file_abspath, v.download_zipped_file_re, lambda ftp:
+            remote_identity(v.download_file_abspath, v.download_zipped_file_re, ftp, reader.cache))
+        variables = list(keys) + list(payload)
+        widths = [end - start for start, end in index_spans(reader.input_info, variables)]
+        layout = IndexLayout(list(keys), list(payload), widths, source, list(where))
+        index_path, layout_path = cls.paths(directory, reader)
+        try:
+            with open(layout_path, 'r') as f:
+                saved = IndexLayout(**json.load(f))
+            if saved.matches(layout) and os.path.isfile(index_path):
+                logging.info(f"Reusing panel index of {v.save_filename}")
+                return cls(index_path, saved)
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            pass
+        logging.info(f"Building panel index of {v.save_filename}")
+        layout.rows = cls.build(index_path, reader, variables, run_lines)
+        with open(layout_path, 'w') as f:
+            json.dump(asdict(layout), f)
+        return cls(index_path, layout)
+
+    @staticmethod
+    def build(index_path:str, reader:PnadReader, variables:Sequence[str], run_lines:int = RUN_LINES) -> int:
+        """Writes the sorted index of a release, merging the sorted runs of an external sort
+
+        Returns:
+            int: the number of records
+        """
+        spans = index_spans(reader.input_info, variables)
+        directory = os.path.dirname(index_path)
+        with tempfile.TemporaryDirectory(dir=settings().spool_path) as tmp_dir:
+            # Each attempt writes its runs to its own directory, see PnadReader.read_pnad
+            run_paths, rows = reader.read_pnad(lambda lines:
+                write_sorted_runs(lines, spans, tempfile.mkdtemp(dir=tmp_dir), run_lines))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='ISO-8859-1') as out:
+                run_files = [open(path, 'r', encoding='ISO-8859-1') for path in run_paths]
+                try:
+                    out.writelines(heapq.merge(*run_files))
+                finally:
+                    for f in run_files:
+                        f.close()
+            os.replace(tmp_path, index_path)
+        return rows
+
+    def records(self) -> Generator[Tuple[str, List[str]], None, None]:
+        """Yields the key and payload values of each record, in key order"""
+        key_width = self.layout.key_width
+        bounds = list()
+        start = key_width
+        for width in self.layout.widths[len(self.layout.keys):]:
+            bounds.append((start, start + width))
+            start += width
+        with open(self.path, 'r', encoding='ISO-8859-1') as f:
+            for line in f:
+                yield line[:key_width], [line[start:end] for start, end in bounds]
+
+def join_indexes(indexes:Sequence[PanelIndex]) -> Iterator[Tuple[str, Dict[int, List[str]]]]:
+    """Merges the sorted indexes and yields each key with the payload of the releases
+    it is found in, streaming all of them at once
+
+    A key repeated in a release (e.g. a household key for its members) keeps its first record.
+
+    Yields:
+        Iterator[Tuple[str, Dict[int, List[str]]]]: the key and the payload by release position
+    """
+    def tagged(i:int, index:PanelIndex) -> Iterator[Tuple[str, int, List[str]]]:
+        for key, payload in index.records():
+            yield key, i, payload
+
+    streams = [tagged(i, index) for i, index in enumerate(indexes)]
+    for key, group in groupby(heapq.merge(*streams, key=lambda record: record[:2]), key=lambda record: record[0]):
+        waves: Dict[int, List[str]] = dict()
+        for _, i, payload in group:
+            waves.setdefault(i, payload)
+        yield key, waves
+
+def split_key(key:str, widths:Sequence[int]) -> List[str]:
+    """Splits a fixed width key in the stripped values of its variables"""
+    values = list()
+    start = 0
+    for width in widths:
+        values.append(key[start:start + width].strip(' .'))
+        start += width
+    return values
+
+def link_panel(releases:Sequence[Release], keys:Sequence[str] = PERSON_KEYS, payload:Optional[Sequence[str]] = None,
+    keep:Sequence[str] = (), min_waves:int = 2, wide:bool = False, translate:bool = False,
+    where:Optional[Sequence[str]] = None, index_path:Optional[str] = None,
+    save_path:str = SAVE_PATH) -> List[Part]:
+    """Links the households or people of several releases on their key and saves the linked records
+
+    Each release is indexed on the key (see PanelIndex) and the indexes are merge joined.
+    By default a linked record folds the waves in release order with merge_lines: the
+    variables in keep hold the value of the first wave the key is found in and the others
+    the value of the last one. With wide, each wave has its own columns instead.
+
+    Args:
+        releases (Sequence[Release]): the releases to link, in time order
+        keys (Sequence[str]): the key variables, PERSON_KEYS or HOUSEHOLD_KEYS
+        payload (Optional[Sequence[str]]): the variables saved for each key, all of them if None
+        keep (Sequence[str]): the payload variables taken from the first wave
+        min_waves (int): the minimum number of releases a key must be found in
+        wide (bool): save the payload of each wave in its own columns
+        translate (bool): translate all codes, not only the location ones
+        where (Optional[Sequence[str]]): filters that the lines of every release must match
+        index_path (Optional[str]): the directory of the indexes, data/panel if None
+        save_path (str): the directory to save the linked records
+
+    Returns:
+        List[Part]: the saved files
+    """
+    index_path = index_path or os.path.join(save_path, "panel")
+    os.makedirs(index_path, exist_ok=True)
+    store = MetadataStore(where=where)
+    try:
+        readers = [store.reader_for(release.read_vars()) for release in releases]
+        if payload is None:
+            # Visits and quarters have different variables, only the common ones are linked
+            common = set.intersection(*(set(reader.pnad_vars) for reader in readers))
+            payload = [var for var in readers[0].pnad_vars if var in common]
+        payload = [var for var in payload if var not in keys]
+        indexes = [PanelIndex.open(index_path, reader, keys, payload, where or ()) for reader in readers]
+    finally:
+        store.pool.close()
+    key_widths = indexes[0].layout.widths[:len(keys)]
+    if any(index.layout.widths[:len(keys)] != key_widths for index in indexes):
+        raise ValueError(f"The widths of {', '.join(keys)} differ between the releases, they can not be linked")
+    keep_idx = {payload.index(var) for var in keep}
+    tvars = payload if translate else [var for var in LOCATION_VARS if var in payload]
+    translate_payload = lambda i, values: list(
+        readers[i].translate_record(Record(dict(zip(payload, values))), tvars).values())
+
+    def linked_rows() -> Generator[Row, None, None]:
+        for key, waves in join_indexes(indexes):
+            if len(waves) < min_waves:
+                continue
+            found = sorted(waves)
+            if wide:
+                values = [value for i in range(len(indexes))
+                    for value in (translate_payload(i, waves[i]) if i in waves else [''] * len(payload))]
+            else:
+                merged = waves[found[0]]
+                for i in found[1:]:
+                    merged = merge_lines(merged, waves[i], keep_idx)
+                values = translate_payload(found[-1], merged)
+            yield [*split_key(key, key_widths), ';'.join(str(i + 1) for i in found), *values]
+
+    names = [reader.pnad_read_vars.save_filename for reader in readers]
+    if wide:
+        header = list(keys) + ["waves"] + [f"{var}_{i + 1}" for i in range(len(indexes)) for var in payload]
+    else:
+        header = list(keys) + ["waves"] + list(payload)
+    filename = f"panel_{names[0]}_{names[-1]}"
+    parts = rows_to_csv(save_path, filename, header, linked_rows())
+    write_manifest(os.path.join(save_path, f"{filename}_manifest.json"), parts, header, "csv")
+    logging.info(f"Linked {sum(part.rows for part in parts)} records of {', '.join(names)}")
+    return parts
@@ -0,0 +1,217 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import io
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+from src import settings
+from src.metrics import PROFILER, StageMetrics
+from src.output import COMPRESSION_EXTENSIONS, Part, describe_part, write_manifest
+from src.reader import PnadReader, mmap_file, rows_to_csv, write_csv
+
+ByteRange = Tuple[int, int]
+
+# The reader is sent once to each worker process instead of with every shard
+_worker_reader: Optional[PnadReader] = None
+
+@dataclass
+class ShardTask:
+    path: str
+    start: int
+    end: int
+    tvars: List[str]
+    col_names: bool
+    engine: str
+    output: str
+    file_format: str = "csv"
+    header: bool = True
+    compression: Optional[str] = None
+
+def next_line_start(mapped:mmap.mmap, offset:int) -> int:
+    """Returns the offset of the first line starting at or after offset"""
+    if offset <= 0:
+        return 0
+    if offset >= len(mapped) or mapped[offset - 1:offset] == b'\n':
+        return min(offset, len(mapped))
+    newline = mapped.find(b'\n', offset)
+    return len(mapped) if newline < 0 else newline + 1
+
+def shard_ranges(mapped:mmap.mmap, shards:int) -> List[ByteRange]:
+    """Splits the file on line boundaries in a number of shards of similar size
+
+    As lines are fixed width, boundaries are computed from the first line length
+    and only adjusted when they do not fall at the start of a line.
+
+    Args:
+        mapped (mmap.mmap): the raw fixed width file
+        shards (int): the number of shards
+
+    Returns:
+        List[ByteRange]: the start and end offsets of each shard, in file order
+    """
+    size = len(mapped)
+    if size == 0:
+        return []
+    first_newline = mapped.find(b'\n')
+    line_length = size if first_newline < 0 else first_newline + 1
+    step = -(-size // (max(shards, 1) * line_length)) * line_length
+    ranges: List[ByteRange] = list()
+    start = 0
+    while start < size:
+        end = next_line_start(mapped, start + step)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def _init_worker(reader:PnadReader, profile:bool = False) -> None:
+    global _worker_reader
+    _worker_reader = reader
+    # Starts over from the metrics copied from the parent when the process was forked
+    PROFILER.enabled = False
+    if profile:
+        PROFILER.enable()
+
+def process_shard(task:ShardTask) -> Tuple[Part, Dict[str, StageMetrics]]:
+    """Parses, translates, transforms and saves a byte range of the raw file
+
+    Args:
+        task (ShardTask): the shard to process
+
+    Returns:
+        Tuple[Part, Dict[str, StageMetrics]]: the written file with its number of rows
+        and checksum, and the metrics of the shard when profiling, to be merged by the parent
+    """
+    part = _save_shard(_worker_reader, task)
+    return part, PROFILER.take() if PROFILER.enabled else dict()
+
+def _save_shard(reader:PnadReader, task:ShardTask) -> Part:
+    with mmap_file(task.path) as mapped:
+        # Copied so no buffer stays exported when the map is closed
+        shard = mapped[task.start:task.end]
+    if task.engine == "numpy":
+        rows = reader.transform(reader.iter_columnar_rows(shard, task.tvars))
+    else:
+        rows = reader.rows_from_lines(reader.filter_lines(io.BytesIO(shard)), task.tvars)
+    if task.file_format == "csv":
+        return write_csv(task.output, reader.fieldnames(task.col_names), rows, task.compression, header=task.header)
+    from src.arrow_writer import DEFAULT_BATCH_SIZE, write_arrow
+    builder = reader.row_builder(task.tvars, task.col_names)
+    rows_written = write_arrow(task.output, builder.fieldnames, reader.dictionary_labels(builder), rows, task.file_format,
+        settings().max_lines or DEFAULT_BATCH_SIZE)
+    return describe_part(task.output, rows_written)
+
+def join_shards(paths:List[str], output:str, rows:int, file_format:str, fieldnames:List[str],
+    labels:List[Optional[List[str]]]) -> Part:
+    """Joins the files of the shards, in order, into the single file the serial writer saves
+
+    Csv shards are concatenated, only the first one having the header, which also works
+    for gzip and zstd as their streams can follow each other. The record batches of
+    parquet and arrow shards are copied to a new file, with their dictionaries merged.
+
+    Args:
+        paths (List[str]): the files of the shards, in file order
+        output (str): the path of the joined file
+        rows (int): the number of rows of all shards
+        file_format (str): "csv", "parquet" or "arrow"
+        fieldnames (List[str]): the output column names
+        labels (List[Optional[List[str]]]): the known labels of each column, for parquet and arrow
+
+    Returns:
+        Part: the joined file with its number of rows and checksum
+    """
+    if file_format == "csv":
+        with open(output, 'wb') as joined:
+            for shard_path in paths:
+                with open(shard_path, 'rb') as shard:
+                    shutil.copyfileobj(shard, joined, 1024 * 1024)
+    else:
+        from src.arrow_writer import concat_arrow
+        concat_arrow(paths, output, fieldnames, labels, file_format)
+    return describe_part(output, rows)
+
+def split_shards(paths:List[str], save_path:str, filename:str, fieldnames:List[str],
+    compression:Optional[str] = None) -> List[Part]:
+    """Splits the csv files of the shards, in order, into the parts of max_lines rows
+    that rows_to_csv saves
+
+    The shards are uncompressed csv files without a header, their rows are read back
+    one at a time, so filtered shards still give full parts.
+
+    Args:
+        paths (List[str]): the files of the shards, in file order
+        save_path (str): the directory to save the parts
+        filename (str): the filename of the parts, without the part number
+        fieldnames (List[str]): the header of the parts
+        compression (Optional[str]): "none", "gzip" or "zstd", the one in the config if None
+
+    Returns:
+        List[Part]: the written parts, in file order
+    """
+    import csv
+    def rows():
+        for shard_path in paths:
+            with open(shard_path, newline='') as shard:
+                yield from csv.reader(shard)
+    return rows_to_csv(save_path, filename, fieldnames, rows(), compression)
+
+def process_in_parallel(reader:PnadReader, path:str, save_path:str, tvars:List[str],
+    col_names:bool, engine:str, workers:int, file_format:str = "csv") -> List[Part]:
+    """Processes the raw pnad file in a pool of processes, one shard per process, each
+    saved to its own file, and saves the manifest of the output
+
+    The output is named like the one of the serial writers. The shards are saved to a
+    temporary directory and joined into a single file, see join_shards, or, when csv
+    files are truncated at max_lines, split into parts of max_lines rows, see split_shards.
+    Parts are returned in file order.
+
+    Args:
+        reader (PnadReader): the reader of the pnad file
+        path (str): the path to the unzipped raw file
+        save_path (str): the directory to save the parts
+        tvars (List[str]): the variables to translate to string values
+        col_names (bool): substitute the variables for their descriptions
+        engine (str): "python" or "numpy"
+        workers (int): the number of processes
+        file_format (str): "csv", "parquet" or "arrow"
+
+    Returns:
+        List[Part]: the written parts
+    """
+    config = settings()
+    filename = reader.pnad_read_vars.save_filename
+    extension = file_format + (COMPRESSION_EXTENSIONS.get(config.compression, "") if file_format == "csv" else "")
+    # The serial writers save parquet and arrow to one file and csv to one file unless truncated
+    split = file_format == "csv" and bool(config.max_lines)
+    with mmap_file(path) as mapped:
+        ranges = shard_ranges(mapped, shards=workers)
+    shard_dir = tempfile.mkdtemp(dir=save_path, prefix=f".{filename}.")
+    try:
+        # Shards that are split again are read back, so they are left uncompressed
+        tasks = [ShardTask(path, start, end, tvars, col_names, engine,
+            os.path.join(shard_dir, f"{filename}_shard_{i}.{'csv' if split else extension}"), file_format,
+            header=not split and i == 0, compression="none" if split else None)
+            for i, (start, end) in enumerate(ranges)]
+        logging.info(f"Processing {len(tasks)} shards in {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(reader, PROFILER.enabled)) as executor:
+            results = list(executor.map(process_shard, tasks))
+        parts = [part for part, _ in results]
+        for _, stages in results:
+            PROFILER.merge(stages)
+        shard_paths = [task.output for task in tasks]
+        if split:
+            parts = split_shards(shard_paths, save_path, filename, reader.fieldnames(col_names))
+        else:
+            output = os.path.join(save_path, f"{filename}.{extension}")
+            logging.info(f"Joining {len(parts)} shards into {os.path.basename(output)}")
+            builder = reader.row_builder(tvars, col_names)
+            parts = [join_shards(shard_paths, output, sum(part.rows for part in parts),
+                file_format, builder.fieldnames, reader.dictionary_labels(builder))]
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    write_manifest(os.path.join(save_path, f"{filename}_manifest.json"), parts, reader.fieldnames(col_names),
+        file_format, config.compression)
+    return parts
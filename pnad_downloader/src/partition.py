@@ -0,0 +1,272 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import logging
+import os
+import shutil
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from src import Row
+from src.metrics import PROFILER
+from src.output import COMPRESSION_EXTENSIONS, Part, describe_part, open_text
+
+# Value of the partitions of blank values, as written by Hive and Spark
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+# Characters escaped as %XX in the partition directories, the same ones Hive escapes
+ESCAPED_CHARS = set('"#%\'*/:=?\\\x7f{[]^')
+
+# Rows held for each partition before they are written to its file
+BUFFER_ROWS = 5000
+
+# Rows held for all partitions together, the largest buffers are written above it
+MAX_BUFFERED_ROWS = 100000
+
+PartitionKey = Tuple[str, ...]
+
+def escape_partition_value(value:str) -> str:
+    """Escapes a value for a directory name like 'UF_ABREV=SP', blanks being DEFAULT_PARTITION"""
+    if not value:
+        return DEFAULT_PARTITION
+    return ''.join(f"%{ord(char):02X}" if char in ESCAPED_CHARS or ord(char) < 32 else char for char in value)
+
+def partition_dir(names:Sequence[str], key:PartitionKey) -> str:
+    """Returns the relative directory of a partition, e.g. UF_ABREV=SP/Capital=..."""
+    return os.path.join(*(f"{name}={escape_partition_value(value)}" for name, value in zip(names, key)))
+
+class PartFile(ABC):
+    """An open part of a partition, which knows how much it has written"""
+
+    def __init__(self, path:str, rows:int = 0):
+        self.path = path
+        self.rows = rows
+
+    @abstractmethod
+    def write(self, rows:Sequence[Row]) -> None:
+        pass
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """The bytes written so far, before compression and encoding"""
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+class CsvPartFile(PartFile):
+
+    def __init__(self, path:str, fieldnames:Sequence[str], compression:str = "none", level:Optional[int] = None):
+        import csv
+        super().__init__(path)
+        self.file = open_text(path, compression, level)
+        self.writer = csv.writer(self.file)
+        self.written = self.writer.writerow(fieldnames)
+
+    def write(self, rows:Sequence[Row]) -> None:
+        writerow = self.writer.writerow
+        for row in rows:
+            self.written += writerow(row)
+        self.rows += len(rows)
+
+    @property
+    def size(self) -> int:
+        return self.written
+
+    def close(self) -> None:
+        self.file.close()
+
+class ArrowPartFile(PartFile):
+
+    def __init__(self, path:str, fieldnames:Sequence[str], labels:Sequence[Optional[Sequence[str]]], file_format:str):
+        from src.arrow_writer import ArrowRecordWriter
+        super().__init__(path)
+        self.writer = ArrowRecordWriter(path, fieldnames, labels, file_format)
+
+    def write(self, rows:Sequence[Row]) -> None:
+        self.writer.write(rows)
+        self.rows += len(rows)
+
+    @property
+    def size(self) -> int:
+        return self.writer.written
+
+    def close(self) -> None:
+        self.writer.close()
+
+class PartitionedWriter:
+    """Streams rows into Hive style directories, one per value of the partition columns,
+    e.g. UF_ABREV=SP/part-0.csv, leaving those columns out of the files
+
+    Rows are buffered per partition and written BUFFER_ROWS at a time, and the
+    largest buffers are also written once all of them hold max_buffered rows, so
+    memory does not grow with the number of partitions. At most
+    max_open parts are open at once: writing to another partition closes the least
+    recently used one, and a partition that is written to again continues in a new
+    part. A part is also closed once it holds part_size bytes.
+    """
+
+    def __init__(self, root:str, fieldnames:Sequence[str], partition_idx:Sequence[int], partition_names:Sequence[str],
+        open_part:Callable[[str, Sequence[int]], PartFile], extension:str, max_open:int = 32,
+        part_size:int = 128 * 1024 * 1024, buffer_rows:int = BUFFER_ROWS, max_buffered:int = MAX_BUFFERED_ROWS):
+        """Initiates the PartitionedWriter object
+
+        Args:
+            root (str): the directory of the partitions
+            fieldnames (Sequence[str]): the columns of the rows
+            partition_idx (Sequence[int]): the positions of the partition columns
+            partition_names (Sequence[str]): the names of the partition columns in the directories
+            open_part (Callable[[str, Sequence[int]], PartFile]): opens a part at a path,
+            given the positions of the columns that are saved
+            extension (str): the extension of the parts, e.g. .csv.gz
+            max_open (int): the maximum number of open parts
+            part_size (int): the bytes after which a part is closed
+            buffer_rows (int): the rows held for each partition before they are written
+            max_buffered (int): the rows held for all partitions before the largest buffers are written
+        """
+        self.root = root
+        self.partition_idx = list(partition_idx)
+        self.partition_names = list(partition_names)
+        self.data_idx = [i for i in range(len(fieldnames)) if i not in set(partition_idx)]
+        self.fieldnames = [fieldnames[i] for i in self.data_idx]
+        self.open_part = open_part
+        self.extension = extension
+        self.max_open = max(max_open, 1)
+        self.part_size = part_size
+        self.buffer_rows = buffer_rows
+        self.max_buffered = max(max_buffered, buffer_rows)
+        self.buffered = 0
+        self.buffers: Dict[PartitionKey, List[Row]] = dict()
+        self.open_parts: "OrderedDict[PartitionKey, PartFile]" = OrderedDict()
+        self.next_part: Dict[PartitionKey, int] = dict()
+        self.parts: List[Part] = list()
+
+    def write(self, row:Row) -> None:
+        key = tuple(row[i] for i in self.partition_idx)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = list()
+        buffer.append([row[i] for i in self.data_idx])
+        self.buffered += 1
+        if len(buffer) >= self.buffer_rows:
+            self.flush(key)
+        elif self.buffered >= self.max_buffered:
+            self.flush_largest()
+
+    def flush_largest(self) -> None:
+        """Writes the largest buffers until at most half of max_buffered rows are held"""
+        for key in sorted(self.buffers, key=lambda k: len(self.buffers[k]), reverse=True):
+            if self.buffered <= self.max_buffered // 2:
+                break
+            self.flush(key)
+
+    def _part_for(self, key:PartitionKey) -> PartFile:
+        part = self.open_parts.get(key)
+        if part is not None:
+            self.open_parts.move_to_end(key)
+            return part
+        if len(self.open_parts) >= self.max_open:
+            self._close(*self.open_parts.popitem(last=False))
+        number = self.next_part.get(key, 0)
+        self.next_part[key] = number + 1
+        directory = os.path.join(self.root, partition_dir(self.partition_names, key))
+        os.makedirs(directory, exist_ok=True)
+        part = self.open_parts[key] = self.open_part(os.path.join(directory, f"part-{number}{self.extension}"), self.data_idx)
+        return part
+
+    def _close(self, key:PartitionKey, part:PartFile) -> None:
+        part.close()
+        described = describe_part(part.path, part.rows)
+        described.file = os.path.relpath(part.path, self.root)
+        self.parts.append(described)
+
+    def flush(self, key:PartitionKey) -> None:
+        """Writes the buffered rows of a partition, rolling its part over when it is full"""
+        rows = self.buffers.pop(key, None)
+        if not rows:
+            return
+        self.buffered -= len(rows)
+        part = self._part_for(key)
+        with PROFILER.stage("write") as counts:
+            part.write(rows)
+            counts.rows = len(rows)
+        if part.size >= self.part_size:
+            self._close(key, self.open_parts.pop(key))
+
+    def abort(self) -> None:
+        """Drops the buffered rows and closes the open parts, after an error"""
+        self.buffers.clear()
+        self.buffered = 0
+        while self.open_parts:
+            _, part = self.open_parts.popitem(last=False)
+            try:
+                part.close()
+            except Exception:
+                pass # The parts are removed, the first error is the one raised
+
+    def close(self) -> List[Part]:
+        """Writes what is left and closes every part
+
+        Returns:
+            List[Part]: the written parts, by partition and part number
+        """
+        for key in list(self.buffers):
+            self.flush(key)
+        while self.open_parts:
+            self._close(*self.open_parts.popitem(last=False))
+        return sorted(self.parts, key=lambda part: (os.path.dirname(part.file), int(part.file.rsplit('-', 1)[1].split('.')[0])))
+
+def rows_to_partitions(path:str, filename:str, fieldnames:Sequence[str], variables:Sequence[str],
+    partition_by:Sequence[str], rows:Iterable[Row], file_format:str = "csv",
+    labels:Optional[Sequence[Optional[Sequence[str]]]] = None, compression:str = "none",
+    level:Optional[int] = None, max_open:int = 32, part_size:int = 128 * 1024 * 1024) -> List[Part]:
+    """Saves rows to <path>/<filename>/<partition>=<value>/part-N, see PartitionedWriter
+
+    The partitions are written to a temporary directory that replaces the previous
+    output of the release, so no stale parts are left, and that is removed when
+    writing fails, so no partial parts are left either.
+
+    Args:
+        path (str): the absolute path to the directory to save the partitions
+        filename (str): the name of the directory of the partitions
+        fieldnames (Sequence[str]): the header of the rows
+        variables (Sequence[str]): the variable of each column, partition_by refers to them
+        partition_by (Sequence[str]): the partition variables, e.g. UF_ABREV or UF_ABREV,Capital
+        rows (Iterable[Row]): the data as an iterable of rows in fieldnames order
+        file_format (str): "csv", "parquet" or "arrow"
+        labels (Optional[Sequence[Optional[Sequence[str]]]]): the labels of each column, for parquet and arrow
+        compression (str): the compression of csv parts
+        level (Optional[int]): the compression level
+        max_open (int): the maximum number of open parts
+        part_size (int): the bytes after which a part is closed
+
+    Returns:
+        List[Part]: the written parts, with their paths relative to the directory of the partitions
+    """
+    partition_idx = [list(variables).index(var) for var in partition_by]
+    if file_format == "csv":
+        extension = ".csv" + COMPRESSION_EXTENSIONS.get(compression, "")
+        open_part = lambda part_path, data_idx: CsvPartFile(part_path, [fieldnames[i] for i in data_idx], compression, level)
+    else:
+        from src.arrow_writer import FILE_EXTENSIONS
+        extension = "." + FILE_EXTENSIONS[file_format]
+        open_part = lambda part_path, data_idx: ArrowPartFile(part_path, [fieldnames[i] for i in data_idx],
+            [labels[i] for i in data_idx], file_format)
+    root = os.path.join(path, filename)
+    tmp_root = root + ".tmp"
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    logging.info(f"Saving to {filename}, partitioned by {', '.join(partition_by)}")
+    writer = PartitionedWriter(tmp_root, fieldnames, partition_idx, partition_by, open_part, extension, max_open, part_size)
+    try:
+        for row in rows:
+            writer.write(row)
+        parts = writer.close()
+    except BaseException:
+        # A failed run, e.g. a corrupted stream read again by read_pnad, leaves no partial output
+        writer.abort()
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        raise
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp_root, root)
+    logging.info(f"Saved {sum(part.rows for part in parts)} records to {len(parts)} parts")
+    return parts
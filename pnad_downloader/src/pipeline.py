@@ -0,0 +1,248 @@
+import io
+import queue
+import re
+import struct
+import threading
+import zipfile
+import zlib
+from typing import Callable, Generator, Iterable, List, Tuple, TypeVar
+
+from src.ftp import DownloadVerificationError
+
+T = TypeVar('T')
+
+# Items held by the queue between two stages
+DEFAULT_QUEUE_SIZE = 16
+
+# Most bytes inflated at a time, which bounds the size of a decompressed block
+INFLATE_BLOCK_SIZE = 1024 * 1024
+
+# Seconds between the checks of a blocked producer for a stopped consumer
+PUT_TIMEOUT = 0.1
+
+# Signature, version, flags, method, time, date, CRC-32, compressed size, size, name and extra lengths
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP64_EXTRA_ID = 0x0001
+
+# Marks the end of the items of a producer
+_END = object()
+
+class PipelineStopped(Exception):
+    """Raised in a producer when the consumer of its queue has stopped, e.g. on an error"""
+    pass
+
+class _Failure:
+    """Carries the error of a producer through the queue"""
+
+    def __init__(self, error:BaseException):
+        self.error = error
+
+def threaded(produce:Callable[[Callable[[T], None]], None], maxsize:int = DEFAULT_QUEUE_SIZE,
+    name:str = "pipeline") -> Generator[T, None, None]:
+    """Runs a producer in its own thread and yields what it puts in a bounded queue
+
+    The producer gets a put function, which blocks while the queue is full, so a fast
+    stage waits for the slower one after it instead of holding its output in memory,
+    and which raises PipelineStopped once the consumer stopped. An error of the
+    producer is raised in the consumer. The thread starts with the first item asked.
+
+    Args:
+        produce (Callable[[Callable[[T], None]], None]): pushes the items with put,
+        e.g. from the callback of retrbinary
+        maxsize (int): the most items waiting in the queue
+        name (str): the name of the thread
+
+    Yields:
+        Generator[T, None, None]: the items, in the order they were put
+    """
+    items: queue.Queue = queue.Queue(max(maxsize, 1))
+    stopped = threading.Event()
+
+    def put(item:T) -> None:
+        while True:
+            if stopped.is_set():
+                raise PipelineStopped(f"The consumer of {name} has stopped")
+            try:
+                items.put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+    def run() -> None:
+        try:
+            produce(put)
+            put(_END)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            try:
+                put(_Failure(e))
+            except PipelineStopped:
+                pass
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+class ChunkReader:
+    """Reads a stream of byte chunks, e.g. from a download, by exact sizes or in the chunks as they come"""
+
+    def __init__(self, chunks:Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size:int) -> bytes:
+        """Returns the next size bytes
+
+        Raises:
+            zipfile.BadZipFile: the stream ended before them
+        """
+        parts = [self.buffer]
+        available = len(self.buffer)
+        while available < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                raise zipfile.BadZipFile("Unexpected end of the zip stream")
+            parts.append(chunk)
+            available += len(chunk)
+        data = b''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def chunk(self) -> bytes:
+        """Returns the buffered bytes or the next chunk, b'' at the end of the stream"""
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        return next(self.chunks, b'')
+
+    def unread(self, data:bytes) -> None:
+        """Puts back bytes read past the end of a member"""
+        self.buffer = data + self.buffer
+
+def zip64_sizes(extra:bytes, compressed_size:int, size:int) -> Tuple[int, int, bool]:
+    """Returns the compressed size and size of a member, reading the ZIP64 extra field when present
+
+    Returns:
+        Tuple[int, int, bool]: the compressed size, the size and whether the member is ZIP64
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        extra_id, length = struct.unpack_from('<HH', extra, offset)
+        if extra_id == ZIP64_EXTRA_ID:
+            values = list(struct.unpack_from(f'<{min(length, 16) // 8}Q', extra, offset + 4))
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            return compressed_size, size, True
+        offset += 4 + length
+    return compressed_size, size, False
+
+def member_blocks(reader:ChunkReader, method:int, compressed_size:int) -> Generator[bytes, None, None]:
+    """Yields the decompressed blocks of the member at the position of the reader,
+    leaving the reader right after its data"""
+    if method == zipfile.ZIP_DEFLATED:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not inflater.eof:
+            data = inflater.unconsumed_tail or reader.chunk()
+            if not data:
+                raise zipfile.BadZipFile("Unexpected end of the zip stream")
+            block = inflater.decompress(data, INFLATE_BLOCK_SIZE)
+            if block:
+                yield block
+        reader.unread(inflater.unused_data + inflater.unconsumed_tail)
+    elif method == zipfile.ZIP_STORED:
+        remaining = compressed_size
+        while remaining:
+            data = reader.chunk()
+            if not data:
+                raise zipfile.BadZipFile("Unexpected end of the zip stream")
+            if len(data) > remaining:
+                reader.unread(data[remaining:])
+                data = data[:remaining]
+            remaining -= len(data)
+            yield data
+    else:
+        raise zipfile.BadZipFile(f"Compression method {method} can not be read as a stream")
+
+def inflate_zip_member(chunks:Iterable[bytes], file_re:str) -> Generator[bytes, None, None]:
+    """Yields the decompressed contents of a zip member while the zip is still arriving
+
+    The local headers are read in file order, so the central directory at the end of
+    the zip is not needed. Members before the matching one are read and skipped and
+    the CRC-32 of the member is checked at its end.
+
+    Args:
+        chunks (Iterable[bytes]): the bytes of the zip, in order
+        file_re (str): regex to match with the file to unzip
+
+    Raises:
+        FileNotFoundError: no member matches file_re
+        DownloadVerificationError: the CRC-32 of the member does not match
+        zipfile.BadZipFile: the zip is truncated, encrypted or uses another compression
+
+    Yields:
+        Generator[bytes, None, None]: the decompressed blocks, of up to INFLATE_BLOCK_SIZE bytes
+    """
+    reader = ChunkReader(chunks)
+    while True:
+        signature = reader.read(4)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            # The central directory follows the last member
+            raise FileNotFoundError(f"No file matching {file_re} in the zip stream")
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = \
+            LOCAL_HEADER.unpack(signature + reader.read(LOCAL_HEADER.size - 4))
+        name = reader.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        compressed_size, size, is_zip64 = zip64_sizes(reader.read(extra_length), compressed_size, size)
+        if flags & 0x1:
+            raise zipfile.BadZipFile(f"{name} is encrypted")
+        if flags & 0x8 and method != zipfile.ZIP_DEFLATED:
+            raise zipfile.BadZipFile(f"The size of {name} is not known before its data")
+        wanted = re.match(file_re, name) is not None
+        checksum = 0
+        for block in member_blocks(reader, method, compressed_size):
+            checksum = zlib.crc32(block, checksum)
+            if wanted:
+                yield block
+        if flags & 0x8:
+            # The CRC and sizes follow the data, with an optional signature
+            descriptor = reader.read(4)
+            if descriptor == DESCRIPTOR_SIGNATURE:
+                descriptor = reader.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            reader.read(16 if is_zip64 else 8)
+        if checksum != crc:
+            raise DownloadVerificationError(f"CRC check failed for {name} in the zip stream")
+        if wanted:
+            return
+
+def line_batches(blocks:Iterable[bytes]) -> Generator[List[bytes], None, None]:
+    """Splits decompressed blocks into lines, with their line breaks, like iterating a binary file
+
+    Yields:
+        Generator[List[bytes], None, None]: the lines ending in each block, as one list
+    """
+    rest = b''
+    for block in blocks:
+        data = rest + block if rest else block
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            rest = data
+            continue
+        rest = data[end:]
+        yield io.BytesIO(data[:end]).readlines()
+    if rest:
+        yield [rest]
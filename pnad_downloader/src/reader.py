@@ -1,87 +1,313 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from functools import partial
-from itertools import chain, repeat
+from itertools import chain, count, repeat
 import logging
 import struct
-from typing import Any, Callable, Dict, List, Sequence, Tuple, Generator
+from typing import IO, Any, Callable, ContextManager, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar, Generator, Iterator
 import zipfile
+import zlib
 import ftplib
 import socket
 import io
+import mmap
 import re
 import os
-import csv
-import xlrd
+import shutil
+import tempfile
 
-from src import SAVE_PATH, MAX_LINES, PnadParse, PnadDict, PnadData, PnadInputInfo, PnadReadVars, Record
-from src.utils import ASCII_CHARS, STATES_ABREV, STATES_ABREV_ASCII_NAMES, chunks, get_list_size, lpad, maybe_int, standardize, uniques_from_list
+from src import SAVE_PATH, PnadParse, PnadDict, PnadData, PnadInputInfo, PnadReadVars, Record, Row, settings
+from src.aggregate import QUARTERLY_WEIGHT, YEARLY_WEIGHT, WeightedAggregator, aggregate_columns
+from src.cache import CacheMiss, FtpCache, MetadataCache
+from src.filters import RowFilter
+from src.metrics import PROFILER
+from src.output import COMPRESSION_EXTENSIONS, Part, describe_part, open_text, staged_directory, write_in_threads, write_manifest
+from src.pipeline import inflate_zip_member, line_batches, threaded
+from src.ftp import (PROGRESS_SUFFIX, DownloadVerificationError, FtpPool, Retriever, StreamingDownload, file_identity,
+    is_segmented, remote_stat, retrieve_file, segmented_retriever)
+from src.translation import RowBuilder, Schema, uf_abrev_from_name
+from src.utils import ASCII_CHARS, ichunks, lpad, maybe_int, standardize
 
-def zipfile_lines_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:ftplib.FTP) -> Generator[bytes, None, None]:
+T = TypeVar('T')
+
+@contextmanager
+def spooled_file_by_path(abspath:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None, retrieve:Retriever = retrieve_file) -> Generator[str, None, None]:
+    """Retrieves a file from ftp server to local disk and yields its path
+
+    Without a cache the file is spooled to a temporary file, removed on exit.
+
+    Args:
+        abspath (str): absolute path to file directory in the FTP server
+        file_re (str): regex to match with the file to retrieve
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the file from
+        retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
+
+    Yields:
+        Generator[str, None, None]: the path to the local file
+    """
+    if cache is not None:
+        yield cache.fetch(abspath, file_re, ftp, retrieve)
+        return
+    ftp.cwd(abspath)
+    match = partial(re.match, file_re)
+    data_file = next(filter(match, ftp.nlst()), None)
+    if data_file is None:
+        raise FileNotFoundError(f"No file matching {file_re} in {abspath}")
+    fd, spool_path = tempfile.mkstemp(dir=settings().spool_path, suffix=".spool")
+    os.close(fd)
+    try:
+        retrieve(ftp, abspath, data_file, spool_path)
+        yield spool_path
+    finally:
+        # A failed segmented download may have removed the spool and left its progress
+        for path in (spool_path, spool_path + PROGRESS_SUFFIX):
+            if os.path.isfile(path):
+                os.remove(path)
+
+@contextmanager
+def mmap_file(path:str) -> Generator[mmap.mmap, None, None]:
+    """Yields a read only memory map of a local file"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+class MmapIO(io.RawIOBase):
+    """A read only file object over a memory map, as mmap is not seekable for zipfile"""
+
+    def __init__(self, mapped:mmap.mmap):
+        self.mapped = mapped
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.mapped.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        self.mapped.seek(offset, whence)
+        return self.mapped.tell()
+
+    def tell(self) -> int:
+        return self.mapped.tell()
+
+@contextmanager
+def zipfile_by_path(abspath:str, zipfile_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None, retrieve:Retriever = retrieve_file) -> Generator[zipfile.ZipFile, None, None]:
+    """Yields a zip retrieved from ftp server, read through a memory map of the spooled file, not from RAM
+
+    Args:
+        abspath (str): absolute path to zipped file in the FTP server
+        zipfile_re (str): regex to match with the .zip file
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
+        retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
+
+    Yields:
+        Generator[zipfile.ZipFile, None, None]: the opened zip file
+    """
+    with spooled_file_by_path(abspath, zipfile_re, ftp, cache, retrieve) as zip_path, \
+        mmap_file(zip_path) as zipdata, \
+        zipfile.ZipFile(MmapIO(zipdata)) as zipped_file:
+        yield zipped_file
+
+def zip_member_name(zipped_file:zipfile.ZipFile, file_re:str) -> str:
+    """Returns the name of the first file in the zip matching the regex"""
+    match = partial(re.match, file_re)
+    file_name = next(filter(match, map(lambda x:x.filename, zipped_file.filelist)), None)
+    if file_name is None:
+        raise FileNotFoundError(f"No file matching {file_re} in {zipped_file.filename or 'zip file'}")
+    return file_name
+
+@contextmanager
+def zip_member_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None, retrieve:Retriever = retrieve_file) -> Generator[IO[bytes], None, None]:
+    """Yields an opened file inside a zip retrieved from ftp server
+
+    Args:
+        abspath (str): absolute path to zipped file in the FTP server
+        zipfile_re (str): regex to match with the .zip file
+        file_re (str): regex to match with the file to unzip
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
+        retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
+
+    Yields:
+        Generator[IO[bytes], None, None]: the zip member opened for binary reading
+    """
+    with zipfile_by_path(abspath, zipfile_re, ftp, cache, retrieve) as zipped_file, \
+        zipped_file.open(zip_member_name(zipped_file, file_re), 'r') as opened_file:
+        yield opened_file
+
+def zipfile_members_by_path(abspath:str, zipfile_re:str, files_re:List[str], ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None) -> List[bytes]:
+    """Returns the contents of many files inside the same zip, downloading it once
+
+    Args:
+        abspath (str): absolute path to zipped file in the FTP server
+        zipfile_re (str): regex to match with the .zip file
+        files_re (List[str]): regexes to match with the files to unzip
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
+
+    Returns:
+        List[bytes]: The unzipped files contents, in the order of the regexes
+    """
+    with zipfile_by_path(abspath, zipfile_re, ftp, cache) as zipped_file:
+        return [zipped_file.read(zip_member_name(zipped_file, file_re)) for file_re in files_re]
+
+def zipfile_lines_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None) -> Generator[bytes, None, None]:
     """Yields lines of unzipped file from ftp server
 
     Args:
         abspath (str): absolute path to file in the FTP server
         zipfile_re (str): lowercase regex to match with the .zip file
         file_re (str): lowercase regex to match with the file to unzip
-        ftp (ftplib.FTP): a FTP object with the connection to the FTP server
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
 
     Yields:
         Generator[bytes, None, None]: A Generator of the lines of the file as byte strings
     """
-    ftp.cwd(abspath)
-    match = partial(re.match, zipfile_re)
-    data_file = next(filter(match, ftp.nlst()))
-    with io.BytesIO() as zipdata:
-        ftp.retrbinary(f"RETR {data_file}", zipdata.write)
-        zipped_file = zipfile.ZipFile(zipdata)
-        match = partial(re.match, file_re)
-        file_name = next(filter(match, map(lambda x:x.filename, zipped_file.filelist)))
-        with zipped_file.open(file_name, 'r') as opened_file:
-            for line in opened_file:
-                yield line
+    with zip_member_by_path(abspath, zipfile_re, file_re, ftp, cache) as opened_file:
+        for line in opened_file:
+            yield line
 
-def zipfile_contents_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:ftplib.FTP) -> bytes:
+def zipfile_contents_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None) -> bytes:
     """Returns an unzipped file contents as bytes
 
     Args:
         abspath (str): absolute path to zipped file in the FTP server
         zipfile_re (str): regex to match with the .zip file
         file_re (str): regex to match with the file to unzip
-        ftp (ftplib.FTP): a FTP object with the connection to the FTP server
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
 
     Returns:
         bytes: The unzipped file contents read as bytes
     """
-    ftp.cwd(abspath)
-    match = partial(re.match, zipfile_re)
-    data_file = next(filter(match, ftp.nlst()))
-    with io.BytesIO() as zipdata:
-        ftp.retrbinary(f"RETR {data_file}", zipdata.write)
-        zipped_file = zipfile.ZipFile(zipdata)
-        match = partial(re.match, file_re)
-        file_name = next(filter(match, map(lambda x:x.filename, zipped_file.filelist)))
-        with zipped_file.open(file_name, 'r') as opened_file:
-            return opened_file.read()
+    with zip_member_by_path(abspath, zipfile_re, file_re, ftp, cache) as opened_file:
+        return opened_file.read()
+
+@contextmanager
+def zipfile_extracted_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None, retrieve:Retriever = retrieve_file) -> Generator[str, None, None]:
+    """Extracts a file from a zip in the ftp server to a temporary file and yields its path
+
+    Args:
+        abspath (str): absolute path to zipped file in the FTP server
+        zipfile_re (str): regex to match with the .zip file
+        file_re (str): regex to match with the file to unzip
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
+        retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
+
+    Yields:
+        Generator[str, None, None]: the path to the unzipped file, removed on exit
+    """
+    fd, extracted_path = tempfile.mkstemp(dir=settings().spool_path, suffix=".txt")
+    try:
+        with os.fdopen(fd, 'wb') as extracted, \
+            zip_member_by_path(abspath, zipfile_re, file_re, ftp, cache, retrieve) as opened_file:
+            shutil.copyfileobj(opened_file, extracted, 1024 * 1024)
+        yield extracted_path
+    finally:
+        os.remove(extracted_path)
 
+@contextmanager
+def zipfile_mmap_by_path(abspath:str, zipfile_re:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None, retrieve:Retriever = retrieve_file) -> Generator[mmap.mmap, None, None]:
+    """Extracts a file from a zip in the ftp server to a temporary file and
+    yields it as a memory map, so it can be sliced without copies
+
+    Args:
+        abspath (str): absolute path to zipped file in the FTP server
+        zipfile_re (str): regex to match with the .zip file
+        file_re (str): regex to match with the file to unzip
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the zip file from
+        retrieve (Retriever): downloads the file, retrieve_file or a segmented_retriever
 
-def file_contents_by_path(abspath:str, file_re:str, ftp:ftplib.FTP) -> bytes:
+    Yields:
+        Generator[mmap.mmap, None, None]: the unzipped file contents as a read only memory map
+    """
+    with zipfile_extracted_by_path(abspath, zipfile_re, file_re, ftp, cache, retrieve) as extracted_path, \
+        mmap_file(extracted_path) as mapped:
+        yield mapped
+
+def file_contents_by_path(abspath:str, file_re:str, ftp:Optional[ftplib.FTP],
+    cache:Optional[FtpCache] = None) -> bytes:
     """Return an entire file retrieved fro FTP server
 
     Args:
         abspath (str): absolute path to file directory
         file_re (str): lowercase regex to match with file to retrieve
-        ftp (ftplib.FTP): a FTP object containing the connection to the remote server
+        ftp (Optional[ftplib.FTP]): a FTP object containing the connection to the remote server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache to reuse the file from
 
     Return:
         bytes: The file read as bytes
     """
-    ftp.cwd(abspath)
-    match = partial(re.match, file_re)
-    data_file = next(filter(match, ftp.nlst()))
-    with io.BytesIO() as datafile:
-        ftp.retrbinary(f"RETR {data_file}", datafile.write)
-        datafile.seek(0)
-        return datafile.read()
+    with spooled_file_by_path(abspath, file_re, ftp, cache) as local_path:
+        with open(local_path, 'rb') as local_file:
+            return local_file.read()
+
+# Variables translated even when not asked to, used for the location columns
+LOCATION_VARS = ["UF", "Capital", "RM_RIDE"]
+
+# Variables that identify the interview and must never be transformed
+IDENTIFIER_VARS = ['Ano', 'Trimestre', 'UPA', 'Estrato', 'V1008', 'V1014', 'V1016', 'V1029', 'posest']
+
+def remote_identity(abspath:str, file_re:str, ftp:Optional[ftplib.FTP], cache:Optional[FtpCache] = None) -> str:
+    """Returns the path, name, size and modification time of a remote file, which change with its contents
+
+    Args:
+        abspath (str): absolute path to file directory in the FTP server
+        file_re (str): regex to match with the file name
+        ftp (Optional[ftplib.FTP]): a FTP object with the connection to the FTP server,
+        may be None only if the file is in the cache
+        cache (Optional[FtpCache]): a cache that may already know the file
+
+    Raises:
+        CacheMiss: no connection was given and the file is not in the cache
+
+    Returns:
+        str: the identity of the file
+    """
+    if ftp is None:
+        entry = cache.lookup_entry(abspath, file_re) if cache is not None else None
+        if entry is None:
+            raise CacheMiss(f"{abspath}{file_re} is not cached")
+        filename, size, mdtm = entry['name'], entry['size'], entry['mdtm']
+    else:
+        ftp.cwd(abspath)
+        match = partial(re.match, file_re)
+        filename = next(filter(match, ftp.nlst()), None)
+        if filename is None:
+            raise FileNotFoundError(f"No file matching {file_re} in {abspath}")
+        size, mdtm = remote_stat(ftp, filename)
+    return file_identity(abspath, filename, size, mdtm)
 
 class PnadVariableNotFound(Exception):
     """Exception to be raised when pnad variable is not found"""
@@ -103,10 +329,11 @@ def xls_to_pnad_dict(pnad_dict:List[List[Any]],
     """
     d : Dict[str, Dict[str, str]] = defaultdict(dict)
     current_var = ''
+    widths : Dict[str, int] = {info[1]:info[2] for info in input_info}
 
     # For each variable, store the codes and respective values
     # ----------- Do NOT transform! -----------
-    special_cases = ['Ano', 'Trimestre', 'UPA', 'Estrato', 'V1008', 'V1014', 'V1016', 'V1029', 'posest']
+    special_cases = IDENTIFIER_VARS
 
     # --------- For all the remaining ---------
     for i in range(6, len(pnad_dict)): # Begin after "Trimestre" line
@@ -117,21 +344,17 @@ def xls_to_pnad_dict(pnad_dict:List[List[Any]],
         if isinstance(pnad_dict[i][6], str):
             if not pnad_dict[i][5]: # If the code is blank, probably variable does not apply
                 if pnad_dict[i][6]:
-                    try:
-                        real_len = next(filter(lambda x:x[1] == current_var, input_info))[2]
-                        d[current_var].update({''.join(repeat(' ', real_len)) : pnad_dict[i][6]})
-                    except StopIteration:
+                    if current_var not in widths:
                         raise PnadVariableNotFound(f"Could not found variable {current_var} on input file info")
+                    d[current_var].update({''.join(repeat(' ', widths[current_var])) : pnad_dict[i][6]})
             elif not maybe_int(pnad_dict[i][5]): 
                 if not current_var in d.keys():
                     d[current_var] = dict() # Just put an empty dict
             else:
-                try:
-                    real_len = next(filter(lambda x:x[1] == current_var, input_info))[2]
-                    num_str = lpad(str(int(pnad_dict[i][5])), real_len, '0')
-                    d[current_var].update({num_str : pnad_dict[i][6]})
-                except StopIteration:
+                if current_var not in widths:
                     raise PnadVariableNotFound(f"Could not found variable {current_var} on input file info")
+                num_str = lpad(str(int(pnad_dict[i][5])), widths[current_var], '0')
+                d[current_var].update({num_str : pnad_dict[i][6]})
 
     # ---------- Add the exceptions ----------
     for var in special_cases:
@@ -140,86 +363,485 @@ def xls_to_pnad_dict(pnad_dict:List[List[Any]],
     # Return all variables in order
     return PnadDict({var:d[var] for var in map(lambda ls:ls[1], input_info)})
 
+def input_info_from_file(input_file:bytes) -> PnadInputInfo:
+    """Reads the positions, variable names and column names from the input file
+
+    Args:
+        input_file (bytes): the input file contents
+
+    Returns:
+        PnadInputInfo: input file in PnadInputInfo format
+    """
+    input_info = list()
+    for line in input_file.splitlines():
+        if line.decode('ISO-8859-1').startswith('@'):
+            line_data = list(filter(None,line.decode('ISO-8859-1').split()))
+            input_info.append((line_data[0], line_data[1], int(line_data[2].strip('$.')), ' '.join(line_data[4:-1]))) # Get positions, variable name and column name
+    return PnadInputInfo(input_info)
+
+def pnad_dict_from_xls(dict_file:bytes, input_info:PnadInputInfo) -> PnadDict:
+    """Reads the dictionary xls file into a PnadDict
+
+    Args:
+        dict_file (bytes): the dictionary file contents
+        input_info (PnadInputInfo): the input file information to be used
+
+    Returns:
+        PnadDict: the dictionary file contents as a PnadDict
+    """
+    import xlrd
+    dict_lines = list()
+    dict_xls : xlrd.Book = xlrd.open_workbook(file_contents=dict_file, formatting_info=False)
+    dict_sheet = dict_xls.sheet_by_index(0)
+    for i in range(dict_sheet.nrows):
+        dict_lines.append(dict_sheet.row_values(i))
+    return xls_to_pnad_dict(dict_lines, input_info)
+
+def project_input(input_info:PnadInputInfo, columns:Optional[Sequence[str]]) -> PnadInputInfo:
+    """Keeps only the selected variables of the input file information, in file order.
+    Their '@' positions are kept, so parsers skip the bytes in between
+
+    Args:
+        input_info (PnadInputInfo): the input file information
+        columns (Optional[Sequence[str]]): the variables to keep, all of them if None
+
+    Raises:
+        PnadVariableNotFound: a variable is not in the input file
+
+    Returns:
+        PnadInputInfo: the input file information of the selected variables
+    """
+    if not columns:
+        return input_info
+    missing = set(columns).difference(info[1] for info in input_info)
+    if missing:
+        raise PnadVariableNotFound(f"Could not found variables {', '.join(sorted(missing))} on input file info")
+    columns = set(columns)
+    return PnadInputInfo([info for info in input_info if info[1] in columns])
+
+def parser_format(input_info:PnadInputInfo) -> str:
+    """Returns the struct format of a line, with pad bytes for the spans of variables not in input_info"""
+    fields = list()
+    cursor = 0
+    for info in input_info:
+        offset = int(info[0].strip('@')) - 1
+        if offset > cursor:
+            fields.append(f"{offset - cursor}x")
+        fields.append(f"{info[2]}s")
+        cursor = offset + info[2]
+    return ' '.join(fields)
+
 def parser_cols_from_input(input_info:PnadInputInfo
-    ) -> Tuple[Callable[[str],List[str]], List[str], List[str]]:
-    """Get a parser for the strings of pnad file and the column names from input file"""
-    fieldstruct = struct.Struct(' '.join(map(lambda x:str(x[2]) + 's', input_info)))
+    ) -> Tuple[PnadParse, List[str], List[str]]:
+    """Get a parser for the raw lines of pnad file and the column names from input file.
+    The parser slices the bytes of each field, the positions of the input file being
+    byte offsets, and leaves decoding to the values that are saved"""
+    fieldstruct = struct.Struct(parser_format(input_info))
     unpack = fieldstruct.unpack_from
-    parse: Callable[[str], List[str]] = lambda line:[s.decode("utf-8") for s in unpack(line.encode("utf-8"))]
+    parse: PnadParse = lambda line: list(unpack(line))
     columns: List[str] = [standardize(val[-1]) for val in input_info]
     variables: List[str] = [val[1] for val in input_info]
     return parse, columns, variables
 
-def read_fieldnames(records:List[Record]) -> Sequence[str]:
-    return uniques_from_list(chain(*list(map(lambda x:list(x.keys()), records))))
+def write_csv(path:str, fieldnames:Sequence[str], rows:Iterable[Row], compression:Optional[str] = None,
+    header:bool = True) -> Part:
+    """Writes rows to a single csv file
+
+    Args:
+        path (str): the absolute path of the file
+        fieldnames (Sequence[str]): the header of the file
+        rows (Iterable[Row]): the rows to write, in fieldnames order
+        compression (Optional[str]): "none", "gzip" or "zstd", the one in the config if None
+        header (bool): write the header, False for a file that continues another one
+
+    Returns:
+        Part: the file with the number of rows written and its checksum
+    """
+    import csv
+    compression = settings().compression if compression is None else compression
+    rows_written = 0
+    with open_text(path, compression, settings().compression_level) as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(fieldnames)
+        # writerow returns the characters written
+        for _ in PROFILER.map("write", writer.writerow, rows, size=int):
+            rows_written += 1
+    return describe_part(path, rows_written)
 
-def records_to_csv(path:str, filename:str, records:List[Record]) -> None:
-    """Saves records to spcified path and filename
+def rows_to_csv(path:str, filename:str, fieldnames:Sequence[str], rows:Iterable[Row],
+    compression:Optional[str] = None) -> List[Part]:
+    """Saves rows to spcified path and filename
+
+    Rows are consumed as a stream. When files are truncated at max_lines, each
+    part is handed to a pool of writer_threads threads that compress and write it
+    while the next one is built, so at most that many parts are kept in memory.
 
     Args:
         path (str): the absolute path to the directory to save the file
         filename (str): the filename to be saved
-        records (List[Record]): the data as a list of records
+        fieldnames (Sequence[str]): the header of the file, e.g. from Schema.header
+        rows (Iterable[Row]): the data as an iterable of rows in fieldnames order
+        compression (Optional[str]): "none", "gzip" or "zstd", the one in the config if None
+
+    Returns:
+        List[Part]: the written files, in file order
     """
-    logging.debug(f"Parsed data size: {get_list_size(records) / (1024 * 1024)} MB")
-    logging.debug("Reading fieldnames")
-    fieldnames = read_fieldnames(records)
-    logging.debug("Dividing in chunks")
-    if MAX_LINES:
-        records_chunks = chunks(records, MAX_LINES)
-        del records
-        counter = 0
-        for rec_list in records_chunks:
-            logging.info(f"Saving to {filename}_part_{counter}.csv")
-            with open(str(os.path.join(path, f"{filename}_part_{counter}.csv")),'w') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for r in rec_list:
-                    writer.writerow(r)
-            counter += 1
-    else:
-        logging.info(f"Saving to {filename}.csv")
-        with open(str(os.path.join(path, f"{filename}.csv")),'w') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for r in records:
-                writer.writerow(r)
+    config = settings()
+    compression = config.compression if compression is None else compression
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        logging.warning("No records to save")
+        return []
+    rows = chain([first], rows)
+    extension = ".csv" + COMPRESSION_EXTENSIONS.get(compression, "")
+    if config.max_lines:
+        paths = (os.path.join(path, f"{filename}_part_{counter}{extension}") for counter in count())
+        write = lambda part_path, part_rows: write_csv(part_path, fieldnames, part_rows, compression)
+        return write_in_threads(write, ichunks(rows, config.max_lines), paths, config.writer_threads)
+    logging.info(f"Saving to {filename}{extension}")
+    return [write_csv(os.path.join(path, f"{filename}{extension}"), fieldnames, rows, compression)]
 
 
 class PnadReader:
     """A class to download, parse, transform and save the pnad file data"""
 
-    def __init__(self, pnad_reader_vars:PnadReadVars):
+    def __init__(self, pnad_reader_vars:PnadReadVars, input_info:Optional[PnadInputInfo] = None,
+        pnad_dict:Optional[PnadDict] = None, pool:Optional[FtpPool] = None, columns:Optional[Sequence[str]] = None,
+        where:Optional[Sequence[str]] = None):
         """Initiates the PnadReader object
 
+        The input file information and dictionary are read from the metadata cache,
+        or downloaded concurrently, only once when both are in the same zip file.
+
         Args:
             pnad_reader_vars (PnadReadVars): PnadReadVars object to be used for creation of PnadReader
+            input_info (Optional[PnadInputInfo]): input file information already downloaded
+            for another release with the same input file
+            pnad_dict (Optional[PnadDict]): dictionary already downloaded for another
+            release with the same dictionary file
+            pool (Optional[FtpPool]): a pool of FTP connections shared with other readers
+            columns (Optional[Sequence[str]]): the variables to parse, translate and save,
+            all of them if None. The others are skipped when parsing each line
+            where (Optional[Sequence[str]]): filters like 'UF=35' or 'V2009>=18' that every
+            saved row must match, checked on the raw lines before they are parsed
         """
         self.pnad_read_vars = pnad_reader_vars
-        self.input_info = self.download_input()
-        self.pnad_dict = self.download_dictionary(self.input_info)
-        self.parse, self.pnad_cols, self.pnad_vars = self.build_parser(self.input_info)
+        config = settings()
+        self.cache = FtpCache(config.cache_path, config.cache_max_bytes, config.cache_revalidate_after) \
+            if config.cache_enabled else None
+        self.pool = pool if pool is not None else self.build_pool()
+        if input_info is None and pnad_dict is None:
+            input_info, pnad_dict = self.load_metadata()
+        self.input_info = input_info if input_info is not None else self.download_input()
+        self.pnad_dict = pnad_dict if pnad_dict is not None else self.download_dictionary(self.input_info)
+        self.projected_info = project_input(self.input_info, columns)
+        self.row_filter = RowFilter.from_expressions(where, self.input_info, self.pnad_dict) if where else None
+        self.parse, self.pnad_cols, self.pnad_vars = self.build_parser(self.projected_info)
+        # Shared by all rows, which only hold the values
+        self.schema = Schema(tuple(self.pnad_vars), tuple(self.pnad_cols))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The parser is a lambda and the pool holds sockets, rebuild them
+        # instead of pickling them (e.g. for worker processes)
+        state = self.__dict__.copy()
+        del state['parse']
+        del state['pool']
+        return state
+
+    def __setstate__(self, state:Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.pool = self.build_pool()
+        self.parse, self.pnad_cols, self.pnad_vars = self.build_parser(self.projected_info)
 
     @staticmethod
-    def get_connection() -> ftplib.FTP:
-        ftp = ftplib.FTP("ftp.ibge.gov.br")
+    def get_connection(host:Optional[str] = None, port:Optional[int] = None) -> ftplib.FTP:
+        """Connects and logs in to the FTP server, ftp.ibge.gov.br unless
+        another host and port are given or set in the [ftp] config section"""
+        ftp = ftplib.FTP()
+        ftp.connect(host or settings().ftp_host, port or settings().ftp_port)
         ftp.login()
         ftp.af = socket.AF_INET6
         return ftp
 
+    @classmethod
+    def build_pool(cls) -> FtpPool:
+        """Creates a pool of connections made by get_connection"""
+        return FtpPool(lambda: cls.get_connection(), settings().ftp_max_sessions, settings().ftp_retries)
+
+    def close(self) -> None:
+        """Closes the idle FTP connections"""
+        self.pool.close()
+
+    def run_remote(self, abspath:str, file_re:str, func:Callable[[Optional[ftplib.FTP]], T]) -> T:
+        """Runs func with a pooled FTP connection, or with None if the file
+        can be served from the cache without touching the network
+
+        Args:
+            abspath (str): absolute path to file directory in the FTP server
+            file_re (str): regex to match with the file name
+            func (Callable[[Optional[ftplib.FTP]], T]): the operation to run
+
+        Returns:
+            T: what func returns
+        """
+        if self.cache is not None and self.cache.lookup(abspath, file_re):
+            return func(None)
+        return self.pool.run(func)
+
+    @contextmanager
+    def remote_context(self, abspath:str, file_re:str,
+        context:Callable[[Optional[ftplib.FTP]], ContextManager[T]]) -> Generator[T, None, None]:
+        """Enters a context that downloads a file, holding a pooled connection only while entering it
+
+        Args:
+            abspath (str): absolute path to file directory in the FTP server
+            file_re (str): regex to match with the file name
+            context (Callable[[Optional[ftplib.FTP]], ContextManager[T]]): builds the context from a connection
+
+        Yields:
+            Generator[T, None, None]: what the context yields
+        """
+        with ExitStack() as stack:
+            yield self.run_remote(abspath, file_re, lambda ftp: stack.enter_context(context(ftp)))
+
+    def data_retriever(self) -> Retriever:
+        """Returns the function to download the data files, in ftp segments byte ranges
+        over parallel connections when they are larger than segment_min_size_mb"""
+        retrieve = segmented_retriever(self.pool, settings().ftp_segments, settings().ftp_segment_min_bytes)
+        if not PROFILER.enabled:
+            return retrieve
+        def profiled_retrieve(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+            with PROFILER.stage("ftp") as counts:
+                retrieve(ftp, abspath, filename, local_path)
+                counts.bytes = os.path.getsize(local_path)
+        return profiled_retrieve
+
+    def read_remote(self, abspath:str, file_re:str, zipped_file_re:Optional[str] = None) -> bytes:
+        """Returns the contents of a remote file, or of a file inside a remote zip
+
+        Args:
+            abspath (str): absolute path to file directory in the FTP server
+            file_re (str): regex to match with the file
+            zipped_file_re (Optional[str]): regex to match with the .zip file, if zipped
+
+        Returns:
+            bytes: The file contents
+        """
+        if zipped_file_re:
+            return self.run_remote(abspath, zipped_file_re,
+                lambda ftp: zipfile_contents_by_path(abspath, zipped_file_re, file_re, ftp, self.cache))
+        return self.run_remote(abspath, file_re, lambda ftp: file_contents_by_path(abspath, file_re, ftp, self.cache))
+
     def download_pnad(self) -> PnadData:
         """Downloads the pnad data file
 
         Returns:
-            PnadData: the file lines as a list of strings
+            PnadData: the raw file lines
+        """
+        return PnadData(list(self.iter_pnad()))
+
+    def streams_pnad(self) -> bool:
+        """Whether iter_pnad reads the data zip while it is downloaded, see stream_pnad:
+        when the pipeline is enabled and the zip is not already in the cache"""
+        file_abspath = self.pnad_read_vars.download_file_abspath
+        zipped_file_re = self.pnad_read_vars.download_zipped_file_re
+        return settings().pipeline_enabled and not (self.cache is not None and self.cache.lookup(file_abspath, zipped_file_re))
+
+    def iter_pnad(self, pipelined:Optional[bool] = None) -> Generator[bytes, None, None]:
+        """Downloads the pnad data file and yields its lines one at a time
+
+        Args:
+            pipelined (Optional[bool]): read the zip while it is downloaded with stream_pnad,
+            or only once it is downloaded and verified. As set by streams_pnad if None
+
+        Yields:
+            Generator[bytes, None, None]: the raw file lines, as ISO-8859-1 bytes
+        """
+        file_abspath = self.pnad_read_vars.download_file_abspath
+        zipped_file_re = self.pnad_read_vars.download_zipped_file_re
+        file_re = self.pnad_read_vars.download_file_re
+        member = lambda ftp: zip_member_by_path(file_abspath, zipped_file_re, file_re, ftp, self.cache,
+            self.data_retriever())
+        if pipelined is None:
+            pipelined = self.streams_pnad()
+        if pipelined:
+            yield from self.filter_lines(line for batch in self.stream_pnad() for line in batch)
+            return
+        with self.remote_context(file_abspath, zipped_file_re, member) as opened_file:
+            yield from self.filter_lines(PROFILER.iterate("decompress", opened_file, size=len))
+
+    def read_pnad(self, consume:Callable[[Iterable[bytes]], T]) -> T:
+        """Runs consume on the lines of iter_pnad, and once more on the lines of the
+        downloaded and verified zip when the streamed one turns out to be corrupted
+
+        The CRC of a streamed zip is only checked at its end, after its lines were
+        consumed, so consume must leave no output behind when it fails, like to_file.
+        Corrupted bytes may also inflate to garbage or to lines that can not be parsed
+        before the end is reached, which is handled the same way.
+
+        Args:
+            consume (Callable[[Iterable[bytes]], T]): reads all the lines, e.g. to save them
+
+        Returns:
+            T: what consume returns
+        """
+        if not self.streams_pnad():
+            return consume(self.iter_pnad(pipelined=False))
+        try:
+            return consume(self.iter_pnad(pipelined=True))
+        except (DownloadVerificationError, zipfile.BadZipFile, zlib.error, struct.error) as e:
+            logging.warning(f"The streamed data zip is corrupted ({e}), downloading it again")
+            if self.cache is not None:
+                self.cache.remove(self.pnad_read_vars.download_file_abspath, self.pnad_read_vars.download_zipped_file_re)
+        return consume(self.iter_pnad(pipelined=False))
+
+    def stream_pnad(self) -> Generator[List[bytes], None, None]:
+        """Downloads the pnad data file and yields its lines while the zip is still arriving
+
+        The download and the decompression run in their own threads, connected to each
+        other and to the caller by bounded queues of pipeline_queue_size items, so the
+        network, zlib and the parsing and writing of the caller work at the same time and
+        a slow stage holds back the ones before it. The zip is still saved to the cache.
+
+        Zips that segmented_retriever downloads in byte ranges (ftp segments above 1 and
+        at least segment_min_size_mb) are downloaded and verified first, as the ranges
+        arrive out of order, and then read from disk, so only the decompression overlaps
+        with the caller. Smaller ones, or all with a single segment, are read as they
+        arrive over a single RETR, whose CRC is checked once the whole member is read.
+
+        Yields:
+            Generator[List[bytes], None, None]: the raw lines, in batches of a decompressed block
+        """
+        file_abspath = self.pnad_read_vars.download_file_abspath
+        zipped_file_re = self.pnad_read_vars.download_zipped_file_re
+        file_re = self.pnad_read_vars.download_file_re
+        config = settings()
+        segmented = segmented_retriever(self.pool, config.ftp_segments, config.ftp_segment_min_bytes)
+        in_segments = lambda ftp, filename: is_segmented(remote_stat(ftp, filename)[0], config.ftp_segments,
+            config.ftp_segment_min_bytes)
+
+        def download(put:Callable[[bytes], None]) -> None:
+            streaming = StreamingDownload(put)
+            def retrieve_to_cache(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+                retrieve = segmented if in_segments(ftp, filename) else streaming
+                retrieve(ftp, abspath, filename, local_path)
+            def retrieve(ftp:ftplib.FTP) -> None:
+                with PROFILER.stage("ftp") as counts:
+                    if self.cache is not None:
+                        path = self.cache.fetch(file_abspath, zipped_file_re, ftp, retrieve_to_cache)
+                        if not streaming.received:
+                            # Revalidated or downloaded in segments
+                            streaming.stream_local(path)
+                    else:
+                        ftp.cwd(file_abspath)
+                        match = partial(re.match, zipped_file_re)
+                        data_file = next(filter(match, ftp.nlst()), None)
+                        if data_file is None:
+                            raise FileNotFoundError(f"No file matching {zipped_file_re} in {file_abspath}")
+                        if in_segments(ftp, data_file):
+                            with spooled_file_by_path(file_abspath, zipped_file_re, ftp, None, segmented) as path:
+                                streaming.stream_local(path)
+                        else:
+                            streaming.stream(ftp, data_file)
+                    counts.bytes = streaming.received
+            self.pool.run(retrieve)
+
+        def decompress(put:Callable[[List[bytes]], None]) -> None:
+            chunks = threaded(download, config.pipeline_queue_size, "download")
+            try:
+                for batch in line_batches(PROFILER.iterate("decompress", inflate_zip_member(chunks, file_re), size=len)):
+                    put(batch)
+            finally:
+                chunks.close()
+
+        yield from threaded(decompress, config.pipeline_queue_size, "decompress")
+
+    @contextmanager
+    def extract_pnad(self) -> Generator[str, None, None]:
+        """Downloads the pnad data file and yields the path of the unzipped file
+
+        Yields:
+            Generator[str, None, None]: the path to the raw fixed width file, removed on exit
         """
-        ftp = self.get_connection()
         file_abspath = self.pnad_read_vars.download_file_abspath
         zipped_file_re = self.pnad_read_vars.download_zipped_file_re
         file_re = self.pnad_read_vars.download_file_re
-        pnad = [line.decode('ISO-8859-1') for line in zipfile_lines_by_path(file_abspath, zipped_file_re, file_re, ftp)]
-        ftp.close()
-        return PnadData(pnad)
+        extracted = lambda ftp: zipfile_extracted_by_path(file_abspath, zipped_file_re, file_re, ftp, self.cache,
+            self.data_retriever())
+        with PROFILER.stage("extract") as counts:
+            stack = ExitStack()
+            extracted_path = stack.enter_context(self.remote_context(file_abspath, zipped_file_re, extracted))
+            counts.bytes = os.path.getsize(extracted_path)
+        with stack:
+            yield extracted_path
+
+    @contextmanager
+    def open_pnad(self) -> Generator[mmap.mmap, None, None]:
+        """Downloads the pnad data file and yields it unzipped as a memory map
+
+        Yields:
+            Generator[mmap.mmap, None, None]: the raw fixed width file as a read only memory map
+        """
+        with self.extract_pnad() as extracted_path, mmap_file(extracted_path) as mapped:
+            yield mapped
+
+    def metadata_sources(self) -> List[Tuple[str, str]]:
+        """Returns the path and regex of the remote files the input file and dictionary come from"""
+        v = self.pnad_read_vars
+        sources = [(v.input_file_abspath, v.input_zipped_file_re if v.input_is_zipped else v.input_file_re),
+            (v.dictionary_file_abspath, v.dictionary_zipped_file_re if v.dictionary_is_zipped else v.dictionary_file_re)]
+        return list(dict.fromkeys(sources))
+
+    def load_metadata(self) -> Tuple[PnadInputInfo, PnadDict]:
+        """Returns the input file information and dictionary from the metadata cache,
+        downloading and parsing them only when their remote files changed
+
+        Returns:
+            Tuple[PnadInputInfo, PnadDict]: the input file information and the dictionary
+        """
+        with PROFILER.stage("metadata"):
+            return self._load_metadata()
+
+    def _load_metadata(self) -> Tuple[PnadInputInfo, PnadDict]:
+        config = settings()
+        metadata_cache = MetadataCache(os.path.join(config.cache_path, "metadata")) if config.cache_enabled else None
+        key = None
+        if metadata_cache is not None:
+            identities = [self.run_remote(abspath, file_re, lambda ftp, abspath=abspath, file_re=file_re:
+                remote_identity(abspath, file_re, ftp, self.cache)) for abspath, file_re in self.metadata_sources()]
+            key = metadata_cache.key(identities)
+            metadata = metadata_cache.load(key)
+            if metadata is not None:
+                return metadata
+        input_file, dictionary_file = self.download_metadata_files()
+        input_info = input_info_from_file(input_file)
+        pnad_dict = pnad_dict_from_xls(dictionary_file, input_info)
+        if metadata_cache is not None:
+            metadata_cache.save(key, input_info, pnad_dict)
+        return input_info, pnad_dict
+
+    def download_metadata_files(self) -> Tuple[bytes, bytes]:
+        """Downloads the input file and the dictionary file, concurrently or
+        with a single download when both are in the same zip file
+
+        Returns:
+            Tuple[bytes, bytes]: the input file and the dictionary file contents
+        """
+        v = self.pnad_read_vars
+        if (v.input_is_zipped and v.dictionary_is_zipped and v.input_file_abspath == v.dictionary_file_abspath
+                and v.input_zipped_file_re == v.dictionary_zipped_file_re):
+            input_file, dictionary_file = self.run_remote(v.input_file_abspath, v.input_zipped_file_re,
+                lambda ftp: zipfile_members_by_path(v.input_file_abspath, v.input_zipped_file_re,
+                    [v.input_file_re, v.dictionary_file_re], ftp, self.cache))
+            return input_file, dictionary_file
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            input_future = executor.submit(self.read_remote, v.input_file_abspath, v.input_file_re,
+                v.input_zipped_file_re if v.input_is_zipped else None)
+            dictionary_file = self.read_remote(v.dictionary_file_abspath, v.dictionary_file_re,
+                v.dictionary_zipped_file_re if v.dictionary_is_zipped else None)
+            return input_future.result(), dictionary_file
 
     def download_input(self) -> PnadInputInfo:
         """Downloads the input file
@@ -227,30 +849,9 @@ class PnadReader:
         Returns:
             PnadInputInfo: input file in PnadInputInfo format
         """
-        ftp = self.get_connection()
-        file_abspath = self.pnad_read_vars.input_file_abspath
-        input_info = list()
-        if self.pnad_read_vars.input_is_zipped:
-            zipped_file_re = self.pnad_read_vars.input_zipped_file_re
-            file_re = self.pnad_read_vars.input_file_re
-            with io.BytesIO() as input_file:
-                input_file.write(zipfile_contents_by_path(file_abspath, zipped_file_re, file_re, ftp))
-                input_file.seek(0)
-                for line in input_file.readlines():
-                    if line.decode('ISO-8859-1').startswith('@'):
-                        line_data = list(filter(None,line.decode('ISO-8859-1').split()))
-                        input_info.append((line_data[0], line_data[1], int(line_data[2].strip('$.')), ' '.join(line_data[4:-1]))) # Get positions, variable name and column name
-        else:
-            file_re = self.pnad_read_vars.input_file_re
-            with io.BytesIO() as input_file:
-                input_file.write(file_contents_by_path(file_abspath, file_re, ftp))
-                input_file.seek(0)
-                for line in input_file.readlines():
-                    if line.decode('ISO-8859-1').startswith('@'):
-                        line_data = list(filter(None,line.decode('ISO-8859-1').split())) 
-                        input_info.append((line_data[0], line_data[1], int(line_data[2].strip('$.')), ' '.join(line_data[4:-1]))) # Get positions, variable name and column name
-        
-        return PnadInputInfo(input_info)
+        v = self.pnad_read_vars
+        return input_info_from_file(self.read_remote(v.input_file_abspath, v.input_file_re,
+            v.input_zipped_file_re if v.input_is_zipped else None))
 
     def download_dictionary(self, input_info:PnadInputInfo) -> PnadDict:
         """Downloads the dictionary file and prepares it for use
@@ -261,26 +862,10 @@ class PnadReader:
         Returns:
             PnadDict: the dictionary file contents as a PnadDict
         """
-        ftp = self.get_connection()
-        file_abspath = self.pnad_read_vars.dictionary_file_abspath
-        dict_lines = list()
-        pnad_dict : PnadDict
-
-        if self.pnad_read_vars.dictionary_is_zipped:
-            zipped_file_re = self.pnad_read_vars.dictionary_zipped_file_re
-            file_re = self.pnad_read_vars.dictionary_file_re
-            dict_file: bytes = zipfile_contents_by_path(file_abspath, zipped_file_re, file_re, ftp)
-        else:
-            file_re = self.pnad_read_vars.dictionary_file_re
-            dict_file: bytes = file_contents_by_path(file_abspath, file_re, ftp)
-            
-        dict_xls : xlrd.Book = xlrd.open_workbook(file_contents=dict_file, formatting_info=False)
-        dict_sheet = dict_xls.sheet_by_index(0)
-        for i in range(dict_sheet.nrows):
-            dict_lines.append([x.value for x in dict_sheet.row(i)])
-        pnad_dict = xls_to_pnad_dict(dict_lines, input_info)
-
-        return pnad_dict
+        v = self.pnad_read_vars
+        dict_file = self.read_remote(v.dictionary_file_abspath, v.dictionary_file_re,
+            v.dictionary_zipped_file_re if v.dictionary_is_zipped else None)
+        return pnad_dict_from_xls(dict_file, input_info)
 
     def build_parser(self, input_info:PnadInputInfo) -> Tuple[PnadParse, List[str], List[str]] :
         """Creates the parser based on input file information and also the columns and variables
@@ -298,16 +883,76 @@ class PnadReader:
         parser, columns, variables = parser_cols_from_input(input_info)
         return parser, columns, variables
 
-    def parse_row(self, row:str) -> Record:
+    def filter_lines(self, lines:Iterable[bytes]) -> Iterable[bytes]:
+        """Drops the raw lines that do not match the row filter, before they are parsed"""
+        if self.row_filter is None:
+            return lines
+        return filter(self.row_filter, lines)
+
+    def parse_row(self, row:bytes) -> Record:
         """Parses a single row from the pnad file
 
         Args:
-            row (str): the row to parse as a decoded string
+            row (bytes): the raw line to parse
 
         Returns:
-            Record: the parsed row as a Record
+            Record: the parsed row as a Record, with the values decoded
         """
-        return Record({col:val for col, val in zip(self.pnad_vars, self.parse(row))})
+        return Record({col:val.decode('ISO-8859-1') for col, val in zip(self.pnad_vars, self.parse(row))})
+
+    def fieldnames(self, col_names:bool = False) -> List[str]:
+        """Returns the header of the saved rows
+
+        Args:
+            col_names (bool): substitute the variables for their descriptions
+        """
+        return self.schema.header(col_names, settings().convert_ascii)
+
+    def row_builder(self, tvars:List[str], col_names:bool = False,
+        convert_ascii:Optional[bool] = None) -> RowBuilder:
+        """Compiles the dictionary once into a callable that turns a line into its final row,
+        the same as parse_row, translate_record and transform would
+
+        Args:
+            tvars (List[str]): the variables to translate to string values
+            col_names (bool): substitute the variables for their descriptions in the header
+            convert_ascii (Optional[bool]): convert the header and values to ASCII, as in the config if None
+
+        Returns:
+            RowBuilder: a callable from a decoded line to a Row
+        """
+        convert_ascii = settings().convert_ascii if convert_ascii is None else convert_ascii
+        return RowBuilder(self.parse, self.schema, self.pnad_dict, tvars, col_names, convert_ascii)
+
+    def dictionary_labels(self, builder:RowBuilder) -> List[Optional[List[str]]]:
+        """Returns the labels of the columns dictionary encoded in parquet and arrow files
+
+        Only the categorical variables are encoded. Numeric ones, like ages or incomes,
+        whose only code in the dictionary is the blank one, are saved as plain strings,
+        as most of their values are not labels and would grow the dictionary with each one.
+
+        Args:
+            builder (RowBuilder): the builder of the saved rows, see row_builder
+
+        Returns:
+            List[Optional[List[str]]]: the labels of each column, None for the plain ones
+        """
+        from src.columnar import numeric_vars_from_dict
+        numeric_vars = numeric_vars_from_dict(self.pnad_dict, IDENTIFIER_VARS)
+        return [None if var in numeric_vars else labels for var, labels in zip(self.schema.header(), builder.labels)]
+
+    def rows_from_lines(self, lines:Iterable[bytes], tvars:List[str]) -> Iterator[Row]:
+        """Turns raw lines into their final rows, lazily, with row_builder
+
+        Args:
+            lines (Iterable[bytes]): the raw lines of the file
+            tvars (List[str]): the variables to translate to string values
+
+        Returns:
+            Iterator[Row]: the rows ready to be saved
+        """
+        builder = self.row_builder(tvars)
+        return PROFILER.map("translate", builder.build, PROFILER.map("parse", builder.parse, lines))
 
     def translate_record(self, record:Record, tvars:List[str]) -> Record:
         """Translates codes to human readable strings
@@ -328,44 +973,225 @@ class PnadReader:
                 d.update({variable : value.strip(' .')})
         return Record(d)
 
-    def var_to_name_record(self, record: Record) -> Record:
-        """Substitutes variables for their correspondent description"""
-        return Record({col:val for col, val in zip(self.pnad_cols, record.values())})
+    def parse_columns(self, buffer:Any, numeric:bool = False) -> Dict[str, Any]:
+        """Parses the whole raw pnad file at once into NumPy columns
 
-    @staticmethod
-    def to_ascii(record: Record) -> Record:
-        """Converts record keys and values to ASCII
+        Args:
+            buffer (Any): the raw fixed width file, e.g. the memory map from open_pnad
+            numeric (bool): convert variables without coded categories to floats,
+            with blanks as NaN
+
+        Returns:
+            Dict[str, Any]: a NumPy array per variable
+        """
+        from src import columnar
+        data = columnar.parse_buffer(buffer, self.projected_info)
+        if self.row_filter is not None:
+            data = data[self.row_filter.mask(buffer)]
+        numeric_vars = columnar.numeric_vars_from_dict(self.pnad_dict, IDENTIFIER_VARS) if numeric else ()
+        return columnar.to_columns(data, numeric_vars)
+
+    def translate_columns(self, columns:Dict[str, Any], tvars:List[str]) -> Dict[str, Any]:
+        """Decodes and translates raw NumPy columns, like translate_record does for a record
 
         Args:
-            redord (Record): a record to format as ASCII
+            columns (Dict[str, Any]): the columns from parse_columns
+            tvars (List[str]): the variables to translate to string values
 
         Returns:
-            Record: the new record
+            Dict[str, Any]: the decoded columns, numeric columns are kept as they are
         """
-        return Record({k.translate(ASCII_CHARS):v.translate(ASCII_CHARS) for k, v in record.items()})
+        from src import columnar
+        tvars = set(tvars)
+        return {var : columnar.translate_column(col, self.pnad_dict[var], var in tvars) if col.dtype.kind == 'S' else col
+            for var, col in columns.items()}
 
-    @staticmethod
-    def insert_uf_abrev_from_number(record:Record):
-        """Inserts inplace a new column containing the uf abreviations from UF codes
+    def iter_columnar_rows(self, buffer:Any, tvars:List[str], chunk_size:int = 100000) -> Generator[Row, None, None]:
+        """Parses and translates the raw file with the NumPy engine and yields the rows as tuples
 
         Args:
-            record (Record): a record to insert the new column
+            buffer (Any): the raw fixed width file, e.g. the memory map from open_pnad
+            tvars (List[str]): the variables to translate to string values
+            chunk_size (int): the number of rows turned into Python objects at a time
+
+        Yields:
+            Generator[Row, None, None]: the same values as parse_row followed by translate_record
         """
-        record.update({"UF_ABREV" : STATES_ABREV[record['UF']]})
+        from src import columnar
+        with PROFILER.stage("parse") as counts:
+            columns = self.parse_columns(buffer)
+            counts.rows, counts.bytes = len(next(iter(columns.values()), ())), len(buffer)
+        with PROFILER.stage("translate") as counts:
+            columns = self.translate_columns(columns, tvars)
+            counts.rows = len(next(iter(columns.values()), ()))
+        yield from PROFILER.iterate("to_rows", columnar.columns_to_rows(columns, chunk_size))
 
     @staticmethod
-    def insert_uf_abrev_from_name(record:Record) -> Record:
-        """Inserts inplace a new column containing the uf abbreviations from UF names
+    def row_to_ascii(row:Row) -> Row:
+        """Converts the values of a row to ASCII
 
         Args:
-            record (Record): the record to insert
+            row (Row): a row to format as ASCII
+
+        Returns:
+            Row: the new row
         """
-        record.update({"UF_ABREV" : STATES_ABREV_ASCII_NAMES[record['UF'].lower().translate(ASCII_CHARS)]})
+        return tuple(value.translate(ASCII_CHARS) for value in row)
+
+    def append_uf_abrev(self, row:Row) -> Row:
+        """Appends the uf abbreviation of the UF name of a row
+
+        Args:
+            row (Row): the translated row
 
-    def to_file(self, pnad:List[Record], save_path:str = SAVE_PATH) -> None:
+        Returns:
+            Row: the row followed by its UF_ABREV
+        """
+        return (*row, uf_abrev_from_name(row[self.schema.uf_idx]))
+
+    def transform(self, pnad:Iterable[Row]) -> Iterable[Row]:
+        """Applies the final transformations to translated rows, lazily
+
+        Substituting the variables for their descriptions only changes the header,
+        see fieldnames.
+
+        Args:
+            pnad (Iterable[Row]): the translated rows, in variable order
+
+        Returns:
+            Iterable[Row]: the rows ready to be saved
+        """
+        if settings().convert_ascii:
+            pnad = PROFILER.map("ascii", self.row_to_ascii, pnad)
+        if self.schema.uf_idx is None:
+            return pnad
+        # Append a column with the UF abreviations
+        return PROFILER.map("uf_abrev", self.append_uf_abrev, pnad)
+
+    def default_weight(self) -> str:
+        """Returns the survey weight of the release: V1032 for the yearly visits and quarters, V1028 for the quarterly ones"""
+        return YEARLY_WEIGHT if '/Anual/' in self.pnad_read_vars.download_file_abspath else QUARTERLY_WEIGHT
+
+    def aggregate(self, group_by:Sequence[str], weight:Optional[str] = None, measures:Sequence[str] = (),
+        engine:str = "python") -> WeightedAggregator:
+        """Streams the pnad file once and computes grouped weighted counts, sums and
+        means, without saving the microdata. Rows are checked against the row filter
+        and only the group, weight and measure variables are parsed
+
+        Args:
+            group_by (Sequence[str]): the variables to group by, e.g. UF, Capital or RM_RIDE
+            weight (Optional[str]): the survey weight variable, the one of the release (see default_weight) if None
+            measures (Sequence[str]): the numeric variables to sum and average, e.g. VD4020
+            engine (str): "python" (line by line from the zip) or "numpy" (whole file at once)
+
+        Raises:
+            PnadVariableNotFound: a variable is not in the input file
+
+        Returns:
+            WeightedAggregator: the totals of each group, see its header and table
+        """
+        weight = weight or self.default_weight()
+        input_info = project_input(self.input_info, list(dict.fromkeys([*group_by, weight, *measures])))
+        parse, _, variables = self.build_parser(input_info)
+        if engine == "numpy":
+            from src import columnar
+            aggregator = WeightedAggregator(variables, group_by, weight, measures)
+            with self.open_pnad() as buffer, PROFILER.stage("aggregate") as counts:
+                data = columnar.parse_buffer(buffer, input_info)
+                if self.row_filter is not None:
+                    data = data[self.row_filter.mask(buffer)]
+                counts.rows, counts.bytes = len(data), len(buffer)
+                aggregator.merge(aggregate_columns(data, group_by, weight, measures))
+                del data
+            return aggregator
+        # Only the few projected fields are decoded
+        parse_decoded = lambda line: [value.decode('ISO-8859-1') for value in parse(line)]
+        def aggregate_lines(lines:Iterable[bytes]) -> WeightedAggregator:
+            # Started over if the streamed zip is read again
+            aggregator = WeightedAggregator(variables, group_by, weight, measures)
+            aggregator.add_all(PROFILER.map("parse", parse_decoded, lines))
+            return aggregator
+        return self.read_pnad(aggregate_lines)
+
+    def aggregate_table(self, aggregator:WeightedAggregator, tvars:Sequence[str] = ()) -> List[Row]:
+        """Returns the table of an aggregation with the group values in tvars translated like translate_record"""
+        group_by = aggregator.group_by
+        translate_key = lambda key: tuple(self.translate_record(Record(dict(zip(group_by, key))), tvars).values())
+        return aggregator.table(translate_key)
+
+    def save_aggregate(self, aggregator:WeightedAggregator, tvars:Sequence[str] = (), save_path:str = SAVE_PATH) -> Part:
+        """Saves the table of an aggregation to <save_filename>_aggregate.csv
+
+        Returns:
+            Part: the saved file with its number of rows and checksum
+        """
+        path = os.path.join(save_path, f"{self.pnad_read_vars.save_filename}_aggregate.csv")
+        logging.info(f"Saving {len(aggregator.totals)} groups to {os.path.basename(path)}")
+        return write_csv(path, aggregator.header, self.aggregate_table(aggregator, tvars), "none")
+
+    def save_extracted(self, path:str, tvars:List[str], col_names:bool = False, engine:str = "python",
+        file_format:str = "csv", save_path:str = SAVE_PATH, partition_by:Sequence[str] = ()) -> None:
+        """Parses, transforms and saves an already unzipped pnad data file
+
+        Args:
+            path (str): the path to the raw fixed width file, e.g. from extract_pnad
+            tvars (List[str]): the variables to translate to string values
+            col_names (bool): substitute the variables for their descriptions
+            engine (str): "python" or "numpy"
+            file_format (str): "csv", "parquet", "arrow" or "sqlite"
+            save_path (str): the directory to save the file
+            partition_by (Sequence[str]): the variables to partition the output by, see to_file
+        """
+        if engine == "numpy":
+            with mmap_file(path) as buffer:
+                pnad = self.transform(self.iter_columnar_rows(buffer, tvars))
+                self.to_file(pnad, save_path, file_format, tvars, col_names, partition_by)
+        else:
+            with open(path, 'rb') as f:
+                pnad = self.rows_from_lines(self.filter_lines(f), tvars)
+                self.to_file(pnad, save_path, file_format, tvars, col_names, partition_by)
+
+    def to_file(self, pnad:Iterable[Row], save_path:str = SAVE_PATH, file_format:str = "csv",
+        tvars:Sequence[str] = (), col_names:bool = False, partition_by:Sequence[str] = ()) -> None:
         """Saves the pnad downloaded data to specified file
 
         Args:
-            pnad (List[Record]): the parsed pnad data
+            pnad (Iterable[Row]): the transformed pnad rows, consumed as a stream
+            save_path (str): the directory to save the file
+            file_format (str): "csv", "parquet", "arrow" or "sqlite"
+            tvars (Sequence[str]): the translated variables, dictionary encoded in parquet and arrow
+            and saved as text in sqlite
+            col_names (bool): substitute the variables for their descriptions in the header
+            partition_by (Sequence[str]): save csv, parquet or arrow parts in Hive style
+            directories by the values of these variables, e.g. <save_filename>/UF_ABREV=SP/part-0.csv
+
+        Raises:
+            PnadVariableNotFound: a partition variable is not among the saved columns
         """
-        records_to_csv(save_path, self.pnad_read_vars.save_filename, pnad)
\ No newline at end of file
+        filename = self.pnad_read_vars.save_filename
+        if partition_by:
+            from src.partition import rows_to_partitions
+            variables = self.schema.header()
+            missing = [var for var in partition_by if var not in variables]
+            if missing:
+                raise PnadVariableNotFound(f"Can not partition by {', '.join(missing)}, they are not among the saved columns")
+            builder = self.row_builder(list(tvars), col_names)
+            labels = self.dictionary_labels(builder) if file_format != "csv" else None
+            parts = rows_to_partitions(save_path, filename, builder.fieldnames, variables, partition_by, pnad,
+                file_format, labels, settings().compression, settings().compression_level,
+                settings().max_open_files, settings().part_size_bytes)
+        elif file_format == "csv":
+            with staged_directory(save_path) as staging:
+                parts = rows_to_csv(staging, filename, self.fieldnames(col_names), pnad)
+        elif file_format == "sqlite":
+            from src.sqlite_writer import rows_to_sqlite
+            parts = [rows_to_sqlite(save_path, filename, self.fieldnames(col_names), self.schema.header(),
+                self.input_info, self.pnad_dict, pnad, tvars, settings().max_lines)]
+        else:
+            from src.arrow_writer import rows_to_arrow
+            builder = self.row_builder(list(tvars), col_names)
+            with staged_directory(save_path) as staging:
+                parts = [rows_to_arrow(staging, filename, builder.fieldnames, self.dictionary_labels(builder), pnad,
+                    file_format, settings().max_lines)]
+        write_manifest(os.path.join(save_path, f"{filename}_manifest.json"), parts, self.fieldnames(col_names),
+            file_format, settings().compression, partition_by)
\ No newline at end of file
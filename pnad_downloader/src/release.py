@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+from src import PnadReadVars
+from src.anual import build_pnad_anual_trimestre, build_pnad_anual_visita
+from src.trimestral import build_pnad_trimestral
+
+@dataclass(frozen=True)
+class Release:
+    """A single pnad release: a quarter or a visit of a year"""
+
+    year: int
+    quarter: Optional[int] = None
+    visit: Optional[int] = None
+    yearly: bool = False
+
+    def read_vars(self) -> PnadReadVars:
+        if self.visit:
+            return build_pnad_anual_visita(self.year, self.visit)
+        if self.yearly:
+            return build_pnad_anual_trimestre(self.year, self.quarter)
+        return build_pnad_trimestral(self.year, self.quarter)
+
+    def __str__(self) -> str:
+        return self.read_vars().save_filename
+
+def parse_range(text:str) -> List[int]:
+    """Parses ranges like '2012-2024' or '1,3-4' into a list of numbers"""
+    numbers: List[int] = list()
+    for part in filter(None, text.split(',')):
+        if '-' in part:
+            start, end = part.split('-')
+            numbers.extend(range(int(start), int(end) + 1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+def releases_from_ranges(years:List[int], quarters:List[int] = (), visits:List[int] = (),
+    yearly:bool = False) -> List[Release]:
+    """Returns every release for the combination of years and quarters or visits"""
+    releases = [Release(year, quarter=quarter, yearly=yearly) for year in years for quarter in quarters]
+    releases += [Release(year, visit=visit) for year in years for visit in visits]
+    return releases
@@ -0,0 +1,162 @@
+import logging
+import os
+import sqlite3
+import tempfile
+from typing import Iterable, List, Optional, Sequence
+
+from src import PnadDict, PnadInputInfo, Row
+from src.metrics import PROFILER
+from src.output import Part, describe_part
+from src.utils import ichunks
+
+# Rows inserted per transaction when MAX_LINES is not set
+DEFAULT_BATCH_SIZE = 100000
+
+# The table of the rows, the description of its columns and the labels of the codes
+DATA_TABLE = "pnad"
+VARIABLES_TABLE = "variables"
+LABELS_TABLE = "labels"
+
+# Indexes built after the load, when all their variables are saved
+INDEXED_VARIABLES = [["UF"], ["UPA"], ["UPA", "V1008", "V1014"]]
+
+# Variables saved as text even when not translated, so the keys keep their leading zeros
+TEXT_VARIABLES = {'UPA', 'Estrato', 'V1008', 'V1014', 'V2003', 'posest', 'UF_ABREV'}
+
+# Loading is done in a temporary file that replaces the database at the end,
+# so the rollback journal and the syncs to disk are not needed
+LOADING_PRAGMAS = ["PRAGMA journal_mode = OFF", "PRAGMA synchronous = OFF", "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY", "PRAGMA cache_size = -262144"]
+
+def quote(identifier:str) -> str:
+    """Quotes a table or column name, which may be a variable description with spaces"""
+    return '"' + identifier.replace('"', '""') + '"'
+
+def column_type(variable:str, translated:bool) -> str:
+    """Returns the type of a column: text for labels and keys, numeric for the others,
+    which stores codes and amounts as integers or reals and keeps anything else as text"""
+    return "TEXT" if translated or variable in TEXT_VARIABLES else "NUMERIC"
+
+def create_table_sql(fieldnames:Sequence[str], types:Sequence[str], descriptions:Sequence[str]) -> str:
+    """Returns the CREATE TABLE of the rows, with the description of each column as a comment"""
+    columns = list()
+    for i, (name, column_type, description) in enumerate(zip(fieldnames, types, descriptions)):
+        separator = ',' if i < len(fieldnames) - 1 else ''
+        columns.append(f"    {quote(name)} {column_type}{separator} -- {' '.join(description.split())}")
+    return f"CREATE TABLE {quote(DATA_TABLE)} (\n" + '\n'.join(columns) + "\n)"
+
+class SqliteRecordWriter:
+    """Bulk loads rows into a new SQLite database
+
+    The database has the rows in a typed table, a table with the position, width and
+    description of each variable and a table with the labels of the codes of the
+    dictionary. Rows are inserted with executemany in one transaction per batch and
+    the indexes are only built when the load is finished.
+    """
+
+    def __init__(self, path:str, fieldnames:Sequence[str], variables:Sequence[str], input_info:PnadInputInfo,
+        pnad_dict:PnadDict, tvars:Sequence[str] = ()):
+        """Initiates the SqliteRecordWriter object
+
+        Args:
+            path (str): the path of the database, replaced when the writer is closed
+            fieldnames (Sequence[str]): the output column names
+            variables (Sequence[str]): the variable of each column, e.g. UF for its description
+            input_info (PnadInputInfo): the input file information, for the variables table
+            pnad_dict (PnadDict): the dictionary, for the labels table
+            tvars (Sequence[str]): the translated variables, the ones with labels are saved as text
+        """
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.variables = list(variables)
+        info = {var: (int(position.strip('@')), width, description) for position, var, width, description in input_info}
+        descriptions = [info[var][2] if var in info else "Sigla da UF" for var in self.variables]
+        # Only variables with labels are changed by the translation, the others keep their numbers
+        translated = {var for var in tvars if pnad_dict.get(var)}
+        types = [column_type(var, var in translated) for var in self.variables]
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(fd)
+        self.connection = sqlite3.connect(self.tmp_path, isolation_level=None)
+        for pragma in LOADING_PRAGMAS:
+            self.connection.execute(pragma)
+        self.connection.execute("BEGIN")
+        self.connection.execute(create_table_sql(self.fieldnames, types, descriptions))
+        self.connection.execute(f"CREATE TABLE {VARIABLES_TABLE} (variable TEXT PRIMARY KEY, column_name TEXT, "
+            "position INTEGER, width INTEGER, description TEXT, type TEXT, translated INTEGER)")
+        self.connection.executemany(f"INSERT INTO {VARIABLES_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(var, name, *(info[var][:2] if var in info else (None, 2)), description, column_type, int(var in translated))
+            for var, name, description, column_type in zip(self.variables, self.fieldnames, descriptions, types)])
+        # Numeric codes, so the labels can be joined on the columns that were not translated
+        self.connection.execute(f"CREATE TABLE {LABELS_TABLE} (variable TEXT, code NUMERIC, label TEXT, "
+            "PRIMARY KEY (variable, code)) WITHOUT ROWID")
+        self.connection.executemany(f"INSERT OR IGNORE INTO {LABELS_TABLE} VALUES (?, ?, ?)",
+            ((var, code.strip(), label) for var in self.variables for code, label in pnad_dict.get(var, {}).items()))
+        self.connection.execute("COMMIT")
+        self.insert = f"INSERT INTO {quote(DATA_TABLE)} VALUES ({', '.join('?' * len(self.fieldnames))})"
+
+    def write(self, rows:Sequence[Row]) -> None:
+        """Inserts a batch of rows in one transaction, with blanks as NULL"""
+        self.connection.execute("BEGIN")
+        self.connection.executemany(self.insert, ([value if value != '' else None for value in row] for row in rows))
+        self.connection.execute("COMMIT")
+
+    def create_indexes(self) -> None:
+        """Indexes UF, UPA and the household key, when their variables are saved"""
+        for index_vars in INDEXED_VARIABLES:
+            if not all(var in self.variables for var in index_vars):
+                continue
+            columns = ', '.join(quote(self.fieldnames[self.variables.index(var)]) for var in index_vars)
+            self.connection.execute(f"CREATE INDEX {quote('idx_' + '_'.join(index_vars))} ON {quote(DATA_TABLE)} ({columns})")
+        self.connection.execute("ANALYZE")
+
+    def close(self) -> None:
+        """Builds the indexes and moves the database to its path"""
+        try:
+            self.create_indexes()
+        finally:
+            self.connection.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self.connection.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self) -> "SqliteRecordWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def rows_to_sqlite(path:str, filename:str, fieldnames:Sequence[str], variables:Sequence[str],
+    input_info:PnadInputInfo, pnad_dict:PnadDict, rows:Iterable[Row], tvars:Sequence[str] = (),
+    batch_size:Optional[int] = None) -> Part:
+    """Bulk loads rows into <filename>.sqlite, see SqliteRecordWriter
+
+    Args:
+        path (str): the absolute path to the directory to save the database
+        filename (str): the filename to be saved, without extension
+        fieldnames (Sequence[str]): the output column names
+        variables (Sequence[str]): the variable of each column
+        input_info (PnadInputInfo): the input file information
+        pnad_dict (PnadDict): the dictionary
+        rows (Iterable[Row]): the data as an iterable of rows in fieldnames order
+        tvars (Sequence[str]): the translated variables
+        batch_size (Optional[int]): rows per transaction (MAX_LINES)
+
+    Returns:
+        Part: the written database with its number of rows and checksum
+    """
+    file_path = os.path.join(path, f"{filename}.sqlite")
+    logging.info(f"Saving to {os.path.basename(file_path)}")
+    rows_written = 0
+    with SqliteRecordWriter(file_path, fieldnames, variables, input_info, pnad_dict, tvars) as writer:
+        for chunk in ichunks(rows, batch_size or DEFAULT_BATCH_SIZE):
+            batch: List[Row] = list(chunk)
+            with PROFILER.stage("write") as counts:
+                writer.write(batch)
+                counts.rows = len(batch)
+            rows_written += len(batch)
+    return describe_part(file_path, rows_written)
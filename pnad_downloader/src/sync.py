@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import ftplib
+from functools import partial
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src import SAVE_PATH, PnadReadVars, settings
+from src.batch import Release, ReleaseResult, run_batch
+from src.cache import FtpCache
+from src.ftp import FtpPool, file_identity, remote_stat
+from src.reader import PnadReader
+
+# Bump when the layout of the manifest changes, older manifests are then ignored
+MANIFEST_VERSION = 1
+
+Source = Tuple[str, str]
+
+def release_sources(read_vars:PnadReadVars) -> List[Source]:
+    """Returns the path and regex of the remote files a release is made from:
+    its data zip and the files of its input file and dictionary"""
+    v = read_vars
+    sources = [(v.download_file_abspath, v.download_zipped_file_re),
+        (v.input_file_abspath, v.input_zipped_file_re if v.input_is_zipped else v.input_file_re),
+        (v.dictionary_file_abspath, v.dictionary_zipped_file_re if v.dictionary_is_zipped else v.dictionary_file_re)]
+    return list(dict.fromkeys(sources))
+
+def list_directory(ftp:ftplib.FTP, abspath:str) -> List[str]:
+    """Returns the names in a remote directory, none if it does not exist yet"""
+    try:
+        ftp.cwd(abspath)
+        return ftp.nlst()
+    except ftplib.error_perm:
+        # Missing directories (e.g. a year not published yet) and empty ones
+        return []
+
+def stat_file(ftp:ftplib.FTP, abspath:str, filename:str) -> str:
+    ftp.cwd(abspath)
+    return file_identity(abspath, filename, *remote_stat(ftp, filename))
+
+def remote_identities(pool:FtpPool, sources:Sequence[Source], threads:Optional[int] = None) -> Dict[Source, Optional[str]]:
+    """Walks the remote directories of the sources and returns the identity of
+    the file matching each one, None for the ones that are not on the server
+
+    Each directory is listed once and each file is checked once with SIZE and MDTM,
+    however many releases share them, over up to threads pooled connections.
+
+    Args:
+        pool (FtpPool): the pool of FTP connections
+        sources (Sequence[Source]): the path and regex of each remote file
+        threads (Optional[int]): the number of concurrent FTP operations, max_sessions if None
+
+    Returns:
+        Dict[Source, Optional[str]]: the identity, as in remote_identity, of each source
+    """
+    threads = settings().ftp_max_sessions if threads is None else threads
+    directories = list(dict.fromkeys(abspath for abspath, _ in sources))
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        listings = dict(zip(directories, executor.map(
+            lambda abspath: pool.run(partial(list_directory, abspath=abspath)), directories)))
+        filenames = {(abspath, file_re): next(filter(partial(re.match, file_re), listings[abspath]), None)
+            for abspath, file_re in sources}
+        files = list(dict.fromkeys((abspath, name) for (abspath, _), name in filenames.items() if name is not None))
+        stats = dict(zip(files, executor.map(
+            lambda file: pool.run(partial(stat_file, abspath=file[0], filename=file[1])), files)))
+    return {source: stats[(source[0], name)] if name is not None else None for source, name in filenames.items()}
+
+def load_manifest(path:str) -> Dict[str, Any]:
+    """Returns the releases already processed, from the manifest saved by save_manifest"""
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+    if manifest.get('version') != MANIFEST_VERSION:
+        logging.warning(f"Ignoring sync manifest {path} of another version")
+        return dict()
+    return manifest['releases']
+
+def save_manifest(path:str, releases:Dict[str, Any]) -> None:
+    # Replace atomically so an interrupted sync never leaves a partial manifest
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, 'w', encoding="utf-8") as f:
+        json.dump({'version': MANIFEST_VERSION, 'releases': releases}, f, indent=2)
+    os.replace(tmp_path, path)
+
+@dataclass
+class SyncPlan:
+    """What a sync found on the server, compared to the manifest"""
+
+    changed: List[Release] = field(default_factory=list)
+    unchanged: List[Release] = field(default_factory=list)
+    missing: List[Release] = field(default_factory=list)
+    identities: Dict[Release, List[str]] = field(default_factory=dict)
+
+def plan_sync(releases:Sequence[Release], manifest:Dict[str, Any], options:Dict[str, Any],
+    identities:Dict[Source, Optional[str]]) -> SyncPlan:
+    """Splits the releases in the ones to process again, the ones that did not change
+    and the ones that are not on the server
+
+    A release changes when the identity (name, size and MDTM) of its data zip or
+    of its input file and dictionary changed, or when it was saved with other options.
+
+    Args:
+        releases (Sequence[Release]): the releases to sync
+        manifest (Dict[str, Any]): the releases already processed, from load_manifest
+        options (Dict[str, Any]): the options that change the saved files
+        identities (Dict[Source, Optional[str]]): the remote files, from remote_identities
+    """
+    plan = SyncPlan()
+    for release in releases:
+        release_identities = [identities[source] for source in release_sources(release.read_vars())]
+        if None in release_identities:
+            plan.missing.append(release)
+            continue
+        plan.identities[release] = release_identities
+        entry = manifest.get(str(release))
+        if entry is not None and entry['sources'] == release_identities and entry['options'] == options:
+            plan.unchanged.append(release)
+        else:
+            plan.changed.append(release)
+    return plan
+
+def run_sync(releases:List[Release], manifest_path:str, translate:bool = False, col_names:bool = False,
+    engine:str = "python", file_format:str = "csv", downloads:int = 2, workers:int = 2, save_path:str = SAVE_PATH,
+    columns:Optional[Sequence[str]] = None, where:Optional[Sequence[str]] = None,
+    dry_run:bool = False) -> Tuple[SyncPlan, List[ReleaseResult]]:
+    """Processes only the releases that are new or changed on the server since the last sync
+
+    The releases that are processed successfully are recorded in the manifest,
+    so a failed one is tried again in the next sync.
+
+    Args:
+        releases (List[Release]): the releases to sync, the ones not published yet are skipped
+        manifest_path (str): the JSON file with the releases already processed
+        translate, col_names, engine, file_format, downloads, workers, save_path, columns, where:
+        the same as in run_batch
+        dry_run (bool): only report what would be processed
+
+    Returns:
+        Tuple[SyncPlan, List[ReleaseResult]]: the plan and the result of each processed release
+    """
+    config = settings()
+    options = {'translate': translate, 'col_names': col_names, 'file_format': file_format,
+        'columns': list(columns) if columns else None, 'where': list(where) if where else None,
+        'convert_ascii': config.convert_ascii, 'max_lines': config.max_lines, 'compression': config.compression}
+    manifest = load_manifest(manifest_path)
+    pool = PnadReader.build_pool()
+    try:
+        sources = list(dict.fromkeys(source for release in releases for source in release_sources(release.read_vars())))
+        identities = remote_identities(pool, sources)
+    finally:
+        pool.close()
+    plan = plan_sync(releases, manifest, options, identities)
+    logging.info(f"{len(plan.changed)} releases to process, {len(plan.unchanged)} unchanged, "
+        f"{len(plan.missing)} not on the server")
+    for release in plan.changed:
+        logging.info(f"{'Would process' if dry_run else 'Processing'} {release}")
+    if dry_run or not plan.changed:
+        return plan, []
+
+    if config.cache_enabled:
+        # Cached copies within the revalidation window would hide the new files
+        cache = FtpCache(config.cache_path, config.cache_max_bytes, config.cache_revalidate_after)
+        for source in dict.fromkeys(source for release in plan.changed for source in release_sources(release.read_vars())):
+            cache.expire(*source)
+    results = run_batch(plan.changed, translate, col_names, engine, file_format, downloads, workers,
+        save_path, columns, where)
+    synced = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    for result in results:
+        if result.ok:
+            manifest[str(result.release)] = {'sources': plan.identities[result.release], 'options': options,
+                'synced': synced}
+    save_manifest(manifest_path, manifest)
+    return plan, results
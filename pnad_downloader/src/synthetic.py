@@ -0,0 +1,201 @@
+from dataclasses import dataclass
+import io
+import os
+import random
+from typing import Dict, List, Optional
+import zipfile
+
+from src import PnadReadVars
+from src.anual import build_pnad_anual_trimestre, build_pnad_anual_visita
+from src.trimestral import build_pnad_trimestral
+from src.utils import STATES_ABREV
+
+UF_NAMES = {
+    11: 'Rondônia', 12: 'Acre', 13: 'Amazonas', 14: 'Roraima', 15: 'Pará', 16: 'Amapá', 17: 'Tocantins',
+    21: 'Maranhão', 22: 'Piauí', 23: 'Ceará', 24: 'Rio Grande do Norte', 25: 'Paraíba', 26: 'Pernambuco',
+    27: 'Alagoas', 28: 'Sergipe', 29: 'Bahia', 31: 'Minas Gerais', 32: 'Espírito Santo', 33: 'Rio de Janeiro',
+    35: 'São Paulo', 41: 'Paraná', 42: 'Santa Catarina', 43: 'Rio Grande do Sul', 50: 'Mato Grosso do Sul',
+    51: 'Mato Grosso', 52: 'Goiás', 53: 'Distrito Federal'
+}
+
+@dataclass
+class SyntheticVariable:
+    """A variable of the synthetic files
+
+    Coded variables have codes, the others are numbers with decimals digits
+    after the point, blank in a blank_ratio of the rows.
+    """
+
+    name: str
+    width: int
+    description: str
+    codes: Optional[Dict[int, str]] = None
+    decimals: int = 0
+    blank_ratio: float = 0.0
+
+def synthetic_variables(extra:int = 0) -> List[SyntheticVariable]:
+    """Returns the variables of the synthetic files: the ones the reader handles
+    specially, some usual ones and extra coded variables, to get closer to the
+    200+ variables of the real files
+
+    Args:
+        extra (int): the number of extra coded variables
+    """
+    variables = [
+        SyntheticVariable('Ano', 4, 'Ano de referência'),
+        SyntheticVariable('Trimestre', 1, 'Trimestre de referência'),
+        SyntheticVariable('UF', 2, 'Unidade da Federação', UF_NAMES),
+        SyntheticVariable('Capital', 2, 'Município da Capital',
+            {uf: f'Município de {name} ({STATES_ABREV[uf]})' for uf, name in UF_NAMES.items()}, blank_ratio=0.7),
+        SyntheticVariable('RM_RIDE', 2, 'Reg. Metr. e Reg. Adm. Int. Des.',
+            {35: 'Região Metropolitana de São Paulo (SP)', 33: 'Região Metropolitana do Rio de Janeiro (RJ)'}, blank_ratio=0.8),
+        SyntheticVariable('UPA', 9, 'Unidade Primária de Amostragem'),
+        SyntheticVariable('Estrato', 7, 'Estrato'),
+        SyntheticVariable('V1008', 2, 'Número de seleção do domicílio'),
+        SyntheticVariable('V1014', 2, 'Painel'),
+        SyntheticVariable('V1016', 1, 'Número da entrevista no domicílio'),
+        SyntheticVariable('V1022', 1, 'Situação do domicílio', {1: 'Urbana', 2: 'Rural'}),
+        SyntheticVariable('V1028', 15, 'Peso do domicílio e das pessoas', decimals=8),
+        SyntheticVariable('V2003', 2, 'Número de ordem'),
+        SyntheticVariable('V2007', 1, 'Sexo', {1: 'Homem', 2: 'Mulher'}),
+        SyntheticVariable('V2009', 3, 'Idade do morador na data de referência'),
+        SyntheticVariable('V2010', 1, 'Cor ou raça',
+            {1: 'Branca', 2: 'Preta', 3: 'Amarela', 4: 'Parda', 5: 'Indígena', 9: 'Ignorado'}),
+        SyntheticVariable('VD4020', 8, 'Rendimento mensal efetivo de todos os trabalhos', blank_ratio=0.4),
+    ]
+    for i in range(extra):
+        variables.append(SyntheticVariable(f'V9{i:03d}', 1, f'Quesito sintético {i}',
+            {1: 'Sim', 2: 'Não', 3: 'Não sabe'}, blank_ratio=0.2))
+    return variables
+
+def input_file(variables:List[SyntheticVariable]) -> bytes:
+    """Returns an input file with the '@' position, name, width and description of each variable"""
+    lines = ['cards']
+    position = 1
+    for var in variables:
+        width = f"{var.width}." if var.codes is None and var.name not in ('UPA', 'Estrato') else f"${var.width}."
+        lines.append(f"@{position:04d}   {var.name}   {width}   /* {var.description} */")
+        position += var.width
+    lines.append(';')
+    return ('\r\n'.join(lines) + '\r\n').encode('ISO-8859-1')
+
+def dictionary_file(variables:List[SyntheticVariable]) -> bytes:
+    """Returns an .xls dictionary in the layout read by xls_to_pnad_dict"""
+    import xlwt
+    book = xlwt.Workbook()
+    sheet = book.add_sheet('dicionário')
+    rows: List[List] = [['Dicionário das variáveis da PNAD Contínua'], [],
+        ['Posição Inicial', 'Tamanho', 'Código da variável', 'Quesito', '', 'Categorias', ''], ['', '', '', 'nº', 'descrição', 'Tipo', 'Descrição']]
+    position = 1
+    for var in variables:
+        first = [position, var.width, var.name, '', var.description]
+        if var.codes:
+            for i, (code, label) in enumerate(var.codes.items()):
+                rows.append((first if i == 0 else ['', '', '', '', '']) + [float(code), label])
+        else:
+            rows.append(first + ['valor', 'Em reais' if var.decimals else 'Número'])
+        if var.blank_ratio:
+            rows.append(['', '', '', '', '', '', 'Não aplicável'])
+        position += var.width
+    for r, row in enumerate(rows):
+        for c, value in enumerate(row):
+            sheet.write(r, c, value)
+    output = io.BytesIO()
+    book.save(output)
+    return output.getvalue()
+
+def synthetic_value(var:SyntheticVariable, rnd:random.Random, year:int, period:int, uf:int) -> str:
+    if var.name == 'Ano':
+        return str(year)
+    if var.name == 'Trimestre':
+        return str(period)
+    if var.name == 'UF':
+        return f"{uf:02d}"
+    if var.blank_ratio and rnd.random() < var.blank_ratio:
+        return ' ' * var.width
+    if var.name in ('Capital', 'RM_RIDE'):
+        return f"{uf:02d}" if uf in var.codes else ' ' * var.width
+    if var.name in ('UPA', 'Estrato'):
+        return f"{uf:02d}{rnd.randrange(10 ** (var.width - 2)):0{var.width - 2}d}"
+    if var.codes:
+        return f"{rnd.choice(list(var.codes)):0{var.width}d}"
+    if var.decimals:
+        integer = var.width - var.decimals - 1
+        return f"{rnd.uniform(0, 10 ** min(integer, 4)):0{var.width}.{var.decimals}f}"
+    return f"{rnd.randrange(10 ** min(var.width, 5)):0{var.width}d}"
+
+def write_data_zip(path:str, member:str, variables:List[SyntheticVariable], rows:int,
+    year:int, period:int, seed:int = 0) -> None:
+    """Writes a zip with a fixed width data file of rows lines, streaming it
+
+    Args:
+        path (str): the path of the zip file
+        member (str): the name of the data file inside the zip
+        variables (List[SyntheticVariable]): the variables of each line
+        rows (int): the number of lines
+        year (int): the value of Ano
+        period (int): the value of Trimestre
+        seed (int): the seed of the random values
+    """
+    rnd = random.Random(seed)
+    ufs = list(UF_NAMES)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipped_file, \
+        zipped_file.open(member, 'w', force_zip64=True) as data:
+        for _ in range(rows):
+            uf = rnd.choice(ufs)
+            line = ''.join(synthetic_value(var, rnd, year, period, uf) for var in variables)
+            data.write((line + '\r\n').encode('ISO-8859-1'))
+
+def remote_dir(root:str, abspath:str) -> str:
+    path = os.path.join(root, abspath.strip('/'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+LAYOUTS = {
+    "trimestral": build_pnad_trimestral,
+    "anual_visita": build_pnad_anual_visita,
+    "anual_trimestre": build_pnad_anual_trimestre,
+}
+
+def build_release(root:str, layout:str, year:int, period:int, rows:int,
+    variables:List[SyntheticVariable], seed:int = 0) -> PnadReadVars:
+    """Writes the data, input and dictionary files of a release under root, in the
+    directories and with the names the PnadReadVars of the layout expects
+
+    Args:
+        root (str): the directory served as the FTP root
+        layout (str): "trimestral", "anual_visita" or "anual_trimestre"
+        year (int): the year of the release
+        period (int): the quarter or the visit
+        rows (int): the number of lines of the data file
+        variables (List[SyntheticVariable]): the variables of the files
+        seed (int): the seed of the random values
+
+    Returns:
+        PnadReadVars: the read variables of the release
+    """
+    v = LAYOUTS[layout](year, period)
+    if layout == "trimestral":
+        name = f"PNADC_{period:02d}{year}"
+        input_name, dictionary_name = "input_PNADC_trimestral.txt", "dicionario_PNADC_microdados_trimestral.xls"
+    elif layout == "anual_visita":
+        name = f"PNADC_{year}_visita{period}"
+        input_name, dictionary_name = (f"input_PNADC_{year}_visita{period}.txt",
+            f"dicionario_PNADC_microdados_{year}_visita{period}.xls")
+    else:
+        name = f"PNADC_{year}_trimestre{period}"
+        input_name, dictionary_name = (f"input_PNADC_trimestre{period}.txt",
+            f"dicionario_PNADC_microdados_trimestre{period}.xls")
+    write_data_zip(os.path.join(remote_dir(root, v.download_file_abspath), f"{name}.zip"), f"{name}.txt",
+        variables, rows, year, period, seed)
+    if v.input_is_zipped:
+        path = os.path.join(remote_dir(root, v.input_file_abspath), "Dicionario_e_input_20221031.zip")
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipped_file:
+            zipped_file.writestr(input_name, input_file(variables))
+            zipped_file.writestr(dictionary_name, dictionary_file(variables))
+    else:
+        with open(os.path.join(remote_dir(root, v.input_file_abspath), input_name), 'wb') as f:
+            f.write(input_file(variables))
+        with open(os.path.join(remote_dir(root, v.dictionary_file_abspath), dictionary_name), 'wb') as f:
+            f.write(dictionary_file(variables))
+    return v
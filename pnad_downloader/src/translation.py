@@ -0,0 +1,146 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src import PnadDict, PnadParse, Row
+from src.utils import ASCII_CHARS, STATES_ABREV_ASCII_NAMES
+
+# Values outside the dictionary are also memoized, up to this many per column
+MEMO_LIMIT = 4096
+
+def compile_tables(pnad_dict:PnadDict, variables:Sequence[str], tvars:Sequence[str],
+    convert_ascii:bool = False) -> List[Optional[Dict[bytes, str]]]:
+    """Compiles the dictionary into a table from the raw bytes of a code to its label per column position
+
+    Args:
+        pnad_dict (PnadDict): the pnad dictionary
+        variables (Sequence[str]): the variables in file order
+        tvars (Sequence[str]): the variables to translate to string values
+        convert_ascii (bool): fold the labels to ASCII ahead of time
+
+    Returns:
+        List[Optional[Dict[bytes, str]]]: a table per column, None for columns that are only stripped
+    """
+    tvars = set(tvars)
+    tables: List[Optional[Dict[bytes, str]]] = list()
+    for var in variables:
+        codes = pnad_dict.get(var)
+        if var not in tvars or not codes:
+            tables.append(None)
+        elif convert_ascii:
+            tables.append({code.encode('ISO-8859-1'): label.translate(ASCII_CHARS) for code, label in codes.items()})
+        else:
+            tables.append({code.encode('ISO-8859-1'): label for code, label in codes.items()})
+    return tables
+
+@lru_cache(maxsize=None)
+def uf_abrev_from_name(uf_name:str) -> str:
+    """Returns the UF abbreviation from its name, in any case and accentuation"""
+    return STATES_ABREV_ASCII_NAMES[uf_name.lower().translate(ASCII_CHARS)]
+
+@dataclass(frozen=True)
+class Schema:
+    """The columns of the rows of a file, shared by all of them
+
+    Rows are sequences of values in variable order, followed by UF_ABREV when
+    UF is among the variables. Substituting the variables for their descriptions
+    or converting them to ASCII only changes the header.
+    """
+
+    variables: Tuple[str, ...]
+    columns: Tuple[str, ...]
+
+    @property
+    def uf_idx(self) -> Optional[int]:
+        """The position of UF, None when it is not among the variables"""
+        return self.variables.index("UF") if "UF" in self.variables else None
+
+    def header(self, col_names:bool = False, convert_ascii:bool = False) -> List[str]:
+        """Returns the names of the columns of the rows
+
+        Args:
+            col_names (bool): use the column descriptions instead of the variables
+            convert_ascii (bool): convert the names to ASCII
+        """
+        keys = list(self.columns) if col_names else list(self.variables)
+        if convert_ascii:
+            keys = [key.translate(ASCII_CHARS) for key in keys]
+        return keys + ["UF_ABREV"] if self.uf_idx is not None else keys
+
+class RowBuilder:
+    """Parses a line and builds its final row in one step
+
+    Does the work of PnadReader.parse_row, translate_record and transform with
+    the same values, but with tables compiled once per file: each value is a flat
+    lookup of its raw bytes by column position, done inplace on the list from the
+    parser, so no other object is built per row. Codes are never decoded, only
+    their labels and the stripped values of the other columns are.
+    """
+
+    def __init__(self, parse:PnadParse, schema:Schema, pnad_dict:PnadDict, tvars:Sequence[str],
+        col_names:bool = False, convert_ascii:bool = False):
+        """Initiates the RowBuilder object
+
+        Args:
+            parse (PnadParse): the line parser
+            schema (Schema): the variables and column descriptions in file order
+            pnad_dict (PnadDict): the pnad dictionary
+            tvars (Sequence[str]): the variables to translate to string values
+            col_names (bool): use the column descriptions in the header
+            convert_ascii (bool): convert the header and values to ASCII
+        """
+        self.parse = parse
+        self.schema = schema
+        self.pnad_dict = pnad_dict
+        self.variables = list(schema.variables)
+        self.convert_ascii = convert_ascii
+        self.fieldnames = schema.header(col_names, convert_ascii)
+        self.tables = compile_tables(pnad_dict, self.variables, tvars, convert_ascii)
+        self.lookup_idx = [i for i, table in enumerate(self.tables) if table is not None]
+        self.strip_idx = [i for i, table in enumerate(self.tables) if table is None]
+        # UF_ABREV is only added when UF is among the projected variables
+        self.uf_idx = schema.uf_idx
+
+    @property
+    def labels(self) -> List[Optional[List[str]]]:
+        """The labels of each output column, None for the ones that are not translated"""
+        labels = [None if table is None else list(dict.fromkeys(table.values())) for table in self.tables]
+        if self.uf_idx is None:
+            return labels
+        return labels + [list(STATES_ABREV_ASCII_NAMES.values())]
+
+    def _missing(self, idx:int, raw:bytes) -> str:
+        """Translates a value that is not a dictionary code, like translate_record"""
+        value = raw.decode('ISO-8859-1')
+        translated = self.pnad_dict[self.variables[idx]].get(value.replace('.',' '), value.strip(' .'))
+        if self.convert_ascii:
+            translated = translated.translate(ASCII_CHARS)
+        table = self.tables[idx]
+        if len(table) < MEMO_LIMIT:
+            table[raw] = translated
+        return translated
+
+    def translate_values(self, values:List[bytes]) -> List[str]:
+        """Translates or decodes the parsed values of a line inplace and returns them"""
+        tables = self.tables
+        for i in self.lookup_idx:
+            value = values[i]
+            translated = tables[i].get(value)
+            values[i] = translated if translated is not None else self._missing(i, value)
+        if self.convert_ascii:
+            for i in self.strip_idx:
+                values[i] = values[i].strip(b' .').decode('ISO-8859-1').translate(ASCII_CHARS)
+        else:
+            for i in self.strip_idx:
+                values[i] = values[i].strip(b' .').decode('ISO-8859-1')
+        return values
+
+    def build(self, values:List[bytes]) -> Row:
+        """Translates the values parsed from a line and appends UF_ABREV, inplace, and returns them as its row"""
+        values = self.translate_values(values)
+        if self.uf_idx is not None:
+            values.append(uf_abrev_from_name(values[self.uf_idx]))
+        return values
+
+    def __call__(self, line:bytes) -> Row:
+        return self.build(self.parse(line))
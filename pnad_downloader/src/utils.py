@@ -1,7 +1,5 @@
-from typing import Any, Callable, Iterable, List, Union
-from functools import reduce
-from itertools import repeat
-import sys
+from typing import Any, Callable, Collection, Iterable, Iterator, List, Union
+from itertools import chain, islice, repeat
 import re
 
 STATES_ABREV = {
@@ -116,28 +114,37 @@ def chunks(lst:List[Any], n:int):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def get_list_size(ls:List[Any]) -> float:
-    """Return size in memory of a list and all its elements"""
-    return reduce(lambda x, y: x + y, (sys.getsizeof(v) for v in ls), 0) + sys.getsizeof(ls)
+def ichunks(iterable:Iterable[Any], n:int) -> Iterator[Iterator[Any]]:
+    """Yield successive n-sized chunks from any iterable without materializing them.
+    Each chunk must be consumed before asking for the next one."""
+    iterator = iter(iterable)
+    for first in iterator:
+        yield chain([first], islice(iterator, n - 1))
+
+def split_list(text:str) -> List[str]:
+    """Splits a comma separated list, like 'V2007,V2009', ignoring blanks"""
+    return [item.strip() for item in text.split(',') if item.strip()]
 
 def standardize(mystring:str) -> str:
     """Utility to standardize column names for Databricks"""
     return re.sub(r"( |-|\.|\(|\))+","_", mystring).lower()
 
-def merge_lines(line1: List[str], line2: List[str], indexes: List[int]) -> List[str]:
+def merge_lines(line1: List[str], line2: List[str], indexes: Collection[int]) -> List[str]:
     """Keeps all values from line 1 that are in indexes,
     for the others, substitute by the value in line2
 
     Args:
         line1 (List[str]): pnad line to merge
         line2 (List[str]): ohter pnad line to merge
-        indexes (List[int]): indexes of values to keep
+        indexes (Collection[int]): indexes of values to keep, pass a set
+        when merging many lines so it is not rebuilt for each one
 
     Returns:
         List[str]: merged pnad line
     """
     assert len(line1) == len(line2)
-    return [a if idx in indexes else b for idx, a, b in zip(range(len(line1)), line1, line2)]
+    keep = indexes if isinstance(indexes, (set, frozenset)) else set(indexes)
+    return [a if idx in keep else b for idx, a, b in zip(range(len(line1)), line1, line2)]
 
 def apply_inplace(ls:List[Any], func:Callable[[Any], None]) -> None:
     """Applies an inplace function to all entries in list
@@ -0,0 +1,67 @@
+import dataclasses
+import os
+from typing import Callable, Iterator, List
+
+import pytest
+
+import src
+from src import Settings
+from src.benchmark import serve_ftp, write_config
+from src.reader import PnadReader
+from src.synthetic import build_release, synthetic_variables
+from src.trimestral import build_pnad_trimestral
+
+# Lines of each synthetic release, enough to have every UF and several parts
+ROWS = 2000
+
+@pytest.fixture(scope="session")
+def ftp_root(tmp_path_factory) -> str:
+    """Synthetic releases of the first two quarters of 2023, with the same seed so
+    the households and people of both have the same keys"""
+    root = str(tmp_path_factory.mktemp("ftp"))
+    for quarter in (1, 2):
+        build_release(root, "trimestral", 2023, quarter, ROWS, synthetic_variables())
+    return root
+
+@pytest.fixture(scope="session")
+def ftp_port(ftp_root) -> Iterator[int]:
+    server, port = serve_ftp(ftp_root)
+    yield port
+    server.close_all()
+
+@pytest.fixture
+def configure(tmp_path, ftp_port, monkeypatch) -> Callable[..., Settings]:
+    """Sets the settings of the benchmark scenarios (local server, no cache and a single
+    output file) and returns a function to replace some of them, e.g. configure(max_lines=500)"""
+    path = str(tmp_path / "config.ini")
+    write_config(path, str(tmp_path), "127.0.0.1", ftp_port)
+    os.makedirs(tmp_path / "spool")
+    defaults = dataclasses.replace(Settings.from_file(path), cache_path=str(tmp_path / "cache"))
+    def replace(**options) -> Settings:
+        monkeypatch.setattr(src, "_settings", dataclasses.replace(defaults, **options))
+        return src.settings()
+    replace()
+    return replace
+
+@pytest.fixture
+def save_path(tmp_path) -> str:
+    path = tmp_path / "output"
+    path.mkdir()
+    return str(path)
+
+@pytest.fixture
+def reader(configure) -> Iterator[PnadReader]:
+    reader = PnadReader(build_pnad_trimestral(2023, 1))
+    yield reader
+    reader.close()
+
+def save_with_engines(reader:PnadReader, tmp_path, tvars:List[str], file_format:str = "csv") -> List[str]:
+    """Saves the release with the python and the numpy engines and returns the paths of their outputs"""
+    paths = list()
+    with reader.extract_pnad() as extracted:
+        for engine in ("python", "numpy"):
+            path = tmp_path / engine
+            path.mkdir()
+            reader.save_extracted(extracted, tvars, engine=engine, file_format=file_format, save_path=str(path))
+            paths.append(os.path.join(path, f"{reader.pnad_read_vars.save_filename}.{file_format}"))
+    return paths
@@ -0,0 +1,57 @@
+import dataclasses
+from typing import Dict
+
+import numpy as np
+import pytest
+
+from src.aggregate import WeightedAggregator, aggregate_columns
+from src.anual import build_pnad_anual_visita
+from src.reader import PnadReader
+from src.synthetic import build_release, synthetic_variables
+
+@pytest.fixture(scope="module")
+def visit_release(ftp_root:str) -> None:
+    """A release of the first visit of 2023, weighted by V1032 like the yearly releases"""
+    variables = [dataclasses.replace(var, name="V1032") if var.name == "V1028" else var for var in synthetic_variables()]
+    build_release(ftp_root, "anual_visita", 2023, 1, 500, variables)
+
+def weights_by_uf(reader:PnadReader, weight:str) -> Dict[str, float]:
+    totals: Dict[str, float] = dict()
+    with reader.extract_pnad() as path, open(path, 'rb') as f:
+        for line in f:
+            record = reader.parse_row(line)
+            totals[record["UF"]] = totals.get(record["UF"], 0.0) + float(record[weight])
+    return totals
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_weighted_count(reader:PnadReader, engine:str):
+    aggregator = reader.aggregate(["UF"], measures=["VD4020"], engine=engine)
+    assert aggregator.weight == "V1028"
+    expected = weights_by_uf(reader, "V1028")
+    table = aggregator.table()
+    assert {row[0]: row[2] for row in table} == pytest.approx(expected)
+    assert sum(row[1] for row in table) == 2000
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_yearly_releases_are_weighted_by_v1032(configure, visit_release, engine:str):
+    reader = PnadReader(build_pnad_anual_visita(2023, 1))
+    try:
+        assert reader.default_weight() == "V1032"
+        aggregator = reader.aggregate(["UF"], engine=engine)
+        expected = weights_by_uf(reader, "V1032")
+    finally:
+        reader.close()
+    assert aggregator.weight == "V1032"
+    assert {row[0]: row[2] for row in aggregator.table()} == pytest.approx(expected)
+
+def test_values_that_are_not_numbers_are_missing():
+    aggregator = WeightedAggregator(["UF", "peso", "renda"], ["UF"], "peso", ["renda"])
+    aggregator.add_all([["35", "2", "100"], ["35", "1", "abc"], ["35", "x", "50"], ["35", "3", "   "]])
+    assert aggregator.table() == [["35", 4, 6.0, 200.0, 100.0]]
+
+def test_columns_that_are_not_numbers_are_missing():
+    data = np.array([(b"35", b"2", b"100"), (b"35", b"1", b"abc"), (b"35", b"x", b" 50"), (b"35", b"3", b"   ")],
+        dtype=[("UF", "S2"), ("peso", "S1"), ("renda", "S3")])
+    aggregator = WeightedAggregator(["UF", "peso", "renda"], ["UF"], "peso", ["renda"])
+    aggregator.merge(aggregate_columns(data, ["UF"], "peso", ["renda"]))
+    assert aggregator.table() == [["35", 4, 6.0, 200.0, 100.0]]
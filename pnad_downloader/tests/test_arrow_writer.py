@@ -0,0 +1,49 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from conftest import ROWS, save_with_engines
+from src.arrow_writer import ArrowRecordWriter, concat_arrow, read_batches
+from src.reader import PnadReader
+
+def read_table(path:str, file_format:str) -> pa.Table:
+    if file_format == "parquet":
+        return pq.read_table(path)
+    with pa.ipc.open_file(path) as ipc_file:
+        return ipc_file.read_all()
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_engines_save_the_same_table(reader:PnadReader, tmp_path, file_format:str):
+    python_path, numpy_path = save_with_engines(reader, tmp_path, reader.pnad_vars, file_format)
+    table = read_table(python_path, file_format)
+    assert table.num_rows == ROWS
+    assert table.equals(read_table(numpy_path, file_format))
+
+def test_only_categorical_columns_are_encoded(reader:PnadReader, tmp_path):
+    python_path, _ = save_with_engines(reader, tmp_path, reader.pnad_vars, "parquet")
+    schema = pq.read_schema(python_path)
+    assert pa.types.is_dictionary(schema.field("V2007").type)
+    assert pa.types.is_dictionary(schema.field("UF").type)
+    for var in ("V2009", "VD4020", "UPA"):
+        assert schema.field(var).type == pa.string()
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_values_outside_the_labels_are_appended(tmp_path, file_format:str):
+    path = str(tmp_path / f"part.{file_format}")
+    with ArrowRecordWriter(path, ["sexo", "idade"], [["Homem", "Mulher"], None], file_format) as writer:
+        writer.write([["Homem", "30"], ["Mulher", "41"]])
+        writer.write([["Ignorado", "7"], ["Homem", ""]])
+    table = read_table(path, file_format)
+    assert table.column("sexo").to_pylist() == ["Homem", "Mulher", "Ignorado", "Homem"]
+    assert table.column("idade").to_pylist() == ["30", "41", "7", ""]
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_concat_arrow_merges_the_dictionaries(tmp_path, file_format:str):
+    paths = [str(tmp_path / f"shard_{i}.{file_format}") for i in range(2)]
+    for path, sexes in zip(paths, (["Mulher", "Ignorado"], ["Outro", "Homem"])):
+        with ArrowRecordWriter(path, ["sexo"], [["Homem", "Mulher"]], file_format) as writer:
+            writer.write([[sex] for sex in sexes])
+    output = str(tmp_path / f"output.{file_format}")
+    concat_arrow(paths, output, ["sexo"], [["Homem", "Mulher"]], file_format)
+    assert read_table(output, file_format).column("sexo").to_pylist() == ["Mulher", "Ignorado", "Outro", "Homem"]
+    assert len(list(read_batches(output, file_format))) == 2
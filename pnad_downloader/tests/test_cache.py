@@ -0,0 +1,56 @@
+import ftplib
+import os
+import threading
+from typing import List
+
+import pytest
+
+from src import settings
+from src.cache import FtpCache
+from src.ftp import retrieve_file
+from src.trimestral import build_pnad_trimestral
+
+FILE_RE = r"PNADC_012023\.zip"
+
+def test_concurrent_fetches_download_once(configure, ftp_root:str, ftp_port:int):
+    abspath = build_pnad_trimestral(2023, 1).download_file_abspath
+    cache = FtpCache(settings().cache_path, 1024 ** 3, revalidate_after=3600)
+    downloads: List[str] = list()
+    def retrieve(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+        downloads.append(local_path)
+        retrieve_file(ftp, abspath, filename, local_path)
+    paths: List[str] = list()
+    def fetch() -> None:
+        ftp = ftplib.FTP()
+        ftp.connect("127.0.0.1", ftp_port)
+        ftp.login()
+        try:
+            paths.append(cache.fetch(abspath, FILE_RE, ftp, retrieve))
+        finally:
+            ftp.quit()
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(downloads) == 1 and len(paths) == 4 and len(set(paths)) == 1
+    with open(paths[0], 'rb') as cached, open(os.path.join(ftp_root, abspath.strip('/'), "PNADC_012023.zip"), 'rb') as remote:
+        assert cached.read() == remote.read()
+    assert not [name for name in os.listdir(settings().cache_path) if name.endswith(".part")]
+
+def test_failed_download_leaves_no_partial_file(configure, ftp_port:int):
+    abspath = build_pnad_trimestral(2023, 1).download_file_abspath
+    cache = FtpCache(settings().cache_path, 1024 ** 3)
+    def retrieve(ftp:ftplib.FTP, abspath:str, filename:str, local_path:str) -> None:
+        with open(local_path, 'wb') as f:
+            f.write(b'partial')
+        raise EOFError("Connection closed")
+    ftp = ftplib.FTP()
+    ftp.connect("127.0.0.1", ftp_port)
+    ftp.login()
+    try:
+        with pytest.raises(EOFError):
+            cache.fetch(abspath, FILE_RE, ftp, retrieve)
+    finally:
+        ftp.quit()
+    assert [name for name in os.listdir(settings().cache_path) if name != FtpCache.INDEX_FILE] == []
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from conftest import ROWS, save_with_engines
+from src.columnar import line_length, parse_buffer, to_numeric, translate_column
+from src.reader import LOCATION_VARS, PnadReader, mmap_file
+
+@pytest.mark.parametrize("translate", [False, True])
+def test_engines_save_the_same_csv(reader:PnadReader, tmp_path, translate:bool):
+    tvars = reader.pnad_vars if translate else LOCATION_VARS
+    python_path, numpy_path = save_with_engines(reader, tmp_path, tvars)
+    with open(python_path, 'rb') as python_file, open(numpy_path, 'rb') as numpy_file:
+        saved = python_file.read()
+        assert saved == numpy_file.read()
+    assert saved.count(b'\n') == ROWS + 1
+
+def test_parse_buffer_maps_every_line(reader:PnadReader):
+    with reader.extract_pnad() as path, mmap_file(path) as buffer, open(path, 'rb') as f:
+        data = parse_buffer(buffer, reader.input_info)
+        first = f.readline()
+        assert len(data) == ROWS
+        assert [data[0][var].decode('ISO-8859-1') for var in reader.pnad_vars] == list(reader.parse_row(first).values())
+        del data
+
+def test_parse_buffer_pads_the_last_line(reader:PnadReader):
+    with reader.extract_pnad() as path, open(path, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)[:3]
+    unterminated = b''.join(lines).rstrip(b'\r\n')
+    assert line_length(unterminated) == len(lines[0])
+    data = parse_buffer(unterminated, reader.input_info)
+    assert len(data) == 3
+    assert [data[2][var].decode('ISO-8859-1') for var in reader.pnad_vars] == list(reader.parse_row(lines[2]).values())
+
+def test_to_numeric_blanks_are_nan():
+    values = to_numeric(np.array([b'  18', b'    ', b'3.50', b'....'], dtype='S4'))
+    assert values[0] == 18 and values[2] == 3.5
+    assert np.isnan(values[1]) and np.isnan(values[3])
+    with pytest.raises(ValueError):
+        to_numeric(np.array([b'ab'], dtype='S2'))
+
+def test_translate_column():
+    column = np.array([b'1', b'2', b' ', b'1'], dtype='S1')
+    codes = {'1': 'Urbana', '2': 'Rural', ' ': 'Não aplicável'}
+    assert translate_column(column, codes).tolist() == ['Urbana', 'Rural', 'Não aplicável', 'Urbana']
+    assert translate_column(column, codes, False).tolist() == ['1', '2', '', '1']
@@ -0,0 +1,68 @@
+from typing import Callable, List
+
+import pytest
+
+from conftest import save_with_engines
+from src import Record
+from src.filters import InvalidFilter, RowFilter, compile_filter
+from src.reader import LOCATION_VARS, PnadReader, mmap_file
+from src.trimestral import build_pnad_trimestral
+
+@pytest.fixture
+def lines(reader) -> List[bytes]:
+    with reader.extract_pnad() as path, open(path, 'rb') as f:
+        return f.readlines()
+
+def is_blank(value:str) -> bool:
+    return not value.strip()
+
+@pytest.mark.parametrize("expression, expected", [
+    ("UF=35", lambda record: record['UF'] == '35'),
+    ("UF == São Paulo", lambda record: record['UF'] == '35'),
+    ("UF='sao paulo'", lambda record: record['UF'] == '35'),
+    ("UF != 35", lambda record: record['UF'] != '35'),
+    ("Capital in (11, 35)", lambda record: record['Capital'] in ('11', '35')),
+    ("V1022 not in (Rural)", lambda record: record['V1022'] != '2'),
+    ("V2009>=18", lambda record: int(record['V2009']) >= 18),
+    # Blanks never match a comparison, but are different from any code
+    ("VD4020 > 100", lambda record: not is_blank(record['VD4020']) and int(record['VD4020']) > 100),
+    ("Capital != 35", lambda record: record['Capital'] != '35'),
+    ("VD4020 < 100", lambda record: not is_blank(record['VD4020']) and int(record['VD4020']) < 100),
+])
+def test_filter_semantics(reader:PnadReader, lines:List[bytes], expression:str, expected:Callable[[Record], bool]):
+    condition = compile_filter(expression, reader.input_info, reader.pnad_dict)
+    matched = [line for line in lines if condition(line)]
+    assert 0 < len(matched) < len(lines)
+    assert matched == [line for line in lines if expected(reader.parse_row(line))]
+
+@pytest.mark.parametrize("expression", ["UF", "Foo=1", "UF in ()", "UF = 11, 12", "V2009 >= adult"])
+def test_invalid_filters(reader:PnadReader, expression:str):
+    with pytest.raises(InvalidFilter):
+        compile_filter(expression, reader.input_info, reader.pnad_dict)
+
+def test_row_filter_matches_all_conditions(reader:PnadReader, lines:List[bytes]):
+    row_filter = RowFilter.from_expressions(["UF=35", "V2009>=18"], reader.input_info, reader.pnad_dict)
+    records = [reader.parse_row(line) for line in lines if row_filter(line)]
+    assert records
+    assert all(record['UF'] == '35' and int(record['V2009']) >= 18 for record in records)
+
+def test_row_filter_mask_matches_lines(reader:PnadReader, lines:List[bytes]):
+    row_filter = RowFilter.from_expressions(["Capital in (11, 35)", "VD4020 > 100", "V1022 != 2"],
+        reader.input_info, reader.pnad_dict)
+    with reader.extract_pnad() as path, mmap_file(path) as buffer:
+        mask = row_filter.mask(buffer)
+    assert mask.tolist() == [row_filter(line) for line in lines]
+
+@pytest.mark.parametrize("where", [["UF=35", "V2009>=18"], ["VD4020 > 100", "Capital in (11, 'Município de São Paulo (SP)')"]])
+def test_engines_save_the_same_filtered_rows(configure, tmp_path, where:List[str]):
+    reader = PnadReader(build_pnad_trimestral(2023, 1), where=where)
+    try:
+        python_path, numpy_path = save_with_engines(reader, tmp_path, LOCATION_VARS)
+        with reader.extract_pnad() as path, open(path, 'rb') as f:
+            matched = sum(1 for line in f if reader.row_filter(line))
+    finally:
+        reader.close()
+    with open(python_path, 'rb') as python_file, open(numpy_path, 'rb') as numpy_file:
+        saved = python_file.read()
+        assert saved == numpy_file.read()
+    assert 0 < matched == saved.count(b'\n') - 1
@@ -0,0 +1,117 @@
+import ftplib
+import os
+import threading
+from typing import List
+
+import pytest
+
+from src.ftp import PROGRESS_SUFFIX, FtpPool, SegmentedDownload, remote_stat, segmented_retriever
+from src.reader import PnadReader
+from src.trimestral import build_pnad_trimestral
+
+FILENAME = "PNADC_012023.zip"
+
+@pytest.fixture
+def remote(ftp_root:str) -> bytes:
+    """The data zip of the first quarter of 2023, as served"""
+    abspath = build_pnad_trimestral(2023, 1).download_file_abspath
+    with open(os.path.join(ftp_root, abspath.strip('/'), FILENAME), 'rb') as f:
+        return f.read()
+
+def download(pool:FtpPool, local_path:str, segments:int, download_class:type = SegmentedDownload) -> SegmentedDownload:
+    abspath = build_pnad_trimestral(2023, 1).download_file_abspath
+    with pool.connection() as ftp:
+        ftp.cwd(abspath)
+        size, mdtm = remote_stat(ftp, FILENAME)
+        segmented = download_class(pool, abspath, FILENAME, local_path, size, mdtm, segments)
+        segmented.run(ftp)
+    return segmented
+
+class InterruptedDownload(SegmentedDownload):
+    """Loses the connection halfway through the first range it downloads"""
+
+    def _fetch_range(self, fd:int, byte_range:List[int], ftp:ftplib.FTP) -> None:
+        end = byte_range[1]
+        byte_range[1] = (byte_range[0] + end) // 2
+        try:
+            super()._fetch_range(fd, byte_range, ftp)
+        finally:
+            byte_range[1] = end
+        raise EOFError("Connection closed")
+
+class RecordedDownload(SegmentedDownload):
+    """Records where each range starts to be downloaded"""
+
+    def __init__(self, *args):
+        self.starts: List[int] = list()
+        super().__init__(*args)
+
+    def _fetch_range(self, fd:int, byte_range:List[int], ftp:ftplib.FTP) -> None:
+        self.starts.append(byte_range[2])
+        super()._fetch_range(fd, byte_range, ftp)
+
+def test_interrupted_range_resumes_in_the_next_run(configure, tmp_path, remote:bytes):
+    configure(ftp_max_sessions=1, ftp_retries=0)
+    pool = PnadReader.build_pool()
+    local_path = str(tmp_path / FILENAME)
+    with pytest.raises(EOFError):
+        download(pool, local_path, 4, InterruptedDownload)
+    assert os.path.isfile(local_path + PROGRESS_SUFFIX)
+
+    resumed = download(pool, local_path, 4, RecordedDownload)
+    pool.close()
+    step = -(-len(remote) // 4)
+    assert sorted(resumed.starts) == [step // 2, step, 2 * step, 3 * step]
+    with open(local_path, 'rb') as f:
+        assert f.read() == remote
+    assert not os.path.exists(local_path + PROGRESS_SUFFIX)
+
+def test_changed_file_is_downloaded_again(configure, tmp_path, remote:bytes):
+    configure(ftp_max_sessions=1, ftp_retries=0)
+    pool = PnadReader.build_pool()
+    local_path = str(tmp_path / FILENAME)
+    with pytest.raises(EOFError):
+        download(pool, local_path, 4, InterruptedDownload)
+    # The remote file was changed since, its progress is discarded
+    with open(local_path + PROGRESS_SUFFIX, 'r+') as f:
+        progress = f.read().replace('"mdtm": "', '"mdtm": "1')
+        f.seek(0)
+        f.write(progress)
+    resumed = download(pool, local_path, 4, RecordedDownload)
+    pool.close()
+    assert 0 in resumed.starts
+    with open(local_path, 'rb') as f:
+        assert f.read() == remote
+
+def test_segments_stay_within_max_sessions(configure, tmp_path, remote:bytes):
+    configure(ftp_max_sessions=2)
+    pool = PnadReader.build_pool()
+    lock = threading.Lock()
+    open_connections = peak = 0
+    connect = pool.connect
+    def counted_connect() -> ftplib.FTP:
+        nonlocal open_connections, peak
+        ftp = connect()
+        close = ftp.close
+        def counted_close() -> None:
+            nonlocal open_connections
+            if ftp.sock is not None:
+                with lock:
+                    open_connections -= 1
+            close()
+        ftp.close = counted_close
+        with lock:
+            open_connections += 1
+            peak = max(peak, open_connections)
+        return ftp
+    pool.connect = counted_connect
+
+    abspath = build_pnad_trimestral(2023, 1).download_file_abspath
+    local_path = str(tmp_path / FILENAME)
+    retrieve = segmented_retriever(pool, 16, 0)
+    pool.run(lambda ftp: (ftp.cwd(abspath), retrieve(ftp, abspath, FILENAME, local_path)))
+    pool.close()
+    assert peak == 2
+    assert open_connections == 0
+    with open(local_path, 'rb') as f:
+        assert f.read() == remote
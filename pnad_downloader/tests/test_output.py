@@ -0,0 +1,51 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from typing import List
+
+import pytest
+
+from conftest import ROWS
+from src.reader import LOCATION_VARS, PnadReader
+
+def save_csv(reader:PnadReader, save_path:str) -> dict:
+    reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(lines, LOCATION_VARS), save_path))
+    with open(os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}_manifest.json")) as f:
+        return json.load(f)
+
+def decompress(path:str) -> bytes:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith(".gz"):
+        return gzip.decompress(data)
+    if path.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    return data
+
+@pytest.mark.parametrize("compression, extension", [("none", ".csv"), ("gzip", ".csv.gz"), ("zstd", ".csv.zst")])
+def test_parts_and_manifest(reader:PnadReader, configure, save_path:str, compression:str, extension:str):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    configure(max_lines=600, compression=compression)
+    manifest = save_csv(reader, save_path)
+    filename = reader.pnad_read_vars.save_filename
+    assert [part["file"] for part in manifest["parts"]] == [f"{filename}_part_{i}{extension}" for i in range(4)]
+    assert [part["rows"] for part in manifest["parts"]] == [600, 600, 600, 200]
+    assert sorted(os.listdir(save_path)) == sorted([f"{filename}_manifest.json"] + [part["file"] for part in manifest["parts"]])
+    lines: List[bytes] = list()
+    for part in manifest["parts"]:
+        path = os.path.join(save_path, part["file"])
+        with open(path, 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == part["sha256"]
+        header, *rows = decompress(path).splitlines()
+        assert len(rows) == part["rows"]
+        lines.extend(rows)
+    assert len(lines) == ROWS
+
+def test_single_file_without_max_lines(reader:PnadReader, save_path:str):
+    manifest = save_csv(reader, save_path)
+    assert [part["file"] for part in manifest["parts"]] == [f"{reader.pnad_read_vars.save_filename}.csv"]
+    assert manifest["parts"][0]["rows"] == ROWS
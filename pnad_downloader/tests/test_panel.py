@@ -0,0 +1,67 @@
+import csv
+import os
+from typing import Dict, List
+
+import pytest
+
+from src.panel import HOUSEHOLD_KEYS, PERSON_KEYS, PanelIndex, link_panel, split_key
+from src.reader import PnadReader
+from src.release import Release
+
+RELEASES = [Release(2023, quarter=1), Release(2023, quarter=2)]
+
+def read_linked(save_path:str) -> List[Dict[str, str]]:
+    path = os.path.join(save_path, "panel_pnad_trimestral_2023_trimestre_1_pnad_trimestral_2023_trimestre_2.csv")
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+def unique_keys(reader:PnadReader, keys:List[str]) -> int:
+    with reader.extract_pnad() as path, open(path, 'rb') as f:
+        records = [reader.parse_row(line) for line in f]
+    return len({tuple(record[var] for var in keys) for record in records})
+
+@pytest.mark.parametrize("keys", [PERSON_KEYS, HOUSEHOLD_KEYS])
+def test_panel_links_every_key_of_both_quarters(reader:PnadReader, save_path:str, keys:List[str]):
+    parts = link_panel(RELEASES, keys, ["Trimestre", "V2009"], save_path=save_path)
+    linked = read_linked(save_path)
+    assert sum(part.rows for part in parts) == len(linked) == unique_keys(reader, keys)
+    assert list(linked[0]) == keys + ["waves", "Trimestre", "V2009"]
+    # The quarters have the same keys, with the value of the last one
+    assert {row["waves"] for row in linked} == {"1;2"}
+    assert {row["Trimestre"] for row in linked} == {"2"}
+    sorted_keys = [tuple(row[var] for var in keys) for row in linked]
+    assert sorted_keys == sorted(sorted_keys)
+
+def test_panel_keeps_the_first_wave(configure, save_path:str):
+    link_panel(RELEASES, payload=["Trimestre", "V2009"], keep=["Trimestre"], save_path=save_path)
+    assert {row["Trimestre"] for row in read_linked(save_path)} == {"1"}
+
+def test_wide_panel(configure, save_path:str):
+    link_panel(RELEASES, payload=["Trimestre", "UF"], wide=True, save_path=save_path)
+    linked = read_linked(save_path)
+    assert list(linked[0]) == PERSON_KEYS + ["waves", "Trimestre_1", "UF_1", "Trimestre_2", "UF_2"]
+    assert {(row["Trimestre_1"], row["Trimestre_2"]) for row in linked} == {("1", "2")}
+    # Locations are always translated
+    assert all(row["UF_1"] == row["UF_2"] and not row["UF_1"].isdigit() for row in linked)
+
+def test_panel_filters_the_lines(configure, save_path:str):
+    link_panel(RELEASES, payload=["UF"], where=["UF=35"], save_path=save_path)
+    linked = read_linked(save_path)
+    assert linked
+    assert {row["UF"] for row in linked} == {"São Paulo"}
+
+def test_panel_index_is_reused(configure, save_path:str, monkeypatch):
+    link_panel(RELEASES, payload=["V2009"], save_path=save_path)
+    index_path = os.path.join(save_path, "panel")
+    assert sorted(os.listdir(index_path)) == sorted(f"{release}.{extension}"
+        for release in RELEASES for extension in ("idx", "json"))
+    def build(*args, **kwargs):
+        raise AssertionError("The index was built again")
+    monkeypatch.setattr(PanelIndex, "build", staticmethod(build))
+    link_panel(RELEASES, payload=["V2009"], save_path=save_path)
+    # Another payload needs other indexes
+    with pytest.raises(AssertionError):
+        link_panel(RELEASES, payload=["V2010"], save_path=save_path)
+
+def test_split_key():
+    assert split_key("35000012301 02", [9, 2, 3]) == ["350000123", "01", "02"]
@@ -0,0 +1,49 @@
+import gzip
+import os
+from typing import Dict, List, Optional
+
+import pytest
+
+from conftest import ROWS
+from src.reader import LOCATION_VARS, PnadReader
+from src.parallel import process_in_parallel, shard_ranges
+from src.trimestral import build_pnad_trimestral
+
+def read_parts(path:str) -> Dict[str, bytes]:
+    """Returns the decompressed content of each part, as joined gzip members differ
+    in their bytes from a single stream"""
+    parts = dict()
+    for name in os.listdir(path):
+        if not name.endswith("_manifest.json"):
+            with open(os.path.join(path, name), 'rb') as f:
+                parts[name] = gzip.decompress(f.read())
+    return parts
+
+def test_shards_follow_the_number_of_workers():
+    data = b''.join(f"{i:09d}\r\n".encode() for i in range(10))
+    ranges = shard_ranges(data, shards=4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    assert all(end % 11 == 0 for _, end in ranges)
+
+@pytest.mark.parametrize("where", [None, ["Capital != 35"]])
+@pytest.mark.parametrize("max_lines", [0, 600, 5000])
+def test_parts_match_the_serial_writer(configure, tmp_path, max_lines:int, where:Optional[List[str]]):
+    configure(max_lines=max_lines, compression="gzip")
+    reader = PnadReader(build_pnad_trimestral(2023, 1), where=where)
+    serial, parallel = tmp_path / "serial", tmp_path / "parallel"
+    serial.mkdir()
+    parallel.mkdir()
+    try:
+        with reader.extract_pnad() as extracted:
+            reader.save_extracted(extracted, LOCATION_VARS, engine="python", save_path=str(serial))
+            parts = process_in_parallel(reader, extracted, str(parallel), LOCATION_VARS, False, "python", workers=3)
+    finally:
+        reader.close()
+    assert read_parts(str(parallel)) == read_parts(str(serial))
+    if max_lines:
+        # Each part but the last is full, even when the shards do not align with max_lines
+        assert all(part.rows == max_lines for part in parts[:-1])
+    if where is None:
+        assert sum(part.rows for part in parts) == ROWS
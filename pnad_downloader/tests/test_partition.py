@@ -0,0 +1,127 @@
+import csv
+import json
+import os
+from typing import Dict, List
+
+import pytest
+
+from conftest import ROWS
+from src.partition import (DEFAULT_PARTITION, CsvPartFile, PartFile, PartitionedWriter, escape_partition_value,
+    rows_to_partitions)
+from src.reader import LOCATION_VARS, PnadReader, PnadVariableNotFound
+
+def save_partitions(reader:PnadReader, save_path:str, partition_by:List[str], file_format:str = "csv") -> Dict:
+    reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(lines, LOCATION_VARS), save_path,
+        file_format, LOCATION_VARS, partition_by=partition_by))
+    with open(os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}_manifest.json")) as f:
+        return json.load(f)
+
+def test_partition_layout(reader:PnadReader, save_path:str):
+    manifest = save_partitions(reader, save_path, ["UF_ABREV"])
+    root = os.path.join(save_path, reader.pnad_read_vars.save_filename)
+    assert sorted(os.listdir(save_path)) == sorted([reader.pnad_read_vars.save_filename,
+        f"{reader.pnad_read_vars.save_filename}_manifest.json"])
+    assert all(directory.startswith("UF_ABREV=") for directory in os.listdir(root))
+    assert sorted(part["file"] for part in manifest["parts"]) == \
+        sorted(os.path.join(directory, "part-0.csv") for directory in os.listdir(root))
+    assert sum(part["rows"] for part in manifest["parts"]) == ROWS
+    uf = reader.fieldnames().index("UF")
+    for part in manifest["parts"]:
+        with open(os.path.join(root, part["file"]), 'r', encoding='utf-8', newline='') as f:
+            header, *rows = list(csv.reader(f))
+        # The partition column is left out of the files
+        assert header == reader.fieldnames()[:-1]
+        assert len(rows) == part["rows"]
+        states = {row[uf] for row in rows}
+        assert len(states) == 1
+
+def test_partition_by_several_variables(reader:PnadReader, save_path:str):
+    manifest = save_partitions(reader, save_path, ["UF_ABREV", "Capital"])
+    files = [part["file"] for part in manifest["parts"]]
+    assert os.path.join("UF_ABREV=SP", "Capital=Município de São Paulo (SP)", "part-0.csv") in files
+    assert os.path.join("UF_ABREV=SP", "Capital=Não aplicável", "part-0.csv") in files
+    assert sum(part["rows"] for part in manifest["parts"]) == ROWS
+
+def test_parquet_partitions_are_a_dataset(reader:PnadReader, save_path:str):
+    import pyarrow.dataset as ds
+    save_partitions(reader, save_path, ["UF_ABREV"], "parquet")
+    dataset = ds.dataset(os.path.join(save_path, reader.pnad_read_vars.save_filename), format="parquet",
+        partitioning="hive")
+    table = dataset.to_table()
+    assert table.num_rows == ROWS
+    assert table.column_names == reader.fieldnames()
+
+def test_missing_partition_variable(reader:PnadReader, save_path:str):
+    with pytest.raises(PnadVariableNotFound):
+        reader.to_file(iter(()), save_path, partition_by=["V9999"])
+    assert os.listdir(save_path) == []
+
+def test_escape_partition_value():
+    assert escape_partition_value("São Paulo") == "São Paulo"
+    assert escape_partition_value("a/b=c") == "a%2Fb%3Dc"
+    # Blank values, e.g. of variables that are not translated
+    assert escape_partition_value("") == DEFAULT_PARTITION
+
+def test_part_file_is_abstract():
+    with pytest.raises(TypeError):
+        PartFile("part-0.csv")
+
+def test_buffered_rows_stay_within_budget(tmp_path):
+    opened: List[CsvPartFile] = list()
+    def open_part(path:str, data_idx:List[int]) -> CsvPartFile:
+        opened.append(CsvPartFile(path, [f"c{i}" for i in data_idx]))
+        return opened[-1]
+    writer = PartitionedWriter(str(tmp_path), ["key", "value"], [0], ["key"], open_part, ".csv",
+        max_open=100, buffer_rows=50, max_buffered=200)
+    peak = 0
+    for i in range(5000):
+        writer.write([str(i % 40), str(i)])
+        peak = max(peak, writer.buffered)
+    parts = writer.close()
+    assert peak <= 200
+    assert writer.buffered == 0
+    assert sum(part.rows for part in parts) == 5000
+    assert len({os.path.dirname(part.file) for part in parts}) == 40
+
+def test_parts_roll_over_at_part_size(tmp_path):
+    open_part = lambda path, data_idx: CsvPartFile(path, ["value"])
+    writer = PartitionedWriter(str(tmp_path), ["key", "value"], [0], ["key"], open_part, ".csv",
+        max_open=1, part_size=100, buffer_rows=10)
+    for i in range(100):
+        writer.write(["a" if i < 50 or i % 2 else "b", f"{i:08d}"])
+    parts = writer.close()
+    files: Dict[str, List[str]] = dict()
+    for part in parts:
+        files.setdefault(os.path.dirname(part.file), list()).append(os.path.basename(part.file))
+    assert sorted(files) == ["key=a", "key=b"]
+    for names in files.values():
+        assert len(names) > 1
+        assert names == [f"part-{i}.csv" for i in range(len(names))]
+    assert sum(part.rows for part in parts) == 100
+
+def test_failed_write_leaves_no_partial_output(tmp_path):
+    def rows():
+        for i in range(12000):
+            yield [str(i % 2), str(i)]
+        raise ValueError("Stopped")
+    with pytest.raises(ValueError):
+        rows_to_partitions(str(tmp_path), "pnad", ["key", "value"], ["key", "value"], ["key"], rows())
+    assert os.listdir(tmp_path) == []
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_columnar_parts_roll_over_at_part_size(tmp_path, file_format:str):
+    rows = [["a" if i % 3 else "b", f"{i:08d}", "Homem" if i % 2 else "Mulher"] for i in range(30000)]
+    parts = rows_to_partitions(str(tmp_path), "pnad", ["key", "value", "sexo"], ["key", "value", "sexo"], ["key"],
+        rows, file_format, [None, None, ["Homem", "Mulher"]], part_size=16 * 1024)
+    # Each part is closed once the batches written to it reach part_size
+    assert len(parts) > 2
+    assert sum(part.rows for part in parts) == 30000
+
+def test_arrow_part_size_counts_the_buffered_batches(tmp_path):
+    from src.partition import ArrowPartFile
+    part = ArrowPartFile(str(tmp_path / "part-0.parquet"), ["value"], [None], "parquet")
+    part.write([[f"{i:08d}"] for i in range(1000)])
+    written = part.size
+    part.write([[f"{i:08d}"] for i in range(1000)])
+    assert 8000 <= written < part.size
+    part.close()
@@ -0,0 +1,127 @@
+import io
+import logging
+import os
+from itertools import count
+from typing import Callable, List
+import zipfile
+
+import pytest
+
+from src.ftp import DownloadVerificationError, StreamingDownload
+from src.pipeline import inflate_zip_member
+from src.reader import LOCATION_VARS, PnadReader
+from src.trimestral import build_pnad_trimestral
+import src.reader
+
+def zip_bytes(members:List[tuple], compression:int = zipfile.ZIP_DEFLATED) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', compression) as zipped_file:
+        for name, data in members:
+            zipped_file.writestr(name, data)
+    return output.getvalue()
+
+def chunked(data:bytes, size:int = 1000) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+DATA = b''.join(b"%08d%s\r\n" % (i, b"x" * (i % 50)) for i in range(20000))
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_inflate_zip_member_skips_other_members(compression:int):
+    data = zip_bytes([("input.txt", b"cards"), ("PNADC_012023.txt", DATA)], compression)
+    assert b''.join(inflate_zip_member(chunked(data), r"PNADC_.*\.txt")) == DATA
+
+def test_inflate_zip_member_reads_data_descriptors():
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipped_file, \
+        zipped_file.open("PNADC_012023.txt", 'w', force_zip64=True) as member:
+        member.write(DATA)
+    assert b''.join(inflate_zip_member(chunked(output.getvalue()), r"PNADC_.*\.txt")) == DATA
+
+def test_truncated_stream_is_rejected():
+    data = zip_bytes([("PNADC_012023.txt", DATA)])
+    with pytest.raises(zipfile.BadZipFile):
+        b''.join(inflate_zip_member(chunked(data[:len(data) // 2]), r"PNADC_.*\.txt"))
+
+def test_corrupted_stream_fails_the_crc():
+    data = bytearray(zip_bytes([("PNADC_012023.txt", DATA)], zipfile.ZIP_STORED))
+    data[len(data) // 2] ^= 0x01
+    with pytest.raises(DownloadVerificationError):
+        b''.join(inflate_zip_member(chunked(bytes(data)), r"PNADC_.*\.txt"))
+
+def test_missing_member_is_reported():
+    data = zip_bytes([("input.txt", b"cards")])
+    with pytest.raises(FileNotFoundError):
+        b''.join(inflate_zip_member(chunked(data), r"PNADC_.*\.txt"))
+
+def save_csv(reader:PnadReader, save_path:str) -> bytes:
+    reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(lines, LOCATION_VARS), save_path))
+    with open(os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}.csv"), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def expected(reader:PnadReader, tmp_path) -> bytes:
+    """The csv of the release saved from the extracted file, without the pipeline"""
+    path = tmp_path / "expected"
+    path.mkdir()
+    with reader.extract_pnad() as extracted:
+        reader.save_extracted(extracted, LOCATION_VARS, save_path=str(path))
+    with open(os.path.join(path, f"{reader.pnad_read_vars.save_filename}.csv"), 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize("cache", [False, True])
+@pytest.mark.parametrize("segments", [1, 4])
+def test_pipeline_saves_the_extracted_output(configure, save_path:str, expected:bytes, cache:bool, segments:int):
+    configure(cache_enabled=cache, ftp_segments=segments, ftp_segment_min_bytes=0)
+    reader = PnadReader(build_pnad_trimestral(2023, 1))
+    try:
+        assert reader.streams_pnad()
+        assert save_csv(reader, save_path) == expected
+        # From the cache the second time
+        if cache:
+            os.remove(os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}.csv"))
+            assert save_csv(reader, save_path) == expected
+    finally:
+        reader.close()
+    assert os.listdir(src.settings().spool_path) == []
+
+def truncate(chunk:bytes, i:int) -> bytes:
+    return b'' if i >= 10 else chunk
+
+def flip(chunk:bytes, i:int) -> bytes:
+    return chunk[:100] + bytes([chunk[100] ^ 0x01]) + chunk[101:] if i == 10 else chunk
+
+@pytest.mark.parametrize("corrupt", [truncate, flip])
+def test_corrupted_stream_is_read_again(reader:PnadReader, configure, save_path:str, expected:bytes,
+    monkeypatch, caplog, corrupt:Callable[[bytes, int], bytes]):
+    configure(max_lines=500)
+    downloads = count()
+    class CorruptedDownload(StreamingDownload):
+        """Corrupts the first download of the zip after ten chunks, once several parts were written"""
+
+        CHUNK_SIZE = 4096
+        BLOCK_SIZE = 1024
+
+        def __init__(self, consume:Callable[[bytes], None]):
+            chunks = count()
+            if next(downloads) == 0:
+                consume = lambda chunk, consume=consume: consume(corrupt(chunk, next(chunks)))
+            super().__init__(consume)
+    monkeypatch.setattr(src.reader, "StreamingDownload", CorruptedDownload)
+
+    outputs = list()
+    def consume(lines) -> None:
+        # Nothing of the corrupted attempt is left when the zip is read again
+        outputs.append(sorted(os.listdir(save_path)))
+        reader.to_file(reader.rows_from_lines(lines, LOCATION_VARS), save_path)
+    with caplog.at_level(logging.WARNING):
+        reader.read_pnad(consume)
+    assert "corrupted" in caplog.text
+    assert outputs == [[], []]
+    filename = reader.pnad_read_vars.save_filename
+    saved = sorted(name for name in os.listdir(save_path) if name.endswith(".csv"))
+    assert saved == [f"{filename}_part_{i}.csv" for i in range(4)]
+    lines = list()
+    for name in saved:
+        with open(os.path.join(save_path, name), 'rb') as f:
+            lines.extend(f.read().splitlines(keepends=True)[1:])
+    assert lines == expected.splitlines(keepends=True)[1:]
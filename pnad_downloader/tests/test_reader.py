@@ -0,0 +1,49 @@
+import csv
+from typing import List
+
+import pytest
+
+from conftest import save_with_engines
+from src.reader import LOCATION_VARS, PnadReader, PnadVariableNotFound, project_input
+from src.trimestral import build_pnad_trimestral
+
+def read_csv(path:str) -> List[List[str]]:
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+@pytest.mark.parametrize("columns, header", [
+    (["V2009", "UF"], ["UF", "V2009", "UF_ABREV"]),
+    # UF_ABREV is only added with UF
+    (["V2007", "VD4020"], ["V2007", "VD4020"]),
+])
+def test_projected_columns(configure, tmp_path, columns:List[str], header:List[str]):
+    reader = PnadReader(build_pnad_trimestral(2023, 1), columns=columns)
+    full = PnadReader(build_pnad_trimestral(2023, 1), reader.input_info, reader.pnad_dict, reader.pool)
+    try:
+        python_path, numpy_path = save_with_engines(reader, tmp_path, reader.pnad_vars)
+        (tmp_path / "full").mkdir()
+        expected_path, _ = save_with_engines(full, tmp_path / "full", full.pnad_vars)
+    finally:
+        reader.close()
+    projected = read_csv(python_path)
+    assert projected == read_csv(numpy_path)
+    assert projected[0] == header
+    # The same values as the same columns of the whole file
+    full_rows = read_csv(expected_path)
+    idx = [full_rows[0].index(name) for name in header]
+    assert projected[1:] == [[row[i] for i in idx] for row in full_rows[1:]]
+
+def test_projection_keeps_file_order_and_positions(reader:PnadReader):
+    projected = project_input(reader.input_info, ["V2009", "UF"])
+    assert [info[1] for info in projected] == ["UF", "V2009"]
+    assert set(projected) <= set(reader.input_info)
+
+def test_unknown_column(reader:PnadReader):
+    with pytest.raises(PnadVariableNotFound):
+        project_input(reader.input_info, ["UF", "V9999"])
+
+def test_location_vars_are_translated(reader:PnadReader, tmp_path):
+    python_path, _ = save_with_engines(reader, tmp_path, LOCATION_VARS)
+    rows = read_csv(python_path)
+    uf, sex = rows[0].index("UF"), rows[0].index("V2007")
+    assert all(not row[uf].isdigit() and row[sex] in ("1", "2") for row in rows[1:])
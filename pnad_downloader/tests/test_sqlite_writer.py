@@ -0,0 +1,58 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import ROWS
+from src.reader import LOCATION_VARS, PnadReader
+from src.sqlite_writer import DATA_TABLE, LABELS_TABLE, VARIABLES_TABLE, create_table_sql, quote
+
+def save_sqlite(reader:PnadReader, save_path:str) -> str:
+    reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(lines, LOCATION_VARS), save_path,
+        "sqlite", LOCATION_VARS))
+    return os.path.join(save_path, f"{reader.pnad_read_vars.save_filename}.sqlite")
+
+def test_sqlite_database(reader:PnadReader, configure, save_path:str):
+    configure(max_lines=300)
+    path = save_sqlite(reader, save_path)
+    assert sorted(os.listdir(save_path)) == sorted([os.path.basename(path),
+        f"{reader.pnad_read_vars.save_filename}_manifest.json"])
+    with sqlite3.connect(path) as connection:
+        assert connection.execute(f"SELECT COUNT(*) FROM {DATA_TABLE}").fetchone()[0] == ROWS
+        # Translated variables and keys are text, with their leading zeros, the others numbers
+        uf, upa, age = connection.execute(f"SELECT UF, UPA, V2009 FROM {DATA_TABLE} LIMIT 1").fetchone()
+        assert isinstance(uf, str) and isinstance(upa, str) and isinstance(age, int)
+        assert len(upa) == 9
+        # Blanks are NULL
+        blanks = connection.execute(f"SELECT COUNT(*) FROM {DATA_TABLE} WHERE VD4020 IS NULL").fetchone()[0]
+        assert 0 < blanks < ROWS
+        assert connection.execute(f"SELECT COUNT(*) FROM {DATA_TABLE} WHERE VD4020 = ''").fetchone()[0] == 0
+        indexes = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"idx_UF", "idx_UPA", "idx_UPA_V1008_V1014"} <= indexes
+
+def test_sqlite_labels_join_the_codes(reader:PnadReader, save_path:str):
+    path = save_sqlite(reader, save_path)
+    with sqlite3.connect(path) as connection:
+        translated = dict(connection.execute(f"SELECT variable, translated FROM {VARIABLES_TABLE}"))
+        assert translated["UF"] == 1 and translated["V2007"] == 0
+        sexes = connection.execute(f"SELECT DISTINCT l.label FROM {DATA_TABLE} p JOIN {LABELS_TABLE} l "
+            "ON l.variable = 'V2007' AND l.code = p.V2007").fetchall()
+        assert sorted(label for label, in sexes) == ["Homem", "Mulher"]
+
+def test_failed_load_leaves_no_database(reader:PnadReader, save_path:str):
+    def failing_lines(lines):
+        for i, line in enumerate(lines):
+            if i == 1000:
+                raise ValueError("Stopped")
+            yield line
+    with pytest.raises(ValueError):
+        reader.read_pnad(lambda lines: reader.to_file(reader.rows_from_lines(failing_lines(lines), LOCATION_VARS),
+            save_path, "sqlite", LOCATION_VARS))
+    assert os.listdir(save_path) == []
+
+def test_create_table_sql_quotes_descriptions():
+    sql = create_table_sql(['Sexo "do morador"', "Idade"], ["TEXT", "NUMERIC"], ["Sexo", "Idade do\nmorador"])
+    assert quote('Sexo "do morador"') in sql
+    assert "-- Idade do morador" in sql
+    with sqlite3.connect(":memory:") as connection:
+        connection.execute(sql)